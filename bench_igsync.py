@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# (c) Stefan Countryman 2018
+
+"""
+Benchmarks for igsync. Run with ``python bench_igsync.py`` (use ``-h`` to see
+options) and compare timings before and after changing the code they cover.
+"""
+
+import os
+import ssl
+import sys
+import json
+import time
+import threading
+import subprocess
+from copy import deepcopy
+from contextlib import contextmanager
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import igsync
+from test_igsync import (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON, CDN_HOST,
+                         KeepAliveCdnHandler)
+
+
+def new_db():
+    """Make an empty, initialized database in a tempfile."""
+    tmp = NamedTemporaryFile(delete=False, suffix='.sqlite')
+    tmp.file.close()
+    return igsync.InstagramDb(path=tmp.name).inittables()
+
+
+def synthetic_posts(count, users=500):
+    """Make ``count`` distinct posts by varying the primary keys of the example
+    posts from the test suite, spread across ``users`` distinct users."""
+    templates = [json.loads(p) for p in (CAROUSEL_JSON, VIDEO_JSON,
+                                         IMAGE_JSON)]
+    posts = []
+    for i in range(count):
+        post = deepcopy(templates[i % len(templates)])
+        media = post['media']
+        media['pk'] = str(10**18 + i)
+        media['code'] = "bench{}".format(i)
+        media['user'] = dict(media['user'], pk=str(i % users))
+        posts.append(post)
+    return posts
+
+
+def timed(func, *args, **kwargs):
+    """Return the wall time in seconds taken to run ``func``."""
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_save_posts(count=5000):
+    """Compare saving ``count`` posts one at a time with ``save_post`` (one
+    commit per post) against a single ``save_posts`` call."""
+    posts = synthetic_posts(count)
+    serial_db = new_db()
+    serial = timed(lambda: [serial_db.save_post(p) for p in posts])
+    bulk = timed(new_db().save_posts, posts)
+    return dict(save_post=serial, save_posts=bulk, speedup=serial/bulk)
+
+
+def bench_migrate(count=1000000, batch_size=50000):
+    """Time migrating a ``count``-row ``posts`` table with the pre-versioning
+    schema (integer ``user_pk``) to the latest schema, which rebuilds the
+    table in chunks of ``batch_size`` rows."""
+    db = new_db()
+    old_posts = db.TABLE_DEFINITIONS.POSTS.replace(
+        'user_pk                     text   ',
+        'user_pk                     integer'
+    )
+    db.cursor.execute("DROP TABLE posts")
+    db.cursor.execute(old_posts)
+    db.cursor.executemany(
+        'INSERT INTO posts VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+        ((str(10**18 + i), "bench{}".format(i), 1500000000 + i, 1, 1, 1, 0,
+          i % 500, 0, "caption", "{}", 0, 1) for i in range(count))
+    )
+    igsync.migrations.set_version(db.cursor, 0)
+    db.connection.commit()
+    elapsed = timed(db.migrate, batch_size)
+    return dict(rows=count, seconds=elapsed, rows_per_second=count/elapsed)
+
+
+def bench_post_codecs(count=2000):
+    """Compare the average stored size of ``count`` posts' ``post_json`` as
+    a Python ``repr`` (how old versions stored it), JSON, zlib, and zlib with
+    a dictionary trained on the saved posts."""
+    posts = synthetic_posts(count)
+    db = new_db()
+    db.save_posts(posts)
+    size = "SELECT avg(length(post_json)) FROM posts"
+    result = dict(json=db.cursor.execute(size).fetchone()[0])
+    result['repr'] = sum(len(str(p)) for p in posts) / count
+    compressed = igsync.InstagramDb(db.path, post_codec='zlib')
+    compressed.convert_posts()
+    result['zlib'] = db.cursor.execute(size).fetchone()[0]
+    compressed.train_post_dictionary()
+    result['convert_seconds'] = timed(compressed.convert_posts)
+    result['zlib_dictionary'] = db.cursor.execute(size).fetchone()[0]
+    return result
+
+
+class ThumbnailCdnHandler(KeepAliveCdnHandler):
+    """A keep-alive CDN stand-in serving thumbnail-sized (32 kB) files."""
+
+    disable_nagle_algorithm = True  # like a real CDN; avoids 40ms stalls
+
+    def body(self):
+        return KeepAliveCdnHandler.body(self)[:1 << 15]
+
+
+@contextmanager
+def local_https_cdn():
+    """Run a local HTTPS stand-in for the Instagram CDN with a throwaway
+    self-signed certificate (made with ``openssl``). Yields its base URL and
+    an ``ssl.SSLContext`` that trusts it."""
+    with TemporaryDirectory() as tmpdir:
+        cert = os.path.join(tmpdir, 'cert.pem')
+        key = os.path.join(tmpdir, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                        '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost',
+                        '-keyout', key, '-out', cert],
+                       check=True, capture_output=True)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=cert)
+        server = ThreadingHTTPServer(('localhost', 0), ThumbnailCdnHandler)
+        server.socket = server_context.wrap_socket(server.socket,
+                                                   server_side=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield "https://localhost:{}".format(server.server_port), \
+                client_context
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def bench_download_pool(count=500, workers=4):
+    """Compare downloading ``count`` thumbnail-sized files from a local HTTPS
+    CDN stand-in with ``workers`` workers over fresh connections (a pool
+    that keeps no idle connections) and over pooled keep-alive
+    connections."""
+    result = dict()
+    with local_https_cdn() as (cdn, context):
+        for name, size in (('fresh', 0), ('pooled', workers)):
+            db = igsync.InstagramDb(
+                new_db().path, throttle=igsync.Throttle(api=None, cdn=None))
+            db.save_posts(json.loads(json.dumps(post).replace(CDN_HOST, cdn))
+                          for post in synthetic_posts(count))
+            pending = db.get_undownloaded_urls()
+            pool = igsync.pool.ConnectionPool(size, context=context)
+            with TemporaryDirectory() as media_root:
+                downloader = igsync.Downloader(db, media_root,
+                                               workers=workers, pool=pool)
+                del KeepAliveCdnHandler.connections[:]
+                elapsed = timed(downloader.download, pending)
+            pool.close()
+            result[name + '_ms_per_file'] = 1000*elapsed*workers/len(pending)
+            result[name + '_connections'] = len(
+                KeepAliveCdnHandler.connections)
+    result['speedup'] = (result['fresh_ms_per_file'] /
+                         result['pooled_ms_per_file'])
+    return result
+
+
+def bench_import(count=20):
+    """Compare the time it takes to import igsync in a fresh interpreter
+    with the time it takes to also load everything it imports lazily (the
+    downloader, pipeline, ``asyncio`` facade and API client), taking the
+    median of ``count`` runs."""
+    result = dict()
+    statements = dict(
+        lazy="import igsync",
+        eager=("import igsync, igsync.aio, igsync.accounts, "
+               "instagram_private_api"),
+    )
+    for name, statement in statements.items():
+        times = sorted(float(subprocess.check_output([sys.executable, '-c', (
+            "import time; start = time.perf_counter(); {}; "
+            "print(time.perf_counter() - start)"
+        ).format(statement)])) for _ in range(count))
+        result[name + '_ms'] = 1000*times[len(times)//2]
+    result['speedup'] = result['eager_ms'] / result['lazy_ms']
+    return result
+
+
+def bench_decoders(count=2000):
+    """Compare parsing ``count`` posts' raw JSON (mostly large carousels,
+    like the ``.JSON`` dump directory) with each installed JSON decoder, and
+    saving them with ``save_posts`` using the stdlib decoder and the default
+    (fastest installed) one."""
+    templates = synthetic_posts(count)
+    for post in templates[::3]:
+        post['media']['carousel_media'] *= 4
+    texts = [json.dumps(p) for p in templates]
+    result = dict()
+    for name in igsync.codec.DECODERS:
+        try:
+            loads = igsync.codec.get_decoder(name).loads
+        except ValueError:
+            continue
+        result[name + '_parse'] = timed(lambda: all(map(loads, texts)))
+    default = igsync.codec.get_decoder()
+    for name in {'json', default.name}:
+        db = igsync.InstagramDb(new_db().path, decoder=name)
+        result[name + '_save_posts'] = timed(db.save_posts, texts)
+    result['speedup'] = result['json_parse'] / result[default.name + '_parse']
+    return result
+
+
+def bench_import_json(count=5000, workers=4):
+    """Compare importing a JSON dump directory of ``count`` posts with
+    ``save_post`` one file at a time against a `JsonImporter` with
+    ``workers`` processes."""
+    result = dict()
+    with TemporaryDirectory() as dump:
+        names = []
+        for post in synthetic_posts(count):
+            names.append(os.path.join(dump, post['media']['code'] + '.json'))
+            with open(names[-1], 'w') as outfile:
+                json.dump(post, outfile)
+
+        def save_each(db):
+            for name in names:
+                with open(name) as infile:
+                    db.save_post(infile.read())
+        result['save_post'] = timed(save_each, new_db())
+        importer = igsync.JsonImporter(new_db(), dump, workers=workers)
+        result['import_json'] = timed(importer.run)
+    result['speedup'] = result['save_post'] / result['import_json']
+    return result
+
+
+BENCHMARKS = {
+    'save_posts': bench_save_posts,
+    'migrate': bench_migrate,
+    'post_codecs': bench_post_codecs,
+    'download_pool': bench_download_pool,
+    'import': bench_import,
+    'decoders': bench_decoders,
+    'import_json': bench_import_json,
+}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", default=sorted(BENCHMARKS),
+                        help="Which benchmarks to run (default: all).")
+    parser.add_argument("-n", "--count", type=int, help="""
+        Number of synthetic items to use in each benchmark (default: a
+        benchmark-specific size).""")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if args.count is None:
+            result = BENCHMARKS[name]()
+        else:
+            result = BENCHMARKS[name](args.count)
+        print("{}: {}".format(name, ", ".join(
+            "{}={:.4g}".format(k, v) for k, v in result.items()
+        )))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
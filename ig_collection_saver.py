@@ -2,17 +2,21 @@
 # (c) Stefan Countryman, 2018
 
 """
-A thin wrapper around saveImages.php. Get images from instagram collections and
-save them to an output directory.
+Get images from instagram collections and save them to an output directory.
+Crawls collections, saves posts and downloads media in-process with `igsync`;
+the original saveImages.php implementation is still available with `--php`.
 """
 
 import sys
 import os
+import logging
 from netrc import netrc
 from argparse import ArgumentParser
 from numbers import Integral
 from collections import namedtuple
 from subprocess import Popen, PIPE
+from urllib.parse import quote_plus
+import igsync
 
 DESC = """Download images saved in your Instagram collections and save them to
 files on disk. Put authentication info under an "instagram.com" entry in
@@ -21,6 +25,7 @@ execution."""
 DEFAULT_COLLECTIONS_DIR = os.path.join(os.path.expanduser("~"), "Pictures",
                                        "InstagramCollections")
 DEFAULT_COLLECTIONS = ()  # if none are specified, try syncing all
+MEDIA_DIR = ".ORIGINAL_MEDIA"  # where each file is stored once
 SCRIPTDIR = os.path.realpath(os.path.dirname(__file__))
 
 if __name__ == "__main__":
@@ -35,11 +40,26 @@ if __name__ == "__main__":
         of the collection. If no collections are specified (DEFAULT), try to
         sync all collections.""")
     ARG("-v", "--verbose", action="count", default=0, help="""
-        Verbosity level, i.e. whether to provide debug output from the
-        Instagram PHP client. More `v`s means more verbosity. No `-v` indicates
-        no debug info (default); `-v` provides status messages to indicate
-        progress; `-vv` provides truncated debug info; and `-vvv` provides full
+        Verbosity level, i.e. whether to provide debug output. More `v`s means
+        more verbosity. No `-v` indicates no debug info (default); `-v`
+        provides status messages to indicate progress; `-vv` provides
+        (truncated, for the PHP client) debug info; and `-vvv` provides full
         debug info.""")
+    ARG("--db", default=igsync.DEFAULT_DB_PATH, help="""
+        The SQLite database that posts are saved to. (default:
+        %(default)s)""")
+    ARG("--full", action="store_true", help="""
+        Page through every post in each collection instead of stopping at the
+        posts saved by the last sync.""")
+    ARG("-j", "--jobs", type=int, default=8, help="""
+        Number of media files to download concurrently. (default:
+        %(default)s)""")
+    ARG("--crawl-jobs", type=int, default=4, help="""
+        Number of collections to crawl concurrently. (default:
+        %(default)s)""")
+    ARG("--php", action="store_true", help="""
+        Use the original saveImages.php implementation (requires PHP and
+        mgp25/instagram-php) instead of igsync.""")
     ARGS = PARSER.parse_args()
 
 
@@ -93,8 +113,51 @@ def verbosity_args(verbosity):
 
 
 def sync(collections=DEFAULT_COLLECTIONS,
-         collections_dir=DEFAULT_COLLECTIONS_DIR, debug=False,
-         truncated_debug=True, logfile=PIPE, synchronous=False):
+         collections_dir=DEFAULT_COLLECTIONS_DIR,
+         db_path=igsync.DEFAULT_DB_PATH, full=False, jobs=8, crawl_jobs=4):
+    """Sync the specified `collections` (by name; all collections if none are
+    specified) to the `collections_dir`. Collection feeds are crawled
+    `crawl_jobs` at a time, their posts saved to the igsync database at
+    `db_path` (by a single writer thread), and their media
+    downloaded `jobs` files at a time into `collections_dir`'s
+    `.ORIGINAL_MEDIA` directory and hardlinked into a directory for each
+    collection, all concurrently with an `igsync.Pipeline`. Media files are
+    laid out and named like saveImages.php does, so files it already
+    downloaded are reused. Only posts added
+    since the last sync are fetched unless `full=True`. Returns a dict mapping
+    collection names to the number of new posts saved."""
+    username, password = get_auth()
+    db = igsync.InstagramDb(db_path, username, password, profile='safe')
+    db.inittables()
+    names = db.sync_collection_list()
+    if collections:
+        missing = set(collections).difference(names.values())
+        if missing:
+            logging.warning("Collections not found on Instagram: %s",
+                            ", ".join(sorted(missing)))
+        names = {pk: n for pk, n in names.items() if n in collections}
+    media_root = os.path.join(collections_dir, MEDIA_DIR)
+    dirs = {pk: os.path.join(collections_dir, quote_plus(name))
+            for pk, name in names.items()}
+    # finish downloads left over from interrupted syncs first, refreshing
+    # any media URLs that have expired since
+    with igsync.Downloader(db, media_root, workers=jobs, refresh=True,
+                           flat=True) as downloader:
+        downloader.download()
+    with igsync.Pipeline(db, media_root, crawl_workers=crawl_jobs,
+                         download_workers=jobs, full=full,
+                         collection_dirs=dirs, report_interval=60,
+                         flat=True) as pipeline:
+        pipeline.run(list(names))
+        pipeline.report()
+    for collection_pk, dest in dirs.items():
+        igsync.materialize_collection(db, media_root, collection_pk, dest)
+    return {name: pipeline.saved[pk] for pk, name in names.items()}
+
+
+def sync_php(collections=DEFAULT_COLLECTIONS,
+             collections_dir=DEFAULT_COLLECTIONS_DIR, debug=False,
+             truncated_debug=True, logfile=PIPE, synchronous=False):
     """Try syncing the specified `collections` to the `collections_dir` with
     the specified amount of debug information. Returns the `subprocess.Popen`
     object for the sync process (which is implemented in PHP). If `logfile` is
@@ -121,16 +184,28 @@ def sync(collections=DEFAULT_COLLECTIONS,
 
 def main():
     """Run with the command line options."""
-    debug, truncated_debug, logfile = verbosity_args(ARGS.verbose)
-    proc = sync(
+    if ARGS.php:
+        debug, truncated_debug, logfile = verbosity_args(ARGS.verbose)
+        proc = sync_php(
+            collections=ARGS.collections,
+            collections_dir=ARGS.collections_dir,
+            debug=debug,
+            truncated_debug=truncated_debug,
+            logfile=logfile,
+            synchronous=True
+        )
+        return proc.returncode
+    logging.basicConfig(level=[logging.WARNING, logging.INFO,
+                               logging.DEBUG][min(ARGS.verbose, 2)])
+    sync(
         collections=ARGS.collections,
         collections_dir=ARGS.collections_dir,
-        debug=debug,
-        truncated_debug=truncated_debug,
-        logfile=logfile,
-        synchronous=True
+        db_path=ARGS.db,
+        full=ARGS.full,
+        jobs=ARGS.jobs,
+        crawl_jobs=ARGS.crawl_jobs
     )
-    return proc.returncode
+    return 0
 
 
 if __name__ == "__main__":
@@ -7,23 +7,61 @@ download the associated media.
 """
 
 import os
+import time
+import random
 import sqlite3
-import json
 import logging
-import pickle
 from pathlib import Path
 from netrc import netrc
+from itertools import groupby
+from operator import itemgetter
 from collections import namedtuple
-from http.cookiejar import CookieJar
 from textwrap import dedent
 from urllib.parse import urlparse
-from instagram_private_api import Client
-from instagram_private_api.errors import ClientConnectionError
+from .store import Blob, BlobStore, materialize_collection
+from .ratelimit import RateLimiter, Throttle
+from .media import LinkPolicy, ORIGINAL, PREVIEW, media_links, iter_links
+from . import (migrations, codec, crawler, ratelimit, retry, expiry,
+               session, query)
 
 LOCAL_STORAGE = Path("~", ".local", "share", "igsync").expanduser()
-LOCAL_STORAGE.mkdir(parents=True, exist_ok=True)
-COOKIE_JAR = LOCAL_STORAGE / "cookie.jar"
+SESSION_DIR = LOCAL_STORAGE / "sessions"
 DEFAULT_DB_PATH = LOCAL_STORAGE / "insta.sqlite"
+DEFAULT_MEDIA_ROOT = LOCAL_STORAGE / "media"
+MAX_PARAMS = 500  # max number of SQL parameters to bind in one IN (...)
+COLLECTION_NAMES_TTL = 60*60  # seconds to reuse the fetched collection list
+# names imported from submodules on first access (see ``__getattr__``) so
+# that importing igsync to query a database doesn't pay for the downloader,
+# ``asyncio`` and friends
+LAZY_ATTRIBUTES = dict(
+    Downloader='download',
+    Pipeline='pipeline',
+    AsyncInstagramDb='aio',
+    Account='accounts',
+    Orchestrator='accounts',
+    JsonImporter='importer',
+)
+LAZY_MODULES = frozenset(('download', 'pipeline', 'aio', 'accounts', 'pool',
+                          'importer'))
+
+
+def __getattr__(name):
+    """Import the lazily loaded ``LAZY_ATTRIBUTES`` and ``LAZY_MODULES`` on
+    first access."""
+    import importlib
+    if name in LAZY_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name in LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(
+            '.' + LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES) | LAZY_MODULES)
 
 
 def dedent_sql(command):
@@ -32,16 +70,22 @@ def dedent_sql(command):
     return dedent('\n'.join([l for l in lines if not set(l).issubset({' '})]))
 
 
-def get_media_links(media):
-    """Extract the highest-quality media URLs (and media dimensions) from the
-    ``media`` item in the JSON object returned by the Instagram API.
+def get_media_links(media, policy=ORIGINAL):
+    """Extract the media URLs (and media dimensions) from the ``media`` item
+    in the JSON object returned by the Instagram API, choosing among the
+    renditions of each image or video by ``policy`` (by default, the
+    largest). See `media.media_links`, which returns compact ``Link`` tuples
+    instead.
 
     Arguments
     =========
-    media : `string`, `dict`
+    media : `string`, `bytes`, `dict`
         The only object contained in the ``post`` object returned by
-        Instagram's posts API. can either be a JSON string or a dictionary (as
-        parsed by ``json.loads``).
+        Instagram's posts API. can either be JSON or a dictionary (as parsed
+        by the default `codec.get_decoder`).
+    policy : `media.LinkPolicy`, optional
+        which rendition of each image or video to pick, e.g.
+        `media.PREVIEW` for small cover images.
 
     Returns
     =======
@@ -50,19 +94,91 @@ def get_media_links(media):
         ``media_type``, and ``url`` of each image in this post.
     """
     if not isinstance(media, dict):
-        media = json.loads(media)
-    if media['media_type'] == 8:
-        return [get_media_links(m)[0] for m in media['carousel_media']]
-    if media['media_type'] == 1:
-        result = media['image_versions2']['candidates'][0]
-    elif media['media_type'] == 2:
-        result = media['video_versions'][0]
-    else:
-        raise ValueError("Unrecognized media_type: " +
-                         str(media['media_type']))
-    result = {k: result[k] for k in ('height', 'width', 'url')}
-    result['media_type'] = media['media_type']
-    return [result]
+        media = codec.get_decoder().loads(media)
+    return [link._asdict() for link in media_links(media, policy)]
+
+
+def storable_text(value):
+    """Get ``value`` as a ``str`` that SQLite can store. Lone UTF-16
+    surrogates (which the API sends when it cuts an emoji in half) can't be
+    encoded as UTF-8, so they are replaced with U+FFFD."""
+    value = str(value)
+    try:
+        value.encode()
+    except UnicodeEncodeError:
+        value = value.encode('utf-16', 'surrogatepass').decode('utf-16',
+                                                               'replace')
+    return value
+
+
+def user_row(user):
+    """Get the ``users`` table row for a ``user`` dict from the API."""
+    return (
+        str(user['pk']),
+        str(user['username']),
+        storable_text(user['full_name']),
+        int(user['is_private']),
+        str(user['profile_pic_url'])
+    )
+
+
+def url_rows(post, policy=ORIGINAL):
+    """Get the ``post_urls`` table rows for a ``post`` dict from the API."""
+    return [(pk, link.url, i, link.media_type, link.height, link.width)
+            for pk, i, link in iter_links((post['media'],), policy)]
+
+
+def post_row(post, post_json):
+    """Get the ``posts`` table row for a ``post`` dict from the API, with
+    ``post_json`` as the encoded post (see `InstagramDb.encode_post`)."""
+    media = post['media']
+    return (
+        str(media['pk']),
+        str(media['code']),
+        int(media['taken_at']),
+        int(media['media_type']),
+        int(media['comment_likes_enabled']),
+        int(media['comment_threading_enabled']),
+        int(media['has_more_comments']),
+        str(media['user']['pk']),
+        int(media['photo_of_you']),
+        storable_text(media['caption']['text']),
+        post_json,
+        int(media['like_count']),
+        int(media['has_viewer_saved']),
+    )
+
+
+PostRows = namedtuple('PostRows', ('user', 'collections', 'urls', 'post',
+                                   'relations'))
+
+
+def post_rows(post, post_json):
+    """Get the ``PostRows`` that saving a ``post`` dict from the API writes
+    to each table, with ``post_json`` as the encoded post. This only depends
+    on the post itself, so it can be done in another process (see
+    `importer`) and the rows saved with `InstagramDb.save_post_rows`."""
+    media = post['media']
+    pk = str(media['pk'])
+    collection_pks = [str(k) for k in media['saved_collection_ids']]
+    return PostRows(
+        user_row(media['user']),
+        collection_pks,
+        url_rows(post),
+        post_row(post, post_json),
+        [(pk, k, int(media['taken_at'])) for k in collection_pks],
+    )
+
+
+class BulkRows(object):
+    """Rows gathered by `InstagramDb.save_post_rows`, grouped by table."""
+
+    def __init__(self):
+        self.users = []
+        self.collections = []
+        self.urls = []
+        self.posts = dict()
+        self.relations = dict()
 
 
 class InstagramDb(object):
@@ -70,8 +186,35 @@ class InstagramDb(object):
     collections are stored as well as an interface to the Instagram private
     API."""
 
+    PROFILES = {
+        # durable writes, but let readers run alongside the writer
+        'safe': (
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'FULL'),
+            ('temp_store', 'DEFAULT'),
+        ),
+        # fast ingest; a power loss may lose the last few commits but can't
+        # corrupt the database
+        'bulk': (
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -262144),
+            ('mmap_size', 268435456),
+            ('temp_store', 'MEMORY'),
+        ),
+        # reporting queries alongside a writer; connection opened read-only
+        'readonly': (
+            ('query_only', 'ON'),
+            ('cache_size', -65536),
+            ('mmap_size', 268435456),
+            ('temp_store', 'MEMORY'),
+        ),
+    }
+
     def __init__(self, path=DEFAULT_DB_PATH, username=None, password=None,
-                 netrc_path=Path("~", ".netrc").expanduser()):
+                 netrc_path=Path("~", ".netrc").expanduser(), profile=None,
+                 pragmas=None, post_codec='json', throttle=None,
+                 sessions=SESSION_DIR, shared=False, decoder=None):
         """
         Arguments
         =========
@@ -93,12 +236,75 @@ class InstagramDb(object):
             path to the .netrc file from which the Instagram username and
             password will be parsed (if not explicitly provided through init
             arguments).
+        profile : `string`, optional
+            a performance profile from ``PROFILES`` to apply to the database
+            connection: ``"safe"`` (WAL journal, fully synchronous commits),
+            ``"bulk"`` (WAL journal, ``synchronous=NORMAL``, large page cache
+            and memory map; fastest for ingest) or ``"readonly"`` (opens the
+            database read-only for reporting alongside a writer). In WAL mode
+            readers don't block the writer or vice versa. If not provided,
+            SQLite's defaults are used.
+        pragmas : `dict`, optional
+            ``PRAGMA`` settings to apply on top of (and overriding) those of
+            ``profile``, e.g. ``{'cache_size': -1048576}``.
+        post_codec : `string`, optional
+            how to store the raw API payload of newly saved posts in
+            ``posts.post_json``: ``"json"`` (default) for JSON text that can be
+            queried with SQLite's JSON functions, or ``"zlib"`` or ``"zstd"``
+            (requires the ``zstandard`` package) for a compressed BLOB, using
+            the latest dictionary trained with ``train_post_dictionary`` (if
+            any). Posts are decoded transparently by ``get_post`` whatever
+            they were stored with.
+        throttle : `ratelimit.Throttle`, optional
+            the rate limiters that every call made with ``client`` (and, by
+            default, every media download) goes through. Share one between
+            databases to share their budgets. Defaults to a new ``Throttle``
+            with the default API and CDN budgets.
+        sessions : `string`, optional
+            the directory to cache logged in sessions in, one file per
+            username (see `session.SessionCache`), so that we only log in
+            again when the cached session stops working.
+        shared : `bool`, optional
+            set if several accounts sync into this database. A post's
+            ``saved_collection_ids`` only lists the collections of the account
+            that fetched it, so saving a post then adds to its collections
+            instead of replacing them.
+        decoder : `string`, optional
+            which JSON parser to parse posts and users given as JSON text
+            with, from `codec.DECODERS`: ``"orjson"`` or ``"simdjson"``
+            (if installed) or the stdlib ``"json"``. Defaults to the
+            ``IGSYNC_JSON_DECODER`` environment variable, or else the fastest
+            one installed (see `codec.get_decoder`).
         """
         self.username = None  # will get overwritten when/if we log in
         self.path = Path(path).resolve()
-        self.connection = sqlite3.connect(self.path)
+        if profile is not None and profile not in self.PROFILES:
+            raise ValueError("Unrecognized profile: {}. Choose from: "
+                             "{}".format(profile, ", ".join(self.PROFILES)))
+        if post_codec not in codec.CODECS:
+            raise ValueError("Unrecognized post_codec: {}. Choose from: "
+                             "{}".format(post_codec, ", ".join(codec.CODECS)))
+        self.post_codec = post_codec
+        self.decoder = codec.get_decoder(decoder)
+        self.throttle = throttle or ratelimit.Throttle()
+        self._dictionaries = dict()
+        self._post_dictionaries = dict()
+        self.profile = profile
+        self.pragmas = dict(self.PROFILES.get(profile, ()))
+        self.pragmas.update(pragmas or {})
+        if profile == 'readonly':
+            self.connection = sqlite3.connect(self.path.as_uri() + '?mode=ro',
+                                              uri=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(self.path)
         self.cursor = self.connection.cursor()
+        for name, value in self.pragmas.items():
+            self.cursor.execute('PRAGMA {} = {}'.format(name, value))
         self.netrc_path = Path(netrc_path).resolve()
+        self.sessions = session.SessionCache(sessions)
+        self.shared = shared
+        self._collection_names = None  # (fetched at, names)
         # if username and password were explicitly provided, initialize a
         # connection to instagram.com immediately. otherwise, this connection
         # will be generated as needed.
@@ -109,29 +315,17 @@ class InstagramDb(object):
                              "neither.")
 
     def login(self, username, password):
-        """Try to form a new connection to Instagram using the given username
-        and password."""
-        # try to load cookies from cookie jar
-        client_kwargs = dict()
-        if os.path.isfile(COOKIE_JAR):
-            cookies = CookieJar()
-            with open(COOKIE_JAR, 'rb') as cookiejar:
-                cookie_string = cookiejar.read()
-            # make sure username in cookies is as expected; otherwise,
-            # don't use cookies
-            try:
-                cookies._cookies = pickle.loads(cookie_string)
-                cookie_user = [c.value for c in cookies
-                               if c.name == 'ds_user']
-                if cookie_user == username:
-                    client_kwargs['cookie'] = cookie_string
-            except:
-                logging.warn("Could not parse cookie file.")
-        self.client = Client(username, password, **client_kwargs)
+        """Set up a connection to Instagram using the given username and
+        password. The session cached in ``sessions`` for ``username`` is
+        reused if there is one; it is only checked by the first request, and
+        we only log in from scratch if it turns out to be invalid."""
+        self.client = session.Session(username, password, self.sessions)
         self.username = username
 
     @property
     def client(self):
+        """The Instagram API client, logging in on first use. Calls made
+        with it are rate limited by ``throttle.api``."""
         if not hasattr(self, "_client"):
             # get user info from .netrc
             try:
@@ -140,17 +334,13 @@ class InstagramDb(object):
             except:
                 raise ValueError("Can't find usable .netrc authentication "
                                  f"info in given .netrc: {self.netrc_path}")
-        return self._client
+        return ratelimit.ThrottledClient(self._client, self.throttle.api)
 
     @client.setter
     def client(self, value):
-        """Set the value of the client and cache the authentication cookies in
-        ~/.local/share/igsync/cookie.jar for later use."""
-        if not os.path.isdir(LOCAL_STORAGE):
-            os.makedirs(LOCAL_STORAGE)
+        """Set the (unthrottled) Instagram API client, e.g. a
+        `session.Session`."""
         self._client = value
-        with open(COOKIE_JAR, 'wb') as cookiejar:
-            cookiejar.write(self.client.cookie_jar.dump())
 
     TABLE_DEFINITIONS = namedtuple(
         'namespace',
@@ -160,6 +350,10 @@ class InstagramDb(object):
             'POSTS',
             'COLLECTION_RELATIONS',
             'POST_URLS',
+            'POST_DICTIONARIES',
+            'MEDIA_BLOBS',
+            'COLLECTION_SYNC_STATE',
+            'JSON_IMPORTS',
         ),
     )(
         USERS=dedent_sql("""
@@ -186,7 +380,7 @@ class InstagramDb(object):
                 comment_likes_enabled       integer NOT NULL,
                 comment_threading_enabled   integer NOT NULL,
                 has_more_comments           integer NOT NULL,
-                user_pk                     integer NOT NULL,
+                user_pk                     text    NOT NULL,
                 photo_of_you                integer NOT NULL,
                 caption_text                text    NOT NULL,
                 post_json                   text    NOT NULL,
@@ -200,6 +394,7 @@ class InstagramDb(object):
             CREATE TABLE IF NOT EXISTS collection_relations (
                 post_pk                     text NOT NULL,
                 collection_pk               text NOT NULL,
+                taken_at                    integer,
                 PRIMARY KEY (post_pk, collection_pk),
                 FOREIGN KEY (post_pk) REFERENCES posts (pk)
                     ON DELETE CASCADE ON UPDATE NO ACTION,
@@ -216,41 +411,148 @@ class InstagramDb(object):
                 height                      integer NOT NULL,
                 width                       integer NOT NULL,
                 download_path               text,
+                blob_hash                   text,
+                attempts                    integer NOT NULL DEFAULT 0,
+                last_error                  text,
+                next_attempt_at             integer,
                 PRIMARY KEY (post_pk, url),
                 FOREIGN KEY (post_pk) REFERENCES posts (pk)
                     ON DELETE CASCADE ON UPDATE NO ACTION
             );
         """),
+        POST_DICTIONARIES=dedent_sql("""
+            CREATE TABLE IF NOT EXISTS post_dictionaries (
+                id                          integer PRIMARY KEY,
+                codec                       text    NOT NULL,
+                data                        blob    NOT NULL
+            );
+        """),
+        MEDIA_BLOBS=dedent_sql("""
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                hash                        text    PRIMARY KEY,
+                size                        integer NOT NULL,
+                etag                        text,
+                refcount                    integer NOT NULL DEFAULT 0
+            );
+        """),
+        COLLECTION_SYNC_STATE=dedent_sql("""
+            CREATE TABLE IF NOT EXISTS collection_sync_state (
+                collection_pk               text    PRIMARY KEY,
+                newest_post_pk              text    NOT NULL,
+                newest_taken_at             integer NOT NULL,
+                last_synced                 integer NOT NULL,
+                FOREIGN KEY (collection_pk) REFERENCES collections (pk)
+                    ON DELETE CASCADE ON UPDATE NO ACTION
+            );
+        """),
+        JSON_IMPORTS=dedent_sql("""
+            CREATE TABLE IF NOT EXISTS json_imports (
+                directory                   text    NOT NULL,
+                name                        text    NOT NULL,
+                post_pk                     text    NOT NULL,
+                imported                    integer NOT NULL,
+                PRIMARY KEY (directory, name)
+            );
+        """),
+    )
+
+    INDEX_DEFINITIONS = namedtuple(
+        'namespace',
+        (
+            'POST_URLS_PENDING',
+            'COLLECTION_RELATIONS_COLLECTION',
+            'POSTS_USER',
+            'POSTS_TAKEN_AT',
+            'POST_URLS_BLOB',
+            'MEDIA_BLOBS_ETAG',
+            'COLLECTION_RELATIONS_KEYSET',
+        ),
+    )(
+        # only rows still waiting to be downloaded, so that polling for work
+        # doesn't touch the (much larger) set of finished downloads
+        POST_URLS_PENDING=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS post_urls_pending
+                ON post_urls (post_pk) WHERE download_path IS NULL;
+        """),
+        COLLECTION_RELATIONS_COLLECTION=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS collection_relations_collection
+                ON collection_relations (collection_pk, post_pk);
+        """),
+        # (taken_at, pk) is the keyset that posts are paged through by (see
+        # `query`), so that each page is a range scan of one of these
+        POSTS_USER=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS posts_user
+                ON posts (user_pk, taken_at, pk);
+        """),
+        POSTS_TAKEN_AT=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at, pk);
+        """),
+        POST_URLS_BLOB=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS post_urls_blob
+                ON post_urls (blob_hash) WHERE blob_hash IS NOT NULL;
+        """),
+        MEDIA_BLOBS_ETAG=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS media_blobs_etag
+                ON media_blobs (etag) WHERE etag IS NOT NULL;
+        """),
+        COLLECTION_RELATIONS_KEYSET=dedent_sql("""
+            CREATE INDEX IF NOT EXISTS collection_relations_keyset
+                ON collection_relations (collection_pk, taken_at, post_pk);
+        """),
     )
 
     def inittables(self, commit=True):
-        """Initialize tables in the instagram database if they don't already
-        exist. If ``commit`` is ``True`` (default), commit the changes
-        immediately. Returns ``self`` to allow for chained commands."""
+        """Initialize tables and indexes in the instagram database if they
+        don't already exist. New databases are stamped with the latest schema
+        version; existing ones are brought up to date with ``migrate``. If
+        ``commit`` is ``True`` (default), commit the changes immediately.
+        Returns ``self`` to allow for chained commands."""
+        fresh = not migrations.table_exists(self.cursor, 'posts')
         for command in self.TABLE_DEFINITIONS:
             self.cursor.execute(command)
+        if fresh:
+            migrations.set_version(self.cursor, migrations.latest_version())
+        else:
+            self.migrate()
+        for command in self.INDEX_DEFINITIONS:
+            self.cursor.execute(command)
         if commit:
             self.connection.commit()
         return self
 
+    @property
+    def schema_version(self):
+        """The schema version of this database (its ``user_version``)."""
+        return migrations.get_version(self.cursor)
+
+    def migrate(self, batch_size=migrations.DEFAULT_BATCH_SIZE):
+        """Apply any pending schema migrations to this database in place. Large
+        tables are copied ``batch_size`` rows per transaction. Returns
+        ``self`` to allow for chained commands."""
+        migrations.migrate(self, batch_size)
+        return self
+
+    def parse(self, value):
+        """Parse a post or user given as raw JSON (``str`` or ``bytes``)
+        returned from the API with this database's ``decoder``. Dicts are
+        returned as they are, so each ``save_*`` method parses its input
+        through here and passes the parsed dict on: a post is parsed once,
+        however many tables it is saved to."""
+        if isinstance(value, dict):
+            return value
+        return self.decoder.loads(value)
+
     def save_user(self, user, overwrite=True, commit=True):
         """Save an instagram user (either a dict or raw JSON returned from the
         API) to this database. If ``overwrite`` is ``True`` (default), replaces
         existing records with the given value; otherwise, existing records are
         left alone. Returns ``self`` to allow for chained commands."""
-        if not isinstance(user, dict):
-            user = json.loads(user)
+        user = self.parse(user)
         self.cursor.execute(
             'INSERT OR {} INTO users VALUES (?, ?, ?, ?, ?)'.format(
                 'REPLACE' if overwrite else 'IGNORE'
             ),
-            (
-                str(user['pk']),
-                str(user['username']),
-                str(user['full_name']),
-                int(user['is_private']),
-                str(user['profile_pic_url'])
-            )
+            user_row(user)
         )
         if commit:
             self.connection.commit()
@@ -279,19 +581,11 @@ class InstagramDb(object):
         """Save an instagram post's media URLs to this database's ``post_urls``
         table. ``post`` can be a JSON string or a dict. Returns ``self`` to
         allow for chained commands."""
-        if not isinstance(post, dict):
-            post = json.loads(post)
-        links = [(
-            post['media']['pk'],
-            link['url'],
-            i,
-            link['media_type'],
-            link['height'],
-            link['width']
-        ) for i, link in enumerate(get_media_links(post['media']))]
+        post = self.parse(post)
         self.cursor.executemany(
-            'INSERT OR IGNORE INTO post_urls VALUES (?, ?, ?, ?, ?, ?, NULL)',
-            links
+            'INSERT OR IGNORE INTO post_urls (post_pk, url, ind, media_type, '
+            'height, width) VALUES (?, ?, ?, ?, ?, ?)',
+            url_rows(post)
         )
         if commit:
             self.connection.commit()
@@ -301,8 +595,7 @@ class InstagramDb(object):
         """Save an instagram post (as raw JSON returned from the API or as a
         dict parsed from said JSON) to this database. Returns ``self`` to allow
         for chained commands."""
-        if not isinstance(post, dict):
-            post = json.loads(post)
+        post = self.parse(post)
         media = post['media']
         # make sure the user and collection are in their respective tables
         self.save_user(media['user'], overwrite=False, commit=False)
@@ -312,35 +605,207 @@ class InstagramDb(object):
         # save the post
         self.cursor.execute(
             'INSERT OR REPLACE INTO posts VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
-            (
-                str(media['pk']),
-                str(media['code']),
-                int(media['taken_at']),
-                int(media['media_type']),
-                int(media['comment_likes_enabled']),
-                int(media['comment_threading_enabled']),
-                int(media['has_more_comments']),
-                int(media['user']['pk']),
-                int(media['photo_of_you']),
-                str(media['caption']['text']),
-                str(post),
-                int(media['like_count']),
-                int(media['has_viewer_saved']),
-            )
+            post_row(post, self.encode_post(post))
         )
         # save the collections that this post belongs to
-        self.cursor.execute(
-            'DELETE FROM collection_relations WHERE post_pk=?',
-            (media['pk'],)
-        )
+        if not self.shared:
+            self.cursor.execute(
+                'DELETE FROM collection_relations WHERE post_pk=?',
+                (media['pk'],)
+            )
         self.cursor.executemany(
-            'INSERT INTO collection_relations VALUES (?, ?)',
-            [(str(media['pk']), str(k)) for k in media['saved_collection_ids']]
+            'INSERT OR IGNORE INTO collection_relations VALUES (?, ?, ?)',
+            [(str(media['pk']), str(k), int(media['taken_at']))
+             for k in media['saved_collection_ids']]
+        )
+        if commit:
+            self.connection.commit()
+        return self
+
+    def save_posts(self, posts, batch_size=1000, commit=True):
+        """Save many instagram posts (each as raw JSON or a dict, as for
+        ``save_post``) to this database. ``posts`` can be any iterable,
+        including a generator yielding feed items as they are fetched.
+
+        Rows are grouped by table and written with one ``executemany`` per
+        table for every ``batch_size`` posts. Users and collections are only
+        inserted the first time they are seen in ``posts``, and if a post
+        appears more than once, the last copy wins. Everything is written in a
+        single transaction, which is committed at the end if ``commit`` is
+        ``True`` (default). If any post fails to save, none of them are
+        saved: with ``commit``, the transaction is rolled back; otherwise
+        only the rows written by this call are, and the rest of the
+        caller's transaction is left alone. Returns ``self`` to allow for
+        chained commands."""
+        return self.save_post_rows(
+            (post_rows(post, self.encode_post(post))
+             for post in map(self.parse, posts)),
+            batch_size, commit
         )
+
+    def save_post_rows(self, rows, batch_size=1000, commit=True):
+        """Save many posts given as ``PostRows`` (see `post_rows`), e.g.
+        gathered by other processes, in batches as for ``save_posts``. The
+        posts' ``post_json`` must have been encoded for this database (see
+        ``encode_post``). Returns ``self`` to allow for chained commands."""
+        seen_users = set()
+        seen_collections = set()
+        batch = BulkRows()
+        # a savepoint, so that a failure only undoes this call's rows. It's
+        # opened just before the first write rather than up front: reading
+        # ``rows`` may query the database, and in a transaction that reads
+        # before it writes, SQLite can't wait for another connection's
+        # write lock
+        savepoint = False
+        try:
+            for row in rows:
+                if row.user[0] not in seen_users:
+                    seen_users.add(row.user[0])
+                    batch.users.append(row.user)
+                for collection_pk in row.collections:
+                    if collection_pk not in seen_collections:
+                        seen_collections.add(collection_pk)
+                        batch.collections.append((collection_pk,))
+                batch.urls.extend(row.urls)
+                batch.posts[row.post[0]] = row.post
+                batch.relations[row.post[0]] = row.relations
+                if len(batch.posts) >= batch_size:
+                    savepoint = savepoint or self._savepoint()
+                    self._write_bulk_rows(batch)
+                    batch = BulkRows()
+            savepoint = savepoint or self._savepoint()
+            self._write_bulk_rows(batch)
+        except BaseException:
+            if commit:
+                self.connection.rollback()
+            elif savepoint:
+                self.cursor.execute("ROLLBACK TO save_post_rows")
+                self.cursor.execute("RELEASE save_post_rows")
+            raise
+        self.cursor.execute("RELEASE save_post_rows")
         if commit:
             self.connection.commit()
         return self
 
+    def _savepoint(self):
+        """Open the savepoint that ``save_post_rows`` writes in, inside a
+        transaction (releasing a savepoint that began one would commit it).
+        Returns ``True``."""
+        if not self.connection.in_transaction:
+            self.cursor.execute("BEGIN")
+        self.cursor.execute("SAVEPOINT save_post_rows")
+        return True
+
+    def _write_bulk_rows(self, batch):
+        """Write a ``BulkRows`` batch gathered by ``save_post_rows``."""
+        executemany = self.cursor.executemany
+        executemany('INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?)',
+                    batch.users)
+        executemany('INSERT OR IGNORE INTO collections VALUES (?, NULL)',
+                    batch.collections)
+        executemany('INSERT OR IGNORE INTO post_urls (post_pk, url, ind, '
+                    'media_type, height, width) VALUES (?, ?, ?, ?, ?, ?)',
+                    batch.urls)
+        executemany('INSERT OR REPLACE INTO posts '
+                    'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', batch.posts.values())
+        if not self.shared:
+            executemany('DELETE FROM collection_relations WHERE post_pk=?',
+                        [(pk,) for pk in batch.relations])
+        executemany('INSERT OR IGNORE INTO collection_relations '
+                    'VALUES (?, ?, ?)',
+                    [r for rows in batch.relations.values() for r in rows])
+
+    @property
+    def post_dictionary(self):
+        """The ``(id, data)`` of the latest compression dictionary for
+        ``post_codec``, or ``None`` if there isn't one."""
+        if self.post_codec not in self._post_dictionaries:
+            self._post_dictionaries[self.post_codec] = self.cursor.execute(
+                "SELECT id, data FROM post_dictionaries WHERE codec = ? "
+                "ORDER BY id DESC LIMIT 1", (self.post_codec,)
+            ).fetchone()
+        return self._post_dictionaries[self.post_codec]
+
+    def get_post_dictionary(self, dictionary_id):
+        """Get the data of the compression dictionary with ID
+        ``dictionary_id``."""
+        if dictionary_id not in self._dictionaries:
+            row = self.cursor.execute(
+                "SELECT data FROM post_dictionaries WHERE id = ?",
+                (dictionary_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError("No such post dictionary: {}".format(
+                    dictionary_id))
+            self._dictionaries[dictionary_id] = row[0]
+        return self._dictionaries[dictionary_id]
+
+    def encode_post(self, post):
+        """Encode the ``post`` dict for storage in ``posts.post_json`` with
+        this database's ``post_codec``."""
+        return codec.encode_post(post, self.post_codec, self.post_dictionary)
+
+    def decode_post(self, post_json):
+        """Decode a ``posts.post_json`` value, however it was stored."""
+        return codec.decode_post(post_json, self.get_post_dictionary,
+                                 self.decoder.loads)
+
+    def get_post(self, pk):
+        """Get the raw API payload of the post with primary key ``pk`` as a
+        dict, or ``None`` if it isn't saved."""
+        row = self.cursor.execute("SELECT post_json FROM posts WHERE pk = ?",
+                                  (str(pk),)).fetchone()
+        return None if row is None else self.decode_post(row[0])
+
+    def train_post_dictionary(self, samples=1000,
+                              size=codec.DEFAULT_DICTIONARY_SIZE, commit=True):
+        """Train a compression dictionary for ``post_codec`` on a random
+        sample of up to ``samples`` saved posts and make it the one used for
+        newly saved posts. Returns the new dictionary's ID."""
+        if self.post_codec == 'json':
+            raise ValueError("The json post_codec doesn't use dictionaries.")
+        self.cursor.execute("SELECT post_json FROM posts "
+                            "ORDER BY random() LIMIT ?", (samples,))
+        posts = [self.decode_post(row[0]) for row in self.cursor.fetchall()]
+        data = codec.train_dictionary(posts, self.post_codec, size)
+        self.cursor.execute("INSERT INTO post_dictionaries (codec, data) "
+                            "VALUES (?, ?)", (self.post_codec, data))
+        self._post_dictionaries[self.post_codec] = (self.cursor.lastrowid,
+                                                    data)
+        if commit:
+            self.connection.commit()
+        return self.cursor.lastrowid
+
+    def convert_posts(self, batch_size=1000):
+        """Re-encode every saved post that isn't already stored with this
+        database's ``post_codec`` (and latest dictionary), e.g. to convert
+        posts saved by older versions of igsync as Python ``repr`` strings to
+        JSON or to compress them. Rows are converted ``batch_size`` at a time,
+        committing after each batch. Run ``VACUUM`` afterwards to return the
+        freed space to the filesystem. Returns the number of posts
+        converted."""
+        dict_id = (self.post_dictionary or (0,))[0]
+        converted = 0
+        last = 0
+        while True:
+            rows = self.cursor.execute(
+                "SELECT rowid, post_json FROM posts WHERE rowid > ? "
+                "ORDER BY rowid LIMIT ?", (last, batch_size)
+            ).fetchall()
+            if not rows:
+                return converted
+            last = rows[-1][0]
+            updates = [
+                (self.encode_post(self.decode_post(value)), rowid)
+                for rowid, value in rows
+                if not codec.is_encoded(value, self.post_codec, dict_id)
+            ]
+            self.cursor.executemany(
+                "UPDATE posts SET post_json = ? WHERE rowid = ?", updates
+            )
+            self.connection.commit()
+            converted += len(updates)
+
     def get_anonymous_collections(self):
         """Return a list of collection IDs whose names need to be set."""
         self.cursor.execute("SELECT pk FROM collections WHERE name IS NULL")
@@ -351,12 +816,220 @@ class InstagramDb(object):
         self.cursor.execute("SELECT pk FROM collections")
         return [res[0] for res in self.cursor.fetchall()]
 
-    def sync_collection_names(self, collection_pks):
+    def get_collection_posts(self, collection_pk):
+        """Return a list of the primary keys of the posts in the collection
+        with primary key ``collection_pk``, newest first."""
+        self.cursor.execute(
+            "SELECT posts.pk FROM collection_relations "
+            "JOIN posts ON collection_relations.post_pk = posts.pk "
+            "WHERE collection_relations.collection_pk = ? "
+            "ORDER BY posts.taken_at DESC",
+            (str(collection_pk),)
+        )
+        return [res[0] for res in self.cursor.fetchall()]
+
+    def iter_posts(self, **filters):
+        """Lazily iterate over compact ``query.PostRow`` tuples for the posts
+        matching ``filters`` (by collection, user, date range and media
+        type), newest first. See `query.iter_posts` for the filters. Uses its
+        own cursor, so other queries can be run while iterating."""
+        return query.iter_posts(self.connection, **filters)
+
+    def page_posts(self, limit, after=None, **filters):
+        """Get a ``query.Page`` of up to ``limit`` posts matching
+        ``filters``, starting after the post with ``query.Key`` ``after``.
+        See `query.page_posts`."""
+        return query.page_posts(self.connection, limit, after, **filters)
+
+    def sync_collection_names(self, collection_pks=None,
+                              max_age=COLLECTION_NAMES_TTL):
         """Get the latest names for the collections whose primary keys are
-        specified in ``collection_pks`` and save them to the local database."""
-        for pk in collection_pks:
-            name = self.client.collection_feed(pk)['collection_name']
-            self.save_collection(pk, name, overwrite=True)
+        specified in ``collection_pks`` (default: the collections returned by
+        ``get_anonymous_collections``) from the user's list of collections
+        (see ``fetch_collection_names``) and save them to the local database
+        in one transaction. Returns a dict mapping the primary keys of the
+        collections that were found to their names."""
+        if collection_pks is None:
+            collection_pks = self.get_anonymous_collections()
+        collection_pks = [str(pk) for pk in collection_pks]
+        if not collection_pks:
+            return dict()
+        names = self.fetch_collection_names(max_age)
+        missing = [pk for pk in collection_pks if pk not in names]
+        if missing:
+            logging.warning("Collections not in the user's collection list: "
+                            "%s", ", ".join(missing))
+        return self.save_collection_names({pk: names[pk] for pk in
+                                           collection_pks if pk in names})
+
+    def fetch_collection_names(self, max_age=COLLECTION_NAMES_TTL, now=None):
+        """Get a dict mapping the primary keys of the user's collections to
+        their names from the (paginated) list of collections. The list is
+        cached and reused for ``max_age`` seconds after it was fetched, as of
+        ``now`` (default: the current time)."""
+        now = time.time() if now is None else now
+        if (self._collection_names is not None and
+                now - self._collection_names[0] < max_age):
+            return dict(self._collection_names[1])
+        names = {str(c['collection_id']): c['collection_name']
+                 for c in crawler.iter_collections(self.client)}
+        self._collection_names = (now, names)
+        return dict(names)
+
+    SyncState = namedtuple('SyncState', ('collection_pk', 'newest_post_pk',
+                                         'newest_taken_at', 'last_synced'))
+
+    def get_sync_state(self, collection_pk):
+        """Get the ``SyncState`` recorded by the last complete sync of the
+        collection with primary key ``collection_pk``, or ``None`` if it has
+        never been synced."""
+        row = self.cursor.execute(
+            "SELECT * FROM collection_sync_state WHERE collection_pk = ?",
+            (str(collection_pk),)
+        ).fetchone()
+        return None if row is None else self.SyncState(*row)
+
+    def get_imported_files(self, directory, names):
+        """Get the set of those file ``names`` that have been imported from
+        the JSON dump ``directory`` (see `importer`)."""
+        directory = os.path.abspath(directory)
+        names = list(names)
+        imported = set()
+        for i in range(0, len(names), MAX_PARAMS):
+            chunk = names[i:i+MAX_PARAMS]
+            imported.update(name for name, in self.cursor.execute(
+                "SELECT name FROM json_imports WHERE directory = ? AND "
+                "name IN ({})".format(','.join('?'*len(chunk))),
+                [directory] + chunk
+            ))
+        return imported
+
+    def save_imported_files(self, directory, files, commit=True):
+        """Record that the files in the JSON dump ``directory`` given as
+        ``(name, post_pk)`` pairs in ``files`` have been imported. Returns
+        ``self`` to allow for chained commands."""
+        directory = os.path.abspath(directory)
+        now = int(time.time())
+        self.cursor.executemany(
+            "INSERT OR REPLACE INTO json_imports VALUES (?, ?, ?, ?)",
+            [(directory, name, post_pk, now) for name, post_pk in files]
+        )
+        if commit:
+            self.connection.commit()
+        return self
+
+    def count_collection_posts(self, collection_pk, post_pks):
+        """Count how many of the posts with primary keys in ``post_pks`` are
+        already saved as members of the collection ``collection_pk``."""
+        post_pks = [str(pk) for pk in post_pks]
+        return self.cursor.execute(
+            "SELECT count(*) FROM collection_relations "
+            "WHERE collection_pk = ? AND post_pk IN ({})".format(
+                ','.join('?'*len(post_pks))),
+            [str(collection_pk)] + post_pks
+        ).fetchone()[0]
+
+    def sync_collection(self, collection_pk, full=False,
+                        page_delay=crawler.DEFAULT_PAGE_DELAY):
+        """Fetch the posts in the collection with primary key
+        ``collection_pk`` from Instagram and save them to this database.
+
+        Collections are paged through newest first. Unless ``full`` is
+        ``True``, paging stops as soon as it reaches the newest post seen by
+        the last complete sync (or a page of posts that are all already
+        saved in this collection), so a collection that gained a couple of
+        posts usually takes a single request. Each page is committed as it
+        is saved; the sync cursor is only advanced once the sync finishes,
+        so an interrupted sync is picked up by the next one. Requests are
+        paced by ``throttle``; if ``page_delay`` is given, also wait a random
+        number of seconds in that range between pages. Returns the number of
+        posts saved."""
+        collection_pk = str(collection_pk)
+        state = None if full else self.get_sync_state(collection_pk)
+        pages = crawler.UnsyncedPages(
+            crawler.iter_collection_pages(self.client, collection_pk,
+                                          page_delay),
+            lambda items: self.unsynced_items(collection_pk, state, items)
+        )
+        saved = 0
+        for new in pages:
+            self.save_posts(new)
+            saved += len(new)
+        if pages.newest is not None:
+            self.save_sync_state(collection_pk, pages.newest)
+        return saved
+
+    def unsynced_items(self, collection_pk, state, items):
+        """Get the leading items of a page of ``items`` from the feed of the
+        collection with primary key ``collection_pk`` that haven't been
+        synced, given the ``SyncState`` of the collection's last sync
+        (``None`` to treat all items as new). Once fewer items than were
+        given are returned, the rest of the feed has already been synced."""
+        if state is None:
+            return items
+        pks = [str(item['media']['pk']) for item in items]
+        if state.newest_post_pk in pks:
+            return items[:pks.index(state.newest_post_pk)]
+        if self.count_collection_posts(collection_pk, pks) == len(pks):
+            return []
+        return items
+
+    def save_sync_state(self, collection_pk, newest, commit=True):
+        """Record that the collection with primary key ``collection_pk`` has
+        been synced up to its newest post, whose ``media`` dict is
+        ``newest``. Returns ``self`` to allow for chained commands."""
+        self.save_collection(collection_pk, overwrite=False, commit=False)
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO collection_sync_state VALUES (?, ?, ?, ?)",
+            (str(collection_pk), str(newest['pk']), int(newest['taken_at']),
+             int(time.time()))
+        )
+        if commit:
+            self.connection.commit()
+        return self
+
+    def sync_collection_list(self, max_age=COLLECTION_NAMES_TTL):
+        """Fetch the list of the user's collections from Instagram (unless it
+        was fetched less than ``max_age`` seconds ago; see
+        ``fetch_collection_names``) and save their names to this database.
+        Returns a dict mapping collection primary keys to names."""
+        return self.save_collection_names(
+            self.fetch_collection_names(max_age))
+
+    def save_collection_names(self, names, commit=True):
+        """Save the collection names in ``names``, a dict mapping collection
+        primary keys to names, with one ``executemany``. If ``commit`` is
+        ``True`` (default), commit the changes immediately. Returns
+        ``names``."""
+        self.cursor.executemany(
+            'INSERT OR REPLACE INTO collections VALUES (?, ?)',
+            [(str(pk), name) for pk, name in names.items()]
+        )
+        if commit:
+            self.connection.commit()
+        return names
+
+    def sync_collections(self, collection_pks=None, full=False,
+                         page_delay=crawler.DEFAULT_PAGE_DELAY, workers=1):
+        """Sync each collection in ``collection_pks`` (default: all of the
+        user's collections on Instagram) with ``sync_collection``. With more
+        than one of ``workers``, that many collections are crawled at once
+        by a `Pipeline` (without downloading media) whose threads share the
+        API budget of ``throttle``, while this thread saves their pages.
+        Returns a dict mapping collection primary keys to the number of
+        posts saved."""
+        if collection_pks is None:
+            collection_pks = list(self.sync_collection_list())
+        collection_pks = [str(pk) for pk in collection_pks]
+        if workers > 1:
+            from .pipeline import Pipeline
+            pipeline = Pipeline(self, None, crawl_workers=workers,
+                                download_workers=0, full=full,
+                                page_delay=page_delay)
+            pipeline.run(collection_pks)
+            return {pk: pipeline.saved[pk] for pk in collection_pks}
+        return {pk: self.sync_collection(pk, full=full, page_delay=page_delay)
+                for pk in collection_pks}
 
     def get_undownloaded_posts(self):
         """Get a list of all post primary keys in the database that have not
@@ -366,17 +1039,310 @@ class InstagramDb(object):
                             "WHERE post_urls.download_path IS NULL;")
         return self.cursor.fetchall()
 
-    UrlInfo = namedtuple('UrlInfo', ('post_pk', 'code', 'url', 'index'))
+    UrlInfo = namedtuple('UrlInfo', ('post_pk', 'code', 'url', 'index',
+                                     'count'))
+    UrlInfo.__new__.__defaults__ = (None,)  # number of media in the post
+    # the number of media items in a post, for ``UrlInfo.count``
+    MEDIA_COUNT = ("(SELECT count(DISTINCT ind) FROM post_urls AS counted "
+                   "WHERE counted.post_pk = posts.pk)")
 
-    def get_undownloaded_urls(self):
+    def get_undownloaded_urls(self, post_pks=None, now=None):
         """Get a list of all media URL rows in the database that have not yet
-        been downloaded to a local path."""
+        been downloaded to a local path, optionally only those of the posts
+        with primary keys in ``post_pks``. Rows whose earlier downloads
+        failed are skipped until their ``next_attempt_at`` (a Unix time) has
+        passed as of ``now`` (default: the current time); see
+        ``record_failures``."""
+        return list(self.iter_undownloaded_urls(post_pks, now))
+
+    def iter_undownloaded_urls(self, post_pks=None, now=None,
+                               fetch_size=query.FETCH_SIZE):
+        """Lazily iterate over the ``UrlInfo`` rows of
+        ``get_undownloaded_urls``, fetching ``fetch_size`` rows at a time.
+        Uses its own cursor, so downloads can be recorded while iterating;
+        rows recorded before the cursor reaches them may be skipped, and are
+        picked up by the next call."""
+        now = int(time.time() if now is None else now)
+        query = ("SELECT posts.pk, posts.code, post_urls.url, post_urls.ind, "
+                 + self.MEDIA_COUNT + " "
+                 "FROM post_urls JOIN posts ON post_urls.post_pk = posts.pk "
+                 "WHERE post_urls.download_path IS NULL AND "
+                 "coalesce(post_urls.next_attempt_at, 0) <= ?")
+        if post_pks is None:
+            chunks = [None]
+        else:
+            post_pks = [str(pk) for pk in post_pks]
+            chunks = [post_pks[i:i+MAX_PARAMS]
+                      for i in range(0, len(post_pks), MAX_PARAMS)]
+        cursor = self.connection.cursor()
+        try:
+            for chunk in chunks:
+                if chunk is None:
+                    cursor.execute(query, (now,))
+                else:
+                    cursor.execute(
+                        query + " AND post_urls.post_pk IN ({})".format(
+                            ','.join('?'*len(chunk))),
+                        [now] + chunk
+                    )
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield self.UrlInfo(*row)
+        finally:
+            cursor.close()
+
+    def get_media_urls(self, post_pks=None, policy=PREVIEW):
+        """Get ``UrlInfo`` rows for the media of the posts with primary keys
+        in ``post_pks`` (default: all posts), choosing each image or video's
+        rendition by the `media.LinkPolicy` ``policy`` from the posts' saved
+        API payloads (default: small cover images for previews). Download
+        them with a `Downloader` that doesn't ``record`` its downloads, into
+        a separate ``media_root``, so that they aren't mistaken for the
+        archived originals. The posts are decoded one at a time, as
+        `media.iter_links` consumes them."""
+        query = "SELECT pk, code, post_json FROM posts"
+        if post_pks is None:
+            chunks = [None]
+        else:
+            post_pks = [str(pk) for pk in post_pks]
+            chunks = [post_pks[i:i+MAX_PARAMS]
+                      for i in range(0, len(post_pks), MAX_PARAMS)]
+        cursor = self.connection.cursor()
+        codes = dict()
+
+        def medias():
+            for chunk in chunks:
+                if chunk is None:
+                    cursor.execute(query)
+                else:
+                    cursor.execute(query + " WHERE pk IN ({})".format(
+                        ','.join('?'*len(chunk))), chunk)
+                for pk, code, post_json in cursor:
+                    codes[pk] = code
+                    yield self.decode_post(post_json)['media']
+
+        result = []
+        for pk, links in groupby(iter_links(medias(), policy),
+                                 itemgetter(0)):
+            links = list(links)
+            code = codes.pop(pk)
+            result += [self.UrlInfo(pk, code, link.url, i, len(links))
+                       for _, i, link in links]
+        cursor.close()
+        return result
+
+    def set_download_paths(self, paths, commit=True):
+        """Record the local paths that media URLs were downloaded to.
+        ``paths`` is an iterable of ``(urlinfo, download_path)`` pairs, where
+        each ``urlinfo`` is a ``UrlInfo`` as returned by
+        ``get_undownloaded_urls``. Returns ``self`` to allow for chained
+        commands."""
+        self.cursor.executemany(
+            "UPDATE post_urls SET download_path = ? "
+            "WHERE post_pk = ? AND url = ?",
+            [(str(path), info.post_pk, info.url) for info, path in paths]
+        )
+        if commit:
+            self.connection.commit()
+        return self
+
+    def record_downloads(self, downloads, commit=True):
+        """Record finished downloads, given as an iterable of
+        ``(urlinfo, download)`` pairs as returned by `Downloader.download`:
+        set each row's ``download_path`` and, for content-addressed
+        downloads, its ``blob_hash``, adding the blobs to ``media_blobs`` and
+        updating their reference counts. Returns ``self`` to allow for chained
+        commands."""
+        downloads = list(downloads)
+        self.set_download_paths([(info, d.path) for info, d in downloads],
+                                commit=False)
+        blobs = [(info, d.blob) for info, d in downloads if d.blob]
+        if blobs:
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO media_blobs (hash, size, etag) "
+                "VALUES (?, ?, ?)",
+                [tuple(blob) for _, blob in blobs]
+            )
+            self.cursor.executemany(
+                "UPDATE post_urls SET blob_hash = ? "
+                "WHERE post_pk = ? AND url = ?",
+                [(blob.hash, info.post_pk, info.url) for info, blob in blobs]
+            )
+            self.update_blob_refcounts({blob.hash for _, blob in blobs},
+                                       commit=False)
+        if commit:
+            self.connection.commit()
+        return self
+
+    def get_stale_post_pks(self, now=None):
+        """Get a sorted list of the primary keys of posts with undownloaded
+        media rows whose URLs have expired as of ``now`` (default: the
+        current time) according to the expiry time in the URL, or whose
+        last download failed the way downloads of expired URLs do (see
+        `expiry`)."""
+        self.cursor.execute("SELECT post_pk, url, last_error FROM post_urls "
+                            "WHERE download_path IS NULL")
+        return sorted({pk for pk, url, error in self.cursor.fetchall()
+                       if expiry.is_expired(url, now) or
+                       expiry.describes_expiry(error)})
+
+    def refresh_urls(self, post_pks, batch_size=50, commit=True):
+        """Replace the URLs of the undownloaded media rows of the posts with
+        primary keys in ``post_pks`` with fresh ones, fetching the posts'
+        media info from Instagram ``batch_size`` posts per request, and
+        clear their failure counts and backoff so they can be downloaded
+        right away. All rows are updated in one transaction. Returns the
+        number of posts refreshed; posts that Instagram no longer returns
+        (e.g. deleted ones) are left alone."""
+        post_pks = sorted({str(pk) for pk in post_pks})
+        updates = []
+        refreshed = 0
+        for i in range(0, len(post_pks), batch_size):
+            response = self.client.medias_info(post_pks[i:i+batch_size])
+            items = response.get('items', [])
+            refreshed += len(items)
+            updates += [(link.url, pk, ind)
+                        for pk, ind, link in iter_links(items)]
+        # a post saved again after its URLs were re-signed has a row for
+        # the old and the new URL of the same media; drop the stale one
+        self.cursor.executemany(
+            "DELETE FROM post_urls WHERE post_pk = ? AND ind = ? AND "
+            "url != ? AND download_path IS NULL AND EXISTS (SELECT 1 FROM "
+            "post_urls WHERE post_pk = ? AND url = ?)",
+            [(pk, ind, url, pk, url) for url, pk, ind in updates]
+        )
+        # several stale rows of one media all get the new URL; keep one
+        self.cursor.executemany(
+            "UPDATE OR REPLACE post_urls SET url = ?, attempts = 0, "
+            "last_error = NULL, next_attempt_at = NULL "
+            "WHERE post_pk = ? AND ind = ? AND download_path IS NULL",
+            updates
+        )
+        if commit:
+            self.connection.commit()
+        return refreshed
+
+    def refresh_stale_urls(self, now=None, batch_size=50):
+        """``refresh_urls`` of all posts from ``get_stale_post_pks``. Returns
+        the number of posts refreshed."""
+        post_pks = self.get_stale_post_pks(now)
+        if not post_pks:
+            return 0
+        refreshed = self.refresh_urls(post_pks, batch_size)
+        logging.info("Refreshed the media URLs of %d of %d posts with stale "
+                     "URLs", refreshed, len(post_pks))
+        return refreshed
+
+    def record_failures(self, failures, now=None, commit=True):
+        """Record failed downloads, given as an iterable of ``(urlinfo,
+        error)`` pairs as returned by `Downloader.download`: count the
+        attempt, store a description of ``error`` in ``last_error`` and set
+        ``next_attempt_at`` to the Unix time after which
+        ``get_undownloaded_urls`` will return the row again, with jittered
+        exponential backoff (see `retry.next_attempt_at`). Rows that failed
+        permanently (e.g. expired URLs) or too many times are given
+        ``retry.NEVER`` and skipped until ``reset_failures`` is called.
+        All rows are updated with one ``executemany``, the backoff being
+        computed by SQLite from each row's stored ``attempts``. Returns
+        ``self`` to allow for chained commands."""
+        now = time.time() if now is None else now
+        # the same as retry.next_attempt_at, where ``attempts`` is the count
+        # before this failure and the last parameter the random jitter
+        self.cursor.executemany(
+            "UPDATE post_urls SET attempts = attempts + 1, last_error = ?, "
+            "next_attempt_at = CASE WHEN ? OR attempts + 1 >= {max} "
+            "THEN {never} ELSE CAST(? + min({cap}, {base}*(1 << "
+            "min(attempts, 32)))*(1 + ?)/2 AS integer) END "
+            "WHERE post_pk = ? AND url = ?".format(
+                max=retry.MAX_ATTEMPTS, never=retry.NEVER,
+                cap=retry.BACKOFF_CAP, base=retry.BACKOFF_BASE),
+            [(retry.describe(error), retry.is_permanent(error), now,
+              random.random(), urlinfo.post_pk, urlinfo.url)
+             for urlinfo, error in failures]
+        )
+        if commit:
+            self.connection.commit()
+        return self
+
+    def reset_failures(self, post_pks=None, commit=True):
+        """Clear the failure counts and backoff of undownloaded media rows
+        (default: all of them; otherwise only those of the posts with primary
+        keys in ``post_pks``) so they are tried again right away. Returns
+        ``self`` to allow for chained commands."""
+        reset = ("UPDATE post_urls SET attempts = 0, last_error = NULL, "
+                 "next_attempt_at = NULL WHERE download_path IS NULL")
+        if post_pks is None:
+            self.cursor.execute(reset)
+        else:
+            self.cursor.executemany(reset + " AND post_pk = ?",
+                                    [(str(pk),) for pk in post_pks])
+        if commit:
+            self.connection.commit()
+        return self
+
+    def update_blob_refcounts(self, hashes=None, commit=True):
+        """Recount the ``post_urls`` rows referencing each blob in ``hashes``
+        (default: all blobs). Returns ``self`` to allow for chained
+        commands."""
+        recount = ("UPDATE media_blobs SET refcount = (SELECT count(*) "
+                   "FROM post_urls WHERE blob_hash = media_blobs.hash)")
+        if hashes is None:
+            self.cursor.execute(recount)
+        else:
+            self.cursor.executemany(recount + " WHERE hash = ?",
+                                    [(h,) for h in hashes])
+        if commit:
+            self.connection.commit()
+        return self
+
+    def get_blob_etags(self):
+        """Get a dict mapping the known CDN ETags of stored blobs to their
+        ``Blob`` records."""
+        self.cursor.execute("SELECT hash, size, etag FROM media_blobs "
+                            "WHERE etag IS NOT NULL")
+        return {row[2]: Blob(*row) for row in self.cursor.fetchall()}
+
+    def get_unreferenced_blobs(self):
+        """Return a list of the hashes of blobs that no ``post_urls`` rows
+        reference (after recounting references)."""
+        self.update_blob_refcounts(commit=False)
+        self.cursor.execute("SELECT hash FROM media_blobs WHERE refcount = 0")
+        return [res[0] for res in self.cursor.fetchall()]
+
+    def delete_blobs(self, hashes, commit=True):
+        """Delete the blobs with the given ``hashes`` from ``media_blobs``.
+        Returns ``self`` to allow for chained commands."""
+        self.cursor.executemany("DELETE FROM media_blobs WHERE hash = ?",
+                                [(h,) for h in hashes])
+        if commit:
+            self.connection.commit()
+        return self
+
+    def get_post_collections(self, post_pk):
+        """Return a list of the primary keys of the collections that the post
+        with primary key ``post_pk`` is saved in."""
+        self.cursor.execute("SELECT collection_pk FROM collection_relations "
+                            "WHERE post_pk = ?", (str(post_pk),))
+        return [res[0] for res in self.cursor.fetchall()]
+
+    def get_collection_media(self, collection_pk):
+        """Get a list of ``(urlinfo, download_path)`` pairs for the downloaded
+        media in the collection with primary key ``collection_pk``."""
         self.cursor.execute(
-            "SELECT posts.pk, posts.code, post_urls.url, post_urls.ind "
-            "FROM post_urls JOIN posts ON post_urls.post_pk = posts.pk "
-            "WHERE post_urls.download_path IS NULL;"
+            "SELECT posts.pk, posts.code, post_urls.url, post_urls.ind, " +
+            self.MEDIA_COUNT + ", post_urls.download_path "
+            "FROM collection_relations "
+            "JOIN posts ON collection_relations.post_pk = posts.pk "
+            "JOIN post_urls ON post_urls.post_pk = posts.pk "
+            "WHERE collection_relations.collection_pk = ? "
+            "AND post_urls.download_path IS NOT NULL",
+            (str(collection_pk),)
         )
-        return [self.UrlInfo(*row) for row in self.cursor.fetchall()]
+        return [(self.UrlInfo(*row[:5]), row[5])
+                for row in self.cursor.fetchall()]
 
     @staticmethod
     def get_media_path(urlinfo):
@@ -387,3 +1353,15 @@ class InstagramDb(object):
         filename = '.'.join([urlinfo.code, str(urlinfo.index), ext])
         return os.path.join(*[pk[-3*i-3:-3*i-1] + pk[-3*i-1]
                               for i in range(len(pk)//3)], filename)
+
+    @staticmethod
+    def get_media_name(urlinfo):
+        """Get the file name that saveImages.php gives the media in a UrlInfo
+        object: ``<code>.<ext>`` if it's the only media item of its post (see
+        ``UrlInfo.count``) and ``<code>.<index>.<ext>`` otherwise. Used for
+        the links in collection directories and for the flat
+        ``.ORIGINAL_MEDIA`` layout."""
+        ext = os.path.basename(urlparse(urlinfo.url).path).split('.')[-1]
+        if urlinfo.count == 1:
+            return '.'.join([urlinfo.code, ext])
+        return '.'.join([urlinfo.code, str(urlinfo.index), ext])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# (c) Stefan Countryman 2018
+
+"""
+Command line interface for igsync. Run ``python -m igsync -h`` for usage.
+"""
+
+import sys
+import logging
+from argparse import ArgumentParser
+from . import InstagramDb, DEFAULT_DB_PATH, DEFAULT_MEDIA_ROOT
+
+DESC = """Sync saved Instagram posts into a local SQLite database. Put
+authentication info under an "instagram.com" entry in `.netrc`."""
+
+
+def sync(args):
+    """Sync collections from Instagram into the database."""
+    db = InstagramDb(args.db, profile='safe').inittables()
+    saved = db.sync_collections(args.collections or None, full=args.full,
+                                workers=args.jobs)
+    for collection_pk, count in saved.items():
+        logging.info("Saved %d posts from collection %s", count,
+                     collection_pk)
+    return 0
+
+
+def sync_accounts(args):
+    """Sync the collections of several accounts into one database and one
+    shared media store."""
+    from .accounts import Orchestrator, load_accounts
+    accounts = load_accounts(args.accounts)
+    results = Orchestrator(args.db, args.media_root, accounts,
+                           workers=args.jobs, full=args.full,
+                           collections_dir=args.collections_dir).run()
+    for username, saved in results.items():
+        if saved is not None:
+            logging.info("Saved %d posts for %s", sum(saved.values()),
+                         username)
+    return 1 if None in results.values() else 0
+
+
+def import_json(args):
+    """Import the JSON dump directory written by saveImages.php."""
+    from .importer import JsonImporter
+    db = InstagramDb(args.db, profile='bulk').inittables()
+    importer = JsonImporter(db, args.directory, workers=args.jobs,
+                            batch_size=args.batch_size,
+                            restart=args.restart, overwrite=args.overwrite)
+    importer.run()
+    logging.info("Saved %d posts from %s (%d already saved, %d failed)",
+                 importer.saved, args.directory, importer.skipped,
+                 importer.failed)
+    return 1 if importer.failed else 0
+
+
+def get_parser():
+    """Get the command line argument parser."""
+    parser = ArgumentParser(prog="igsync", description=DESC)
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="""
+        The SQLite database to sync into. (default: %(default)s)""")
+    parser.add_argument("-v", "--verbose", action="count", default=0, help="""
+        Verbosity level. `-v` reports progress; `-vv` adds debug info.""")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    cmd = subparsers.add_parser("sync", help=sync.__doc__)
+    cmd.set_defaults(func=sync)
+    arg = cmd.add_argument
+    arg("collections", nargs="*", help="""
+        Primary keys of the collections to sync. If none are specified
+        (DEFAULT), sync all of your collections.""")
+    arg("--full", action="store_true", help="""
+        Page through every post in each collection instead of stopping at the
+        posts saved by the last sync.""")
+    arg("-j", "--jobs", type=int, default=4, help="""
+        Number of collections to crawl at once. (default: %(default)s)""")
+    cmd = subparsers.add_parser("sync-accounts", help=sync_accounts.__doc__)
+    cmd.set_defaults(func=sync_accounts)
+    arg = cmd.add_argument
+    arg("accounts", help="""
+        A JSON file listing the accounts to sync as objects with "username"
+        and "password" keys and an optional "collections" list of collection
+        primary keys (DEFAULT: all of the account's collections).""")
+    arg("--media-root", default=DEFAULT_MEDIA_ROOT, help="""
+        The directory holding the shared media store. (default:
+        %(default)s)""")
+    arg("--collections-dir", help="""
+        If given, link each account's collections into
+        <collections-dir>/<username>/<collection>.""")
+    arg("-j", "--jobs", type=int, default=2, help="""
+        Number of accounts to sync at once. (default: %(default)s)""")
+    arg("--full", action="store_true", help="""
+        Page through every post in each collection instead of stopping at the
+        posts saved by the last sync.""")
+    cmd = subparsers.add_parser("import-json", help=import_json.__doc__)
+    cmd.set_defaults(func=import_json)
+    arg = cmd.add_argument
+    arg("directory", help="""
+        The directory of <code>.json files to import, i.e. the .JSON
+        directory inside saveImages.php's collections directory.""")
+    arg("-j", "--jobs", type=int, help="""
+        Number of processes parsing files. (default: the number of CPUs)""")
+    arg("--batch-size", type=int, default=1000, help="""
+        Number of files to parse per task and commit at a time. (default:
+        %(default)s)""")
+    arg("--restart", action="store_true", help="""
+        Load every file, including those imported from this directory by
+        earlier runs.""")
+    arg("--overwrite", action="store_true", help="""
+        Replace posts that are already saved instead of skipping them.""")
+    return parser
+
+
+def main(argv=None):
+    """Run with the command line options."""
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=[logging.WARNING, logging.INFO,
+                               logging.DEBUG][min(args.verbose, 2)])
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
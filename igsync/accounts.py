@@ -0,0 +1,163 @@
+# (c) Stefan Countryman 2018
+
+"""
+Sync the collections of several Instagram accounts into one shared database
+and one shared, content-addressed media store, so that posts and media saved
+by more than one account are only stored (and usually only downloaded) once.
+
+Each account gets its own cached session and its own API rate limit,
+while all accounts share the per-host CDN budgets. Accounts are synced by a
+pool of worker threads, each running a `Pipeline` over its own connection
+to the database.
+"""
+
+import os
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus
+from . import ratelimit
+from .store import materialize_collection
+from .pipeline import Pipeline
+
+Account = namedtuple('Account', ('username', 'password', 'collections'))
+Account.__new__.__defaults__ = (None,)  # sync all collections by default
+BUSY_TIMEOUT = 60000  # ms to wait for another account's write to finish
+
+
+def load_accounts(path):
+    """Load a list of ``Account`` tuples from the JSON file at ``path``,
+    holding a list of objects with ``username`` and ``password`` keys and an
+    optional list of ``collections`` (primary keys) to sync."""
+    with open(path) as infile:
+        return [Account(a['username'], a['password'], a.get('collections'))
+                for a in json.load(infile)]
+
+
+class Orchestrator(object):
+    """Sync the collections of each of ``accounts`` (`Account` tuples) into
+    the database at ``db_path`` and the media store under ``media_root``."""
+
+    def __init__(self, db_path, media_root, accounts, workers=2,
+                 sessions=None, api_budget=ratelimit.API_BUDGET,
+                 cdn_budget=ratelimit.CDN_BUDGET, collections_dir=None,
+                 full=False, **pipeline_kwargs):
+        """
+        Arguments
+        =========
+        db_path : `string`
+            the SQLite database shared by all accounts.
+        media_root : `string`
+            the directory holding the shared content-addressed media store.
+        accounts : `list`
+            the ``Account`` tuples to sync.
+        workers : `int`, optional
+            the number of accounts to sync at once.
+        sessions : `string`, optional
+            the directory to cache the accounts' sessions in, one file per
+            username. Defaults to ``sessions`` next to ``db_path``.
+        api_budget : `dict`, optional
+            the `ratelimit.RateLimiter` arguments of each account's API rate
+            limit.
+        cdn_budget : `dict`, optional
+            the `ratelimit.RateLimiter` arguments of each CDN host's rate
+            limit, shared by all accounts.
+        collections_dir : `string`, optional
+            if given, link each account's collections into
+            ``<collections_dir>/<username>/<collection pk>``.
+        full : `bool`, optional
+            if ``True``, page through every post in each collection instead
+            of stopping at the posts saved by the last sync.
+        **pipeline_kwargs
+            passed on to each account's `Pipeline`.
+        """
+        self.db_path = db_path
+        self.media_root = media_root
+        self.accounts = accounts
+        self.workers = workers
+        self.sessions = sessions or os.path.join(
+            os.path.dirname(os.path.abspath(db_path)), 'sessions')
+        self.api_budget = api_budget
+        self.throttle = ratelimit.Throttle(api=None, cdn=cdn_budget)
+        self.collections_dir = collections_dir
+        self.full = full
+        self.pipeline_kwargs = pipeline_kwargs
+
+    def connect(self, account):
+        """Open a connection to the database logged in as ``account``, with
+        its own session and API rate limit, for use from the calling
+        thread."""
+        from . import InstagramDb
+        return InstagramDb(
+            self.db_path, account.username, account.password,
+            profile='safe', pragmas=dict(busy_timeout=BUSY_TIMEOUT),
+            throttle=self.throttle.with_api(self.api_budget),
+            sessions=self.sessions,
+            shared=True
+        )
+
+    def collection_dir(self, account, collection_pk):
+        """Get the directory to link ``account``'s collection with primary
+        key ``collection_pk`` into."""
+        return os.path.join(self.collections_dir,
+                            quote_plus(account.username), collection_pk)
+
+    def sync_account(self, account):
+        """Sync the collections of ``account``. Returns a dict mapping the
+        primary keys of its collections to the number of posts saved."""
+        db = self.connect(account)
+        try:
+            names = db.sync_collection_list()
+            collection_pks = account.collections or list(names)
+            dirs = None
+            if self.collections_dir is not None:
+                dirs = {pk: self.collection_dir(account, pk)
+                        for pk in collection_pks}
+            with Pipeline(db, self.media_root, full=self.full,
+                          collection_dirs=dirs, content_addressed=True,
+                          **self.pipeline_kwargs) as pipeline:
+                pipeline.run(collection_pks)
+            return {pk: pipeline.saved[pk] for pk in collection_pks}
+        finally:
+            db.connection.close()
+
+    def run(self):
+        """Sync every account, ``workers`` at a time. Returns a dict mapping
+        each username to the result of ``sync_account``, or ``None`` if
+        syncing that account failed (the error is logged)."""
+        from . import InstagramDb
+        init = InstagramDb(self.db_path, profile='safe').inittables()
+        init.connection.close()
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = {account.username: executor.submit(self.sync_account,
+                                                         account)
+                       for account in self.accounts}
+        results = dict()
+        for username, future in futures.items():
+            try:
+                results[username] = future.result()
+            except Exception as err:
+                logging.error("Failed to sync account %s: %s", username, err)
+                results[username] = None
+        if self.collections_dir is not None:
+            self.materialize(results)
+        return results
+
+    def materialize(self, results):
+        """Link the media of the collections synced for each account in
+        ``results`` (as returned by ``run``) into ``collections_dir``. Each
+        `Pipeline` only links the media it downloads itself, so this adds
+        the posts that another account downloaded first."""
+        from . import InstagramDb
+        db = InstagramDb(self.db_path, profile='safe')
+        try:
+            for account in self.accounts:
+                for pk in results.get(account.username) or ():
+                    materialize_collection(
+                        db, self.media_root, pk,
+                        self.collection_dir(account, pk),
+                        self.pipeline_kwargs.get('link', 'hard')
+                    )
+        finally:
+            db.connection.close()
@@ -0,0 +1,249 @@
+# (c) Stefan Countryman 2018
+
+"""
+An ``asyncio`` facade over `InstagramDb` for services running an event
+loop. The database connection lives on a dedicated writer thread that runs
+every database operation, one at a time, and Instagram API calls and media
+downloads run in a separate thread pool, so none of them block the event
+loop and many collections can be synced concurrently from it.
+"""
+
+import asyncio
+import logging
+import functools
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from . import crawler, query
+from .download import Downloader, DownloadResults
+
+DONE = object()  # end-of-iterator marker
+
+
+class AsyncInstagramDb(object):
+    """Run an `InstagramDb`, created with the given arguments, on its own
+    writer thread. Any `InstagramDb` method can be awaited as a method of
+    this class; the methods defined here additionally keep API calls and
+    downloads off the writer thread. ``api_workers`` is the number of API
+    calls and downloads to run concurrently. Use as an ``async with``
+    context manager or call ``close`` when done."""
+
+    def __init__(self, *args, api_workers=8, **kwargs):
+        self.db = None
+        self._writer = ThreadPoolExecutor(
+            1, thread_name_prefix='igsync-writer', initializer=self._open,
+            initargs=(args, kwargs)
+        )
+        self._api = ThreadPoolExecutor(api_workers,
+                                       thread_name_prefix='igsync-api')
+        self.api_workers = api_workers
+        # open the database now so that errors surface here
+        self._writer.submit(lambda: None).result()
+
+    def _open(self, args, kwargs):
+        from . import InstagramDb
+        self.db = InstagramDb(*args, **kwargs)
+
+    async def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def write(self, func, *args, **kwargs):
+        """Call ``func(db, *args, **kwargs)`` on the writer thread, where
+        ``db`` is the `InstagramDb`, and return its result."""
+        return await self._run(self._writer, func, self.db, *args, **kwargs)
+
+    async def api(self, func, *args, **kwargs):
+        """Call ``func(client, *args, **kwargs)`` in the API thread pool,
+        where ``client`` is the database's (rate limited) API client, and
+        return its result."""
+        client = await self._run(self._api, lambda: self.db.client)
+        return await self._run(self._api, func, client, *args, **kwargs)
+
+    def __getattr__(self, name):
+        if self.db is None:
+            raise AttributeError(name)
+        attr = getattr(self.db, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._run(self._writer, attr, *args, **kwargs)
+        return method
+
+    async def close(self):
+        """Close the database connection and shut down the threads."""
+        if self.db is not None:
+            await self.write(lambda db: db.connection.close())
+        self._writer.shutdown()
+        self._api.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def aiter(self, iterator, executor=None):
+        """Asynchronously iterate over the blocking ``iterator`` (e.g. a
+        generator of API pages), advancing it in ``executor`` (default: the
+        API thread pool)."""
+        executor = executor or self._api
+        while True:
+            item = await self._run(executor, next, iterator, DONE)
+            if item is DONE:
+                return
+            yield item
+
+    async def iter_collection_pages(self, collection_pk,
+                                    page_delay=crawler.DEFAULT_PAGE_DELAY):
+        """``async for`` over the pages of a collection's feed; see
+        `crawler.iter_collection_pages`."""
+        pages = await self.api(crawler.iter_collection_pages, collection_pk,
+                               page_delay)
+        async for page in self.aiter(pages):
+            yield page
+
+    async def iter_collection_feed(self, collection_pk,
+                                   page_delay=crawler.DEFAULT_PAGE_DELAY):
+        """``async for`` over the feed items (posts) of a collection, newest
+        first; see `crawler.iter_collection_feed`."""
+        async for page in self.iter_collection_pages(collection_pk,
+                                                     page_delay):
+            for item in page.get('items', []):
+                yield item
+
+    async def iter_undownloaded_urls(self, post_pks=None,
+                                     fetch_size=query.FETCH_SIZE):
+        """``async for`` over the ``UrlInfo`` rows returned by
+        `InstagramDb.iter_undownloaded_urls`, fetching ``fetch_size`` rows
+        at a time on the writer thread."""
+        rows = await self.write(
+            lambda db: db.iter_undownloaded_urls(post_pks,
+                                                 fetch_size=fetch_size))
+        try:
+            while True:
+                page = await self._run(self._writer,
+                                       lambda: list(islice(rows, fetch_size)))
+                if not page:
+                    return
+                for urlinfo in page:
+                    yield urlinfo
+        finally:
+            # the cursor belongs to the writer thread
+            await self._run(self._writer, rows.close)
+
+    async def sync_collection_list(self):
+        """Fetch the user's collections and save their names; see
+        `InstagramDb.sync_collection_list`."""
+        collections = await self.api(
+            lambda client: list(crawler.iter_collections(client)))
+        names = {str(c['collection_id']): c['collection_name']
+                 for c in collections}
+        return await self.write(lambda db: db.save_collection_names(names))
+
+    async def sync_collection(self, collection_pk, full=False,
+                              page_delay=crawler.DEFAULT_PAGE_DELAY):
+        """Sync a collection incrementally, like
+        `InstagramDb.sync_collection`, fetching pages in the API thread pool
+        and saving them on the writer thread. Returns the number of posts
+        saved."""
+        collection_pk = str(collection_pk)
+        state = None if full else await self.write(
+            lambda db: db.get_sync_state(collection_pk))
+        client = await self._run(self._api, lambda: self.db.client)
+        # pages are advanced in the API thread pool, which asks the writer
+        # thread which of their items are new
+        pages = crawler.UnsyncedPages(
+            crawler.iter_collection_pages(client, collection_pk, page_delay),
+            lambda items: self._writer.submit(
+                self.db.unsynced_items, collection_pk, state, items).result()
+        )
+        saved = 0
+        async for new in self.aiter(iter(pages)):
+            await self.write(lambda db: db.save_posts(new))
+            saved += len(new)
+        if pages.newest is not None:
+            await self.write(lambda db: db.save_sync_state(collection_pk,
+                                                           pages.newest))
+        return saved
+
+    async def sync_collections(self, collection_pks=None, full=False,
+                               page_delay=crawler.DEFAULT_PAGE_DELAY):
+        """Sync the collections in ``collection_pks`` (default: all of the
+        user's collections) concurrently with ``sync_collection``. Returns
+        a dict mapping collection primary keys to the number of posts
+        saved."""
+        if collection_pks is None:
+            collection_pks = list(await self.sync_collection_list())
+        counts = await asyncio.gather(*(
+            self.sync_collection(pk, full=full, page_delay=page_delay)
+            for pk in collection_pks
+        ))
+        return dict(zip(collection_pks, counts))
+
+    async def download(self, media_root, urlinfos=None, **kwargs):
+        """Download each ``UrlInfo`` in ``urlinfos`` (default: all pending
+        rows, read lazily with ``iter_undownloaded_urls``) with a
+        `Downloader` (created with ``kwargs``), recording the results on the
+        writer thread in batches. ``api_workers`` worker coroutines take
+        URLs from a bounded queue, so only a few URLs are held in memory at
+        a time however many are pending. Returns a ``DownloadResults``
+        tuple."""
+        downloader = Downloader(self.db, media_root, **kwargs)
+        if downloader.store is not None:
+            downloader.etags = await self.write(
+                lambda db: db.get_blob_etags())
+        queue = asyncio.Queue(2*self.api_workers)
+        results = DownloadResults([], [])
+        batch = DownloadResults([], [])
+
+        async def produce():
+            if urlinfos is None:
+                async for urlinfo in self.iter_undownloaded_urls():
+                    await queue.put(urlinfo)
+            else:
+                for urlinfo in urlinfos:
+                    await queue.put(urlinfo)
+            for _ in range(self.api_workers):
+                await queue.put(DONE)
+
+        async def work():
+            while True:
+                urlinfo = await queue.get()
+                if urlinfo is DONE:
+                    return
+                try:
+                    download = await self._run(
+                        self._api, downloader.fetch_retrying, urlinfo)
+                    batch.downloaded.append((urlinfo, download))
+                except Exception as err:
+                    logging.warning("Failed to download %s: %s", urlinfo.url,
+                                    err)
+                    batch.failed.append((urlinfo, err))
+                if len(batch.downloaded) + len(batch.failed) >= \
+                        downloader.batch_size:
+                    await flush()
+
+        async def flush():
+            downloaded, failed = batch.downloaded[:], batch.failed[:]
+            del batch.downloaded[:], batch.failed[:]
+            await self.write(lambda db: db.record_downloads(
+                downloaded, commit=False).record_failures(failed))
+            results.downloaded.extend(downloaded)
+            results.failed.extend(failed)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(work())
+                  for _ in range(self.api_workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # if one task failed, don't leave the others waiting on the queue
+            for task in tasks:
+                task.cancel()
+            await self._run(self._api, downloader.close)
+        await flush()
+        return results
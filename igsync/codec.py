@@ -0,0 +1,197 @@
+# (c) Stefan Countryman 2018
+
+"""
+Encode and decode the raw API payloads stored in the ``posts.post_json``
+column. Payloads are stored either as compact JSON text (queryable with
+SQLite's JSON functions) or compressed into a BLOB with zlib or (if the
+``zstandard`` package is installed) zstd, optionally using a dictionary
+trained on previously saved posts.
+
+Raw API payloads (e.g. from the ``.JSON`` dump directory) are parsed by a
+pluggable ``Decoder``: the stdlib ``json`` module, or the much faster
+``orjson`` or ``simdjson`` packages when installed (see ``get_decoder``).
+Those are stricter than the stdlib about some of what the API sends (e.g.
+lone UTF-16 surrogates from emoji cut in half, which ``orjson`` rejects), so
+a document either of them rejects is parsed again by the stdlib.
+
+Compressed values start with a small header holding the codec and the ID of
+the dictionary used (``0`` for none), so rows written with different settings
+can live side by side and are always decoded correctly. Text values that
+aren't JSON are Python ``repr`` strings written by older versions of igsync.
+"""
+
+import os
+import re
+import ast
+import json
+import zlib
+import struct
+from importlib import import_module
+from collections import Counter, namedtuple
+
+CODECS = ('json', 'zlib', 'zstd')
+CODEC_IDS = {'zlib': 1, 'zstd': 2}
+HEADER = struct.Struct('>BI')  # codec ID, dictionary ID
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 10
+ZLIB_MAX_DICTIONARY = 1 << 15
+DEFAULT_DICTIONARY_SIZE = 1 << 15
+# a key, plus its value if that's short, e.g. '"is_private":false,'
+FRAGMENT = re.compile(r'"[^"\\]{1,64}":(?:true|false|null|-?\d{1,20}|'
+                      r'"[^"\\]{0,48}")?[,{\[]?')
+DECODERS = ('orjson', 'simdjson', 'json')  # in order of preference
+DECODER_ENV = 'IGSYNC_JSON_DECODER'
+Decoder = namedtuple('Decoder', ('name', 'loads'))
+
+
+def zstandard():
+    """Import the optional ``zstandard`` package."""
+    try:
+        import zstandard as zstd
+    except ImportError:
+        raise ValueError("The zstd codec requires the zstandard package.")
+    return zstd
+
+
+def with_fallback(loads):
+    """Wrap ``loads`` so that a document it rejects is parsed again by the
+    stdlib ``json`` module, which only raises if it's really malformed."""
+    def loads_with_fallback(text):
+        try:
+            return loads(text)
+        except ValueError:
+            return json.loads(text)
+    return loads_with_fallback
+
+
+def get_decoder(name=None):
+    """Get the ``Decoder`` named ``name`` (one of ``DECODERS``), whose
+    ``loads`` parses JSON ``str`` or ``bytes`` into plain dicts and lists,
+    the same whichever decoder is used. By default, use the one named by the
+    ``IGSYNC_JSON_DECODER`` environment variable, or else the fastest one
+    installed. Anything but ``json`` falls back to it for documents it
+    rejects (see ``with_fallback``). Raises a ``ValueError`` if the requested
+    decoder's package isn't installed."""
+    if name is None:
+        name = os.environ.get(DECODER_ENV)
+    if name is None:
+        for name in DECODERS[:-1]:
+            try:
+                return get_decoder(name)
+            except ValueError:
+                pass
+        return Decoder('json', json.loads)
+    if name not in DECODERS:
+        raise ValueError("Unrecognized decoder: {}. Choose from: {}".format(
+            name, ", ".join(DECODERS)))
+    if name == 'json':
+        return Decoder(name, json.loads)
+    try:
+        return Decoder(name, with_fallback(import_module(name).loads))
+    except ImportError:
+        raise ValueError("The {0} decoder requires the {0} package.".format(
+            name))
+
+
+def dumps(post):
+    """Serialize ``post`` to compact JSON."""
+    return json.dumps(post, separators=(',', ':'))
+
+
+def encode_post(post, codec='json', dictionary=None):
+    """Encode the dict ``post`` for storage in ``posts.post_json`` using
+    ``codec`` (one of ``CODECS``). ``dictionary`` is an optional
+    ``(dictionary_id, data)`` pair, as stored in the ``post_dictionaries``
+    table, to compress with. Returns a ``str`` for ``json`` and ``bytes``
+    otherwise."""
+    text = dumps(post)
+    if codec == 'json':
+        return text
+    if codec not in CODEC_IDS:
+        raise ValueError("Unrecognized codec: {}. Choose from: {}".format(
+            codec, ", ".join(CODECS)))
+    dict_id, data = dictionary or (0, None)
+    if codec == 'zlib':
+        if data:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zdict=data)
+        else:
+            compressor = zlib.compressobj(ZLIB_LEVEL)
+        payload = compressor.compress(text.encode()) + compressor.flush()
+    else:
+        zstd = zstandard()
+        params = dict(level=ZSTD_LEVEL, write_dict_id=False)
+        if data:
+            params['dict_data'] = zstd.ZstdCompressionDict(data)
+        payload = zstd.ZstdCompressor(**params).compress(text.encode())
+    return HEADER.pack(CODEC_IDS[codec], dict_id) + payload
+
+
+def decode_post(value, dictionaries=None, loads=json.loads):
+    """Decode a ``posts.post_json`` value into a dict. ``dictionaries`` is a
+    function taking a dictionary ID and returning the dictionary's data, used
+    for compressed values that were compressed with a dictionary. ``loads``
+    parses the JSON (see ``get_decoder``)."""
+    if isinstance(value, bytes):
+        codec_id, dict_id = HEADER.unpack_from(value)
+        payload = value[HEADER.size:]
+        data = dictionaries(dict_id) if dict_id else None
+        if codec_id == CODEC_IDS['zlib']:
+            if data:
+                decompressor = zlib.decompressobj(zdict=data)
+            else:
+                decompressor = zlib.decompressobj()
+            value = decompressor.decompress(payload) + decompressor.flush()
+        elif codec_id == CODEC_IDS['zstd']:
+            zstd = zstandard()
+            params = dict()
+            if data:
+                params['dict_data'] = zstd.ZstdCompressionDict(data)
+            value = zstd.ZstdDecompressor(**params).decompressobj().decompress(
+                payload)
+        else:
+            raise ValueError("Unrecognized codec ID: {}".format(codec_id))
+        value = value.decode()
+    try:
+        return loads(value)
+    except ValueError:
+        # stored by an old version of igsync as ``str(post)``
+        return ast.literal_eval(value)
+
+
+def is_encoded(value, codec, dict_id=0):
+    """Check (cheaply) whether the ``posts.post_json`` value ``value`` is
+    already stored with ``codec`` and dictionary ``dict_id``."""
+    if codec == 'json':
+        return isinstance(value, str) and not value.startswith("{'")
+    return (isinstance(value, bytes) and
+            HEADER.unpack_from(value) == (CODEC_IDS[codec], dict_id))
+
+
+def train_dictionary(samples, codec, size=DEFAULT_DICTIONARY_SIZE):
+    """Train a compression dictionary of at most ``size`` bytes for ``codec``
+    from ``samples``, a list of post dicts. zstd dictionaries are trained by
+    ``zstandard``; zlib dictionaries are built from the JSON fragments (keys
+    and short values) that occur in the most samples, with the most useful
+    fragments last, where zlib finds them most cheaply."""
+    texts = [dumps(post) for post in samples]
+    if codec == 'zstd':
+        zstd = zstandard()
+        return zstd.train_dictionary(
+            size, [t.encode() for t in texts]
+        ).as_bytes()
+    if codec != 'zlib':
+        raise ValueError("Can't train a dictionary for codec: " + codec)
+    size = min(size, ZLIB_MAX_DICTIONARY)
+    counts = Counter()
+    for text in texts:
+        counts.update(set(FRAGMENT.findall(text)))
+    common = [f for f, n in counts.items() if n > 1]
+    common.sort(key=lambda f: (counts[f]*len(f), f), reverse=True)
+    fragments = []
+    total = 0
+    for fragment in common:
+        if total + len(fragment) > size:
+            break
+        fragments.append(fragment)
+        total += len(fragment)
+    return ''.join(reversed(fragments)).encode()
@@ -0,0 +1,93 @@
+# (c) Stefan Countryman 2018
+
+"""
+Page through the collections and collection feeds of an Instagram account
+with the private API client, as generators, so that feed items can be saved
+(and their media downloaded) as soon as each page arrives.
+"""
+
+import time
+import random
+from . import retry
+
+DEFAULT_PAGE_DELAY = None  # rely on the client's rate limiter instead
+
+
+def iter_pages(fetch, page_delay=DEFAULT_PAGE_DELAY):
+    """Yield the pages of a paginated API endpoint. ``fetch`` takes the
+    ``max_id`` of the page to fetch (``None`` for the first page) and returns
+    the API response, and transient errors are retried (see `retry.call`).
+    If ``page_delay`` is given, waits a random number of seconds in that
+    range before each page after the first. (Clients from
+    `InstagramDb.client` are already rate limited.)"""
+    max_id = None
+    while True:
+        page = retry.call(fetch, max_id)
+        yield page
+        max_id = page.get('next_max_id') if page.get('more_available') \
+            else None
+        if max_id is None:
+            return
+        if page_delay:
+            time.sleep(random.uniform(*page_delay))
+
+
+def iter_collections(client, page_delay=DEFAULT_PAGE_DELAY):
+    """Yield the collections of the logged in user as dicts with (at least)
+    ``collection_id`` and ``collection_name`` keys."""
+    def fetch(max_id):
+        if max_id is None:
+            return client.list_collections()
+        # the client's list_collections doesn't take a max_id
+        return client._call_api('collections/list/',
+                                query=dict(max_id=max_id))
+    for page in iter_pages(fetch, page_delay):
+        for collection in page.get('items', []):
+            yield collection
+
+
+def iter_collection_pages(client, collection_pk,
+                          page_delay=DEFAULT_PAGE_DELAY):
+    """Yield the pages of the feed of the collection with primary key
+    ``collection_pk``, newest first. Each page is the API response, with the
+    feed items (posts) under ``items``."""
+    def fetch(max_id):
+        if max_id is None:
+            return client.collection_feed(collection_pk)
+        return client.collection_feed(collection_pk, max_id=max_id)
+    return iter_pages(fetch, page_delay)
+
+
+def iter_collection_feed(client, collection_pk, page_delay=DEFAULT_PAGE_DELAY):
+    """Yield the feed items (posts) of the collection with primary key
+    ``collection_pk``, newest first. Items can be passed straight to
+    `InstagramDb.save_posts`."""
+    for page in iter_collection_pages(client, collection_pk, page_delay):
+        for item in page.get('items', []):
+            yield item
+
+
+class UnsyncedPages(object):
+    """Iterate over the items of each page in ``pages`` (collection feed
+    pages, newest first) that haven't been synced yet, as lists, stopping
+    after the first page where ``unsynced`` returns fewer items than it was
+    given. ``unsynced`` takes a page's items and returns the leading ones
+    that haven't been synced, e.g. `InstagramDb.unsynced_items`. Once
+    iteration has started, ``newest`` is the ``media`` dict of the newest
+    post in the feed, to record as the sync cursor once the sync is done.
+    This is the incremental sync rule shared by every way of syncing."""
+
+    def __init__(self, pages, unsynced):
+        self.pages = pages
+        self.unsynced = unsynced
+        self.newest = None
+
+    def __iter__(self):
+        for page in self.pages:
+            items = page.get('items', [])
+            if self.newest is None and items:
+                self.newest = items[0]['media']
+            new = self.unsynced(items)
+            yield new
+            if len(new) < len(items):
+                return
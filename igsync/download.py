@@ -0,0 +1,424 @@
+# (c) Stefan Countryman 2018
+
+"""
+Download the media referenced by an `InstagramDb` to local storage using a
+bounded pool of worker threads sharing keep-alive connections.
+"""
+
+import os
+import json
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from urllib.error import HTTPError
+from .store import BlobStore
+from .pool import ConnectionPool, Http2Pool
+from .ratelimit import RateLimiter
+from . import retry, expiry
+
+USER_AGENT = "igsync"
+CHUNK_SIZE = 1 << 16
+CHECKPOINT_SIZE = 1 << 22
+PART_SUFFIX = ".part"
+OFFSET_SUFFIX = ".part.offset"
+
+
+def read_offset(path, url):
+    """Read the resume state for a partial download of ``url`` to ``path``
+    from its ``.part.offset`` sidecar file. Returns a dict with the ``offset``
+    to resume from (``0`` if there is nothing usable to resume) and the HTTP
+    ``validator`` (ETag or Last-Modified) of the partial content. Signed CDN
+    URLs change over time, so a partial download with a validator can be
+    resumed from a different URL; the server will send the whole file if the
+    validator no longer matches."""
+    try:
+        with open(path + OFFSET_SUFFIX) as sidecar:
+            state = json.load(sidecar)
+        if (state['validator'] or state['url'] == url) and \
+                os.path.getsize(path + PART_SUFFIX) >= state['offset']:
+            state['url'] = url
+            return state
+    except (OSError, ValueError, KeyError):
+        pass
+    return dict(url=url, offset=0, validator=None)
+
+
+def write_offset(path, state):
+    """Atomically replace the ``.part.offset`` sidecar file for a partial
+    download to ``path`` with ``state`` as returned by ``read_offset``."""
+    tmp = path + OFFSET_SUFFIX + '.tmp'
+    with open(tmp, 'w') as sidecar:
+        json.dump(state, sidecar)
+    os.replace(tmp, path + OFFSET_SUFFIX)
+
+
+def clear_offset(path):
+    """Remove the ``.part.offset`` sidecar file for ``path``, if any."""
+    try:
+        os.remove(path + OFFSET_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def stream_to(response, outfile, path, state):
+    """Copy the body of ``response`` to ``outfile`` in ``CHUNK_SIZE`` pieces,
+    fsyncing and recording progress in ``state`` (and the sidecar file for
+    ``path``) every ``CHECKPOINT_SIZE`` bytes. On return or error,
+    ``state['offset']`` counts every byte written to ``outfile``, including
+    any written since the last checkpoint that have not been fsynced yet."""
+    written = 0
+    try:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            outfile.write(chunk)
+            written += len(chunk)
+            if written >= CHECKPOINT_SIZE:
+                sync_file(outfile)
+                state['offset'] += written
+                written = 0
+                write_offset(path, state)
+    finally:
+        state['offset'] += written
+
+
+def resumed_offset(response, offset):
+    """Get the offset that the body of ``response`` starts at given that
+    bytes starting at ``offset`` were requested. A server that ignores the
+    Range header (or whose content changed, per If-Range) sends the whole file
+    with a 200 status, in which case the download starts over at ``0``."""
+    if response.status != 206:
+        return 0
+    content_range = response.headers.get('Content-Range', '')
+    start = content_range.replace('bytes', '').strip().split('-')[0]
+    if start != str(offset):
+        raise IOError("Unexpected Content-Range: " + content_range)
+    return offset
+
+
+def sync_file(fileobj):
+    """Flush ``fileobj`` all the way to disk."""
+    fileobj.flush()
+    os.fsync(fileobj.fileno())
+
+
+def sync_dir(dirname):
+    """Make a rename in ``dirname`` durable (where the platform allows)."""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+DownloadResults = namedtuple('DownloadResults', ('downloaded', 'failed'))
+Download = namedtuple('Download', ('path', 'blob'))
+
+
+class Downloader(object):
+    """Fetch the media URLs in an `InstagramDb` that have not yet been
+    downloaded, save them under ``media_root`` (at the paths given by
+    `InstagramDb.get_media_path` or in a content-addressed `BlobStore`), and
+    record the download paths in the database. With ``flat``, media is
+    saved directly under ``media_root`` as ``InstagramDb.get_media_name``
+    instead, the layout saveImages.php uses. Use as a context manager or
+    call ``close`` when done, to close the connections it opened."""
+
+    def __init__(self, db, media_root, workers=8, rate=None, per_host=4,
+                 batch_size=100, timeout=30, content_addressed=False,
+                 throttle=None, retries=retry.RETRIES, refresh=False,
+                 pool=None, pool_size=None, http2=False, record=True,
+                 flat=False):
+        """
+        Arguments
+        =========
+        db : `InstagramDb`
+            the database whose ``post_urls`` should be downloaded. It is only
+            ever accessed from the thread calling ``download``.
+        media_root : `string`
+            the directory under which media files will be saved.
+        workers : `int`, optional
+            the number of files to fetch concurrently.
+        rate : `float`, optional
+            a fixed maximum number of requests to start per second across all
+            workers, on top of the adaptive per-host limits of ``throttle``.
+            If ``None`` (default), there is no such overall limit.
+        per_host : `int`, optional
+            the maximum number of concurrent requests to a single host.
+        batch_size : `int`, optional
+            the number of completed downloads to record in the database per
+            transaction.
+        timeout : `float`, optional
+            socket timeout in seconds for each request.
+        content_addressed : `bool`, optional
+            if ``True``, store media in a `BlobStore` under ``media_root``
+            instead, so that identical files saved under different posts or
+            URLs are only stored (and, when the CDN's ETags match, fetched)
+            once.
+        throttle : `ratelimit.Throttle`, optional
+            the rate limiters whose per-host CDN budgets requests are made
+            within. Defaults to ``db.throttle``.
+        retries : `int`, optional
+            the number of times to retry each download right away after a
+            transient error (e.g. a timeout) before recording it as failed.
+        refresh : `bool`, optional
+            if ``True``, replace expired media URLs with fresh ones from
+            Instagram (using ``db.client``) before downloading them, and
+            retry downloads that fail because their URL has expired once
+            with a fresh URL; see `InstagramDb.refresh_urls`.
+        pool : `pool.ConnectionPool`, optional
+            the keep-alive connections to make requests over, shared by all
+            workers. Defaults to a new pool (an `pool.Http2Pool` if
+            ``http2``) keeping up to ``pool_size`` idle connections per host,
+            which ``close`` closes; a pool passed in is left to the caller
+            to close.
+        pool_size : `int`, optional
+            the number of idle connections per host to keep open for reuse.
+            Defaults to ``per_host``.
+        http2 : `bool`, optional
+            if ``True``, multiplex requests to each host over HTTP/2
+            connections (requires the ``httpx`` package with its ``http2``
+            extra).
+        record : `bool`, optional
+            if ``False``, don't record downloads or failures in the database,
+            e.g. when fetching previews from `InstagramDb.get_media_urls`.
+        flat : `bool`, optional
+            if ``True``, save files directly under ``media_root``, named by
+            `InstagramDb.get_media_name` like saveImages.php names them in
+            ``.ORIGINAL_MEDIA``, so that files it already downloaded are
+            recorded without being fetched again.
+        """
+        self.db = db
+        self.media_root = media_root
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.throttle = throttle or db.throttle
+        self.retries = retries
+        self.refresh = refresh
+        self.record = record
+        self.flat = flat
+        self._owns_pool = pool is None
+        if pool is None:
+            pool = (Http2Pool if http2 else ConnectionPool)(
+                per_host if pool_size is None else pool_size, timeout
+            )
+        self.pool = pool
+        self.per_host = per_host
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.store = BlobStore(media_root) if content_addressed else None
+        self.etags = dict()
+        self._host_slots = dict()
+        self._host_lock = threading.Lock()
+
+    def close(self):
+        """Close the connection pool, unless it was passed in."""
+        if self._owns_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def host_slot(self, url):
+        """Get the semaphore bounding concurrent requests to ``url``'s host."""
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(
+                    self.per_host
+                )
+            return self._host_slots[host]
+
+    def fetch(self, urlinfo):
+        """Download a single ``UrlInfo`` row. Returns a ``Download`` with the
+        path it was saved to relative to ``media_root`` and, if
+        ``content_addressed``, the ``Blob`` holding it.
+
+        Files are saved at their ``InstagramDb.get_media_path`` (or, if
+        ``flat``, ``get_media_name``) under ``media_root``; a file already
+        there is not fetched again. In the
+        content-addressed layout, downloads are staged under the same
+        relative path in the store's incoming directory and then moved into
+        the store, and if the CDN's ETag for the URL matches that of a known
+        blob (checked with a HEAD request) the bytes aren't fetched at all.
+        """
+        if self.flat:
+            relpath = self.db.get_media_name(urlinfo)
+        else:
+            relpath = self.db.get_media_path(urlinfo)
+        if self.store is None:
+            path = os.path.join(self.media_root, relpath)
+            if os.path.isfile(path):
+                return Download(relpath, None)
+            self.transfer(urlinfo, path)
+            os.replace(path + PART_SUFFIX, path)
+            clear_offset(path)
+            sync_dir(os.path.dirname(path))
+            return Download(relpath, None)
+        blob = self.known_blob(urlinfo)
+        if blob is None:
+            path = self.store.incoming_path(relpath)
+            etag = self.transfer(urlinfo, path)
+            blob = self.store.add(path + PART_SUFFIX, etag)
+            clear_offset(path)
+            if etag:
+                self.etags[etag] = blob
+        return Download(self.store.blob_path(blob.hash), blob)
+
+    def known_blob(self, urlinfo):
+        """Ask the CDN for the ETag of ``urlinfo.url`` with a HEAD request and
+        return the known ``Blob`` with that ETag, if any."""
+        if not self.etags:
+            return None
+        with self.host_slot(urlinfo.url), \
+                self.throttle.host(urlinfo.url).request():
+            self.limiter.wait()
+            with self.pool.request('HEAD', urlinfo.url,
+                                   {'User-Agent': USER_AGENT}) as response:
+                return self.etags.get(response.headers.get('ETag'))
+
+    def transfer(self, urlinfo, path):
+        """Fetch ``urlinfo.url`` into a complete, fsynced ``.part`` file
+        beside ``path``, returning the response's ETag.
+
+        The response is streamed in ``CHUNK_SIZE`` pieces. Every
+        ``CHECKPOINT_SIZE`` bytes the number of durably written bytes is
+        recorded in a ``.part.offset`` sidecar; if a later attempt finds a
+        partial download, it asks the server for just the remainder with an
+        HTTP Range request. The caller moves the ``.part`` file into place
+        atomically once it's complete, so a file at the final path is always
+        a whole download."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + PART_SUFFIX
+        state = read_offset(path, urlinfo.url)
+        headers = {'User-Agent': USER_AGENT}
+        if state['offset']:
+            headers['Range'] = 'bytes={}-'.format(state['offset'])
+            if state['validator']:
+                headers['If-Range'] = state['validator']
+        with self.host_slot(urlinfo.url), \
+                self.throttle.host(urlinfo.url).request():
+            self.limiter.wait()
+            try:
+                response = self.pool.request('GET', urlinfo.url, headers)
+            except HTTPError as err:
+                if err.code == 416:
+                    # our partial file doesn't match the remote; start over
+                    clear_offset(path)
+                raise
+            with response:
+                offset = resumed_offset(response, state['offset'])
+                etag = response.headers.get('ETag')
+                state = dict(url=urlinfo.url, offset=offset,
+                             validator=(etag or
+                                        response.headers.get('Last-Modified')))
+                length = response.headers.get('Content-Length')
+                with open(part, 'r+b' if offset else 'wb') as outfile:
+                    outfile.seek(offset)
+                    outfile.truncate()
+                    try:
+                        stream_to(response, outfile, path, state)
+                        if length is not None and \
+                                state['offset'] - offset != int(length):
+                            raise IOError("Incomplete read: got {} of {} "
+                                          "bytes".format(state['offset'] -
+                                                         offset, length))
+                    except BaseException:
+                        # keep what we have so the next attempt can resume
+                        sync_file(outfile)
+                        write_offset(path, state)
+                        raise
+                    sync_file(outfile)
+        return etag
+
+    def fetch_retrying(self, urlinfo):
+        """``fetch`` ``urlinfo``, retrying up to ``retries`` times after
+        transient errors (see `retry.call`)."""
+        return retry.call(self.fetch, urlinfo, retries=self.retries)
+
+    def download(self, urlinfos=None):
+        """Download each ``UrlInfo`` in ``urlinfos`` (default: all rows
+        returned by ``db.get_undownloaded_urls()``, which skips rows waiting
+        out a backoff after earlier failures), recording successful downloads
+        and failures in the database in batches of ``batch_size``. Failed
+        downloads are logged and left pending, to be retried by a later run
+        once their backoff has passed (see `InstagramDb.record_failures`).
+        If ``refresh`` is set, expired URLs are refreshed first (when
+        downloading all rows) and downloads that fail because their URL has
+        expired are retried with fresh URLs. Returns a ``DownloadResults``
+        tuple of lists of ``(urlinfo, download)`` pairs and ``(urlinfo,
+        error)`` pairs."""
+        if urlinfos is None:
+            if self.refresh:
+                self.db.refresh_stale_urls()
+            urlinfos = self.db.get_undownloaded_urls()
+        results = self.download_pass(urlinfos)
+        if not self.refresh:
+            return results
+        expired = {info.post_pk for info, err in results.failed
+                   if expiry.is_expired_error(err)}
+        if not expired or not self.db.refresh_urls(expired):
+            return results
+        retried = self.download_pass(self.db.get_undownloaded_urls(expired))
+        return DownloadResults(
+            results.downloaded + retried.downloaded,
+            [(info, err) for info, err in results.failed
+             if info.post_pk not in expired] + retried.failed
+        )
+
+    def download_pass(self, urlinfos):
+        """Download each ``UrlInfo`` in ``urlinfos`` once, as described in
+        ``download``, without refreshing URLs."""
+        if self.store is not None:
+            self.etags = self.db.get_blob_etags()
+        urlinfos = iter(urlinfos)
+        downloaded = []
+        failed = []
+        pending = dict()
+        batch = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                # keep a bounded number of requests in flight so that huge
+                # backlogs don't turn into huge lists of futures
+                for urlinfo in urlinfos:
+                    pending[executor.submit(self.fetch_retrying,
+                                            urlinfo)] = urlinfo
+                    if len(pending) >= 4*self.workers:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    urlinfo = pending.pop(future)
+                    try:
+                        download = future.result()
+                    except Exception as err:
+                        logging.warning("Failed to download %s: %s",
+                                        urlinfo.url, err)
+                        errors.append((urlinfo, err))
+                        continue
+                    batch.append((urlinfo, download))
+                if len(batch) + len(errors) >= self.batch_size:
+                    self._record(batch, errors)
+                    downloaded += batch
+                    failed += errors
+                    batch = []
+                    errors = []
+        self._record(batch, errors)
+        return DownloadResults(downloaded + batch, failed + errors)
+
+    def _record(self, downloaded, failed):
+        """Record a batch of downloads and failures in the database, unless
+        ``record`` is ``False``."""
+        if self.record:
+            self.db.record_downloads(downloaded, commit=False)
+            self.db.record_failures(failed)
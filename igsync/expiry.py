@@ -0,0 +1,62 @@
+# (c) Stefan Countryman 2018
+
+"""
+Detect expired media URLs. The CDN URLs in the API's media info are signed
+and stop working (the CDN answers 403) some time after they're fetched, so
+by the time a backlog of old saves is downloaded many of them are stale.
+The expiry time is part of the URL, as a hexadecimal Unix time: in the
+``oe`` query parameter of current URLs, or the path segment after the
+signature in older ``/vp/<signature>/<expiry>/...`` URLs. Stale URLs are
+replaced with fresh ones by `InstagramDb.refresh_urls`.
+"""
+
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+from urllib.error import HTTPError
+
+EXPIRED_STATUS = frozenset((403, 410))
+EXPIRY_MARGIN = 10*60  # treat URLs expiring this soon (seconds) as expired
+# how `retry.describe` records the errors in ``post_urls.last_error``
+EXPIRED_ERRORS = tuple("HTTPError: HTTP Error {}:".format(code)
+                       for code in sorted(EXPIRED_STATUS))
+VP_PATH = re.compile(r'/vp/[0-9a-f]+/([0-9A-Fa-f]{8})/')
+
+
+def url_expiry(url):
+    """Get the Unix time at which the signed CDN ``url`` expires, or
+    ``None`` if it doesn't say."""
+    parsed = urlparse(url)
+    expiry = parse_qs(parsed.query).get('oe')
+    if expiry:
+        value = expiry[0]
+    else:
+        match = VP_PATH.search(parsed.path)
+        if match is None:
+            return None
+        value = match.group(1)
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+
+def is_expired(url, now=None, margin=EXPIRY_MARGIN):
+    """Check whether ``url`` has expired, or will within ``margin`` seconds
+    of ``now`` (default: the current time)."""
+    expiry = url_expiry(url)
+    if expiry is None:
+        return False
+    return expiry <= (time.time() if now is None else now) + margin
+
+
+def is_expired_error(err):
+    """Check whether the download error ``err`` is what the CDN answers for
+    an expired URL."""
+    return isinstance(err, HTTPError) and err.code in EXPIRED_STATUS
+
+
+def describes_expiry(last_error):
+    """Check whether ``last_error``, as recorded in ``post_urls`` by
+    `InstagramDb.record_failures`, is an ``is_expired_error``."""
+    return last_error is not None and last_error.startswith(EXPIRED_ERRORS)
@@ -0,0 +1,203 @@
+# (c) Stefan Countryman 2018
+
+"""
+Bulk import the ``.JSON`` dump directory written by ``saveImages.php``,
+which holds one ``<code>.json`` feed item per post, into an `InstagramDb`.
+
+Files are listed with a streaming ``os.scandir``, in directory order, and
+imported ``batch_size`` at a time as they are found. A pool of worker
+processes reads and parses each batch and turns every post into `PostRows`
+already encoded for the database, so all that's left to the single writer
+(the process calling `JsonImporter.run`) is inserting rows with
+`InstagramDb.save_post_rows`.
+Each batch is committed along with the names of its files, so an
+interrupted import (or one run again once ``saveImages.php`` has added more
+files) only loads the files that haven't made it into the database yet,
+whatever their names; the listing is checked against the recorded names a
+chunk at a time, so neither the listing nor the names are ever held in
+memory in full.
+"""
+
+import os
+import time
+import logging
+from functools import partial
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from . import codec, post_rows, MAX_PARAMS
+
+SUFFIX = '.json'
+DEFAULT_BATCH_SIZE = 1000
+REPORT_INTERVAL = 10.0  # seconds between progress reports
+
+
+def iter_json_files(directory, imported=None, chunk_size=MAX_PARAMS):
+    """Lazily iterate over the names of the ``.json`` files in ``directory``
+    in directory order. If given, ``imported`` is called with lists of up to
+    ``chunk_size`` names and returns the set of those to skip."""
+    with os.scandir(directory) as entries:
+        names = (entry.name for entry in entries
+                 if entry.name.lower().endswith(SUFFIX) and entry.is_file())
+        while True:
+            chunk = list(islice(names, chunk_size))
+            if not chunk:
+                return
+            skip = imported(chunk) if imported is not None else ()
+            for name in chunk:
+                if name not in skip:
+                    yield name
+
+
+def bounded_map(executor, func, iterable, window):
+    """Like ``executor.map``, but only submit the next item once fewer than
+    ``window`` results are waiting, so that results don't pile up in memory
+    when whoever consumes them falls behind."""
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+class Loader(object):
+    """Load dump files from ``directory`` as ``PostRows`` whose posts are
+    parsed with ``decoder`` and encoded with ``post_codec`` and
+    ``dictionary`` (see `codec`). Instances are picklable, so that batches
+    can be loaded in worker processes."""
+
+    def __init__(self, directory, decoder='json', post_codec='json',
+                 dictionary=None):
+        self.directory = directory
+        self.decoder = decoder
+        self.post_codec = post_codec
+        self.dictionary = dictionary
+
+    def load(self, name, loads):
+        """Load the ``PostRows`` of the dump file ``name``."""
+        with open(os.path.join(self.directory, name), 'rb') as infile:
+            post = loads(infile.read())
+        return post_rows(post, codec.encode_post(post, self.post_codec,
+                                                 self.dictionary))
+
+    def __call__(self, names):
+        """Load the files ``names``. Returns a list of ``(name, rows,
+        error)``, where ``rows`` is ``None`` and ``error`` describes what
+        went wrong if a file couldn't be loaded."""
+        loads = codec.get_decoder(self.decoder).loads
+        results = []
+        for name in names:
+            try:
+                results.append((name, self.load(name, loads), None))
+            except (OSError, ValueError, LookupError, TypeError) as err:
+                results.append((name, None, "{}: {}".format(
+                    type(err).__name__, err)))
+        return results
+
+
+class JsonImporter(object):
+    """Import the dump files in ``directory`` into the `InstagramDb` ``db``.
+
+    Arguments
+    =========
+    db : `InstagramDb`
+        the database to import into; only used from the calling thread.
+    directory : `string`
+        the dump directory, e.g. ``<collections dir>/.JSON``.
+    workers : `int`, optional
+        the number of processes parsing files. Defaults to the number of
+        CPUs; with ``0``, files are parsed by the calling thread.
+    batch_size : `int`, optional
+        the number of files to load per task and commit at a time.
+    restart : `bool`, optional
+        load every file, including those imported by earlier runs.
+    overwrite : `bool`, optional
+        replace posts that are already saved. By default they are skipped,
+        since the dump usually holds older copies of posts synced since.
+    """
+
+    def __init__(self, db, directory, workers=None,
+                 batch_size=DEFAULT_BATCH_SIZE, restart=False,
+                 overwrite=False):
+        self.db = db
+        self.directory = directory
+        self.workers = os.cpu_count() if workers is None else workers
+        self.batch_size = batch_size
+        self.restart = restart
+        self.overwrite = overwrite
+        self.saved = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def saved_pks(self, pks):
+        """Get the set of primary keys in ``pks`` of posts that are already
+        saved."""
+        saved = set()
+        for i in range(0, len(pks), MAX_PARAMS):
+            chunk = pks[i:i+MAX_PARAMS]
+            saved.update(pk for pk, in self.db.cursor.execute(
+                "SELECT pk FROM posts WHERE pk IN ({})".format(
+                    ','.join('?'*len(chunk))), chunk))
+        return saved
+
+    def save(self, results):
+        """Save a batch of ``results`` from a ``Loader`` and record which
+        files were imported, committing both at once. Files that failed to
+        load are tried again by the next run."""
+        rows = []
+        files = []
+        for name, row, error in results:
+            if row is None:
+                logging.warning("Failed to import %s: %s", name, error)
+                self.failed += 1
+            else:
+                rows.append(row)
+                files.append((name, row.post[0]))
+        if not self.overwrite:
+            saved = self.saved_pks([row.post[0] for row in rows])
+            self.skipped += len(saved)
+            rows = [row for row in rows if row.post[0] not in saved]
+        self.db.save_post_rows(rows, self.batch_size, commit=False)
+        self.saved += len(rows)
+        self.db.save_imported_files(self.directory, files)
+
+    def run(self):
+        """Import every file in ``directory`` that hasn't been imported yet,
+        logging progress every ``REPORT_INTERVAL`` seconds. Returns the
+        number of posts saved."""
+        imported = None
+        if not self.restart:
+            imported = partial(self.db.get_imported_files, self.directory)
+        names = iter_json_files(self.directory, imported)
+        logging.info("Importing files from %s", self.directory)
+        loader = Loader(self.directory, self.db.decoder.name,
+                        self.db.post_codec, self.db.post_dictionary)
+        batches = iter(lambda: list(islice(names, self.batch_size)), [])
+        start = reported = time.monotonic()
+        done = 0
+        executor = None
+        if self.workers > 0:
+            executor = ProcessPoolExecutor(self.workers)
+            results = bounded_map(executor, loader, batches, 2*self.workers)
+        else:
+            results = map(loader, batches)
+        try:
+            for batch in results:
+                self.save(batch)
+                done += len(batch)
+                if time.monotonic() - reported >= REPORT_INTERVAL:
+                    reported = time.monotonic()
+                    self.report(done, reported - start)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        self.report(done, time.monotonic() - start)
+        return self.saved
+
+    def report(self, done, elapsed):
+        """Log progress after ``done`` files in ``elapsed`` seconds."""
+        logging.info("Imported %d files (%.1f/s): %d posts saved, %d already "
+                     "saved, %d failed", done, done/max(elapsed, 1e-9),
+                     self.saved, self.skipped, self.failed)
@@ -0,0 +1,77 @@
+# (c) Stefan Countryman 2018
+
+"""
+Extract media links from the ``media`` dicts returned by Instagram's API.
+
+Each image and video comes in several renditions (``candidates`` and
+``video_versions``) whose order the API doesn't promise, so a `LinkPolicy`
+says which one to pick: the largest (``ORIGINAL``, what gets archived), or
+the largest that fits a size cap, e.g. a small cover image for fast
+previews (``PREVIEW``). Links are extracted from posts that have already
+been parsed, a whole batch at a time with ``iter_links``.
+"""
+
+from collections import namedtuple
+
+MEDIA_TYPES = dict(image=1, video=2, carousel=8)
+Link = namedtuple('Link', ('url', 'media_type', 'height', 'width'))
+LinkPolicy = namedtuple('LinkPolicy', ('max_side', 'video'))
+LinkPolicy.__doc__ = """How to choose among the renditions of a media item.
+``max_side`` is the largest width or height (in pixels) to pick, or
+``None`` for the largest available rendition; if every rendition is larger,
+the smallest is picked. If ``video`` is ``False``, videos are represented by
+their cover image."""
+ORIGINAL = LinkPolicy(max_side=None, video=True)
+PREVIEW = LinkPolicy(max_side=320, video=False)
+
+
+def best_candidate(candidates, max_side=None):
+    """Pick the rendition with the most pixels from ``candidates`` (dicts
+    with ``width`` and ``height``) whose sides are at most ``max_side``, or
+    the smallest one if none are. Ties go to the first listed."""
+    best = smallest = None
+    best_area = -1
+    smallest_area = None
+    for candidate in candidates:
+        width, height = candidate['width'], candidate['height']
+        area = width*height
+        if smallest_area is None or area < smallest_area:
+            smallest, smallest_area = candidate, area
+        if max_side is not None and max(width, height) > max_side:
+            continue
+        if area > best_area:
+            best, best_area = candidate, area
+    return smallest if best is None else best
+
+
+def item_link(media, policy=ORIGINAL):
+    """Get the ``Link`` to the rendition of the image or video ``media`` (not
+    a carousel) chosen by ``policy``."""
+    media_type = media['media_type']
+    if media_type == 2 and policy.video:
+        choice = best_candidate(media['video_versions'], policy.max_side)
+    elif media_type in (1, 2):
+        choice = best_candidate(media['image_versions2']['candidates'],
+                                policy.max_side)
+        media_type = 1
+    else:
+        raise ValueError("Unrecognized media_type: " + str(media_type))
+    return Link(choice['url'], media_type, choice['height'], choice['width'])
+
+
+def media_links(media, policy=ORIGINAL):
+    """Get a list of ``Link`` tuples for each image or video in the (parsed)
+    ``media`` dict of a post, choosing renditions by ``policy``."""
+    if media['media_type'] == 8:
+        return [item_link(item, policy) for item in media['carousel_media']]
+    return [item_link(media, policy)]
+
+
+def iter_links(medias, policy=ORIGINAL):
+    """Yield ``(post_pk, index, link)`` for each image or video in each of
+    the (parsed) ``media`` dicts in ``medias``, choosing renditions by
+    ``policy``."""
+    for media in medias:
+        pk = str(media['pk'])
+        for index, link in enumerate(media_links(media, policy)):
+            yield pk, index, link
@@ -0,0 +1,259 @@
+# (c) Stefan Countryman 2018
+
+"""
+Versioned schema migrations for `InstagramDb`. The schema version of a
+database is stored in SQLite's ``PRAGMA user_version``; each migration in
+``MIGRATIONS`` brings a database from the previous version up to its own.
+
+Migrations are applied in place. They must be idempotent, since databases
+created before versioning start at version ``0`` and may already have some of
+the changes. Large tables are rebuilt with ``copy_table``, which copies rows
+in chunks (committing between chunks, so other connections can keep using the
+database in WAL mode) while triggers mirror concurrent writes into the copy.
+"""
+
+import logging
+from collections import namedtuple
+
+Migration = namedtuple('Migration', ('version', 'description', 'apply'))
+MIGRATIONS = []
+DEFAULT_BATCH_SIZE = 50000
+
+
+def migration(version, description):
+    """Register the decorated function as the migration to schema
+    ``version``. It will be called with the `InstagramDb` to migrate and the
+    batch size to use when copying tables."""
+    def decorator(func):
+        assert not MIGRATIONS or MIGRATIONS[-1].version == version - 1
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+    return decorator
+
+
+def latest_version():
+    """The schema version that ``migrate`` brings databases up to."""
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+def get_version(cursor):
+    """Get the schema version of the database."""
+    return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_version(cursor, version):
+    """Set the schema version of the database."""
+    cursor.execute("PRAGMA user_version = {:d}".format(version))
+
+
+def table_exists(cursor, table):
+    """Check whether ``table`` exists in the database."""
+    return cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table,)
+    ).fetchone() is not None
+
+
+def columns(cursor, table):
+    """Get a dict mapping the names of the columns of ``table`` to their
+    declared types."""
+    return {row[1]: row[2].lower() for row in
+            cursor.execute("PRAGMA table_info({})".format(table))}
+
+
+def add_column(cursor, table, column, definition):
+    """Add ``column`` to ``table`` (``definition`` being its type and
+    constraints) unless it is already there."""
+    if column not in columns(cursor, table):
+        cursor.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+            table, column, definition))
+
+
+def copy_table(db, table, definition, batch_size=DEFAULT_BATCH_SIZE):
+    """Rebuild ``table`` with a new ``CREATE TABLE`` statement,
+    ``definition``, keeping the values of every column the old and new tables
+    have in common (SQLite converts them to the new column types).
+
+    Rows are copied ``batch_size`` at a time in ``rowid`` order, committing
+    after each chunk and recording progress in the ``migration_progress``
+    table, so an interrupted copy resumes where it left off. Triggers mirror
+    writes made to ``table`` during the copy. Finally, ``table`` is replaced
+    by the copy in one short transaction. Indexes on ``table`` are dropped
+    with it and must be recreated by the caller."""
+    cursor = db.cursor
+    tmp = table + '_migrating'
+    create = definition.replace(' {} ('.format(table), ' {} ('.format(tmp), 1)
+    assert create != definition, "definition must create " + table
+    cursor.execute(create)
+    cursor.execute("CREATE TABLE IF NOT EXISTS migration_progress "
+                   "(name text PRIMARY KEY, last_rowid integer NOT NULL)")
+    shared = [c for c in columns(cursor, tmp) if c in columns(cursor, table)]
+    cols = ', '.join(shared)
+    new = ', '.join('NEW.' + c for c in shared)
+    cursor.executescript("""
+        CREATE TRIGGER IF NOT EXISTS {tmp}_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT OR REPLACE INTO {tmp} (rowid, {cols})
+                VALUES (NEW.rowid, {new});
+        END;
+        CREATE TRIGGER IF NOT EXISTS {tmp}_update AFTER UPDATE ON {table}
+        BEGIN
+            DELETE FROM {tmp} WHERE rowid = OLD.rowid;
+            INSERT OR REPLACE INTO {tmp} (rowid, {cols})
+                VALUES (NEW.rowid, {new});
+        END;
+        CREATE TRIGGER IF NOT EXISTS {tmp}_delete AFTER DELETE ON {table}
+        BEGIN
+            DELETE FROM {tmp} WHERE rowid = OLD.rowid;
+        END;
+    """.format(tmp=tmp, table=table, cols=cols, new=new))
+    row = cursor.execute("SELECT last_rowid FROM migration_progress "
+                         "WHERE name = ?", (tmp,)).fetchone()
+    last = row[0] if row else 0
+    while True:
+        end = cursor.execute(
+            "SELECT max(rowid) FROM (SELECT rowid FROM {} WHERE rowid > ? "
+            "ORDER BY rowid LIMIT ?)".format(table), (last, batch_size)
+        ).fetchone()[0]
+        if end is None:
+            break
+        cursor.execute(
+            "INSERT OR REPLACE INTO {tmp} (rowid, {cols}) "
+            "SELECT rowid, {cols} FROM {table} "
+            "WHERE rowid > ? AND rowid <= ?".format(tmp=tmp, cols=cols,
+                                                   table=table),
+            (last, end)
+        )
+        cursor.execute("INSERT OR REPLACE INTO migration_progress "
+                       "VALUES (?, ?)", (tmp, end))
+        db.connection.commit()
+        logging.info("Migrating %s: copied rows up to rowid %d", table, end)
+        last = end
+    db.connection.commit()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("DROP TABLE {}".format(table))
+    cursor.execute("ALTER TABLE {} RENAME TO {}".format(tmp, table))
+    cursor.execute("DELETE FROM migration_progress WHERE name = ?", (tmp,))
+    db.connection.commit()
+
+
+def migrate(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Apply every migration newer than the current schema version of ``db``
+    in order, committing and bumping the version after each one. Returns the
+    new schema version."""
+    cursor = db.cursor
+    version = get_version(cursor)
+    for step in MIGRATIONS:
+        if step.version <= version:
+            continue
+        logging.info("Migrating database to version %d: %s", step.version,
+                     step.description)
+        step.apply(db, batch_size)
+        set_version(cursor, step.version)
+        db.connection.commit()
+        version = step.version
+    return version
+
+
+# Each migration spells out the tables and indexes it creates as they were at
+# its version, rather than using `InstagramDb`'s current definitions, so that
+# later schema changes can't change what an old migration does.
+
+
+@migration(1, "add indexes for download polling and collection queries")
+def add_indexes(db, batch_size):
+    db.cursor.executescript("""
+        CREATE INDEX IF NOT EXISTS post_urls_pending
+            ON post_urls (post_pk) WHERE download_path IS NULL;
+        CREATE INDEX IF NOT EXISTS collection_relations_collection
+            ON collection_relations (collection_pk, post_pk);
+        CREATE INDEX IF NOT EXISTS posts_user ON posts (user_pk);
+        CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at);
+    """)
+
+
+@migration(2, "store posts.user_pk as text to match users.pk")
+def text_user_pk(db, batch_size):
+    if columns(db.cursor, 'posts')['user_pk'] != 'text':
+        copy_table(db, 'posts', """
+            CREATE TABLE IF NOT EXISTS posts (
+                pk                          text    PRIMARY KEY,
+                code                        text    NOT NULL,
+                taken_at                    integer NOT NULL,
+                media_type                  integer NOT NULL,
+                comment_likes_enabled       integer NOT NULL,
+                comment_threading_enabled   integer NOT NULL,
+                has_more_comments           integer NOT NULL,
+                user_pk                     text    NOT NULL,
+                photo_of_you                integer NOT NULL,
+                caption_text                text    NOT NULL,
+                post_json                   text    NOT NULL,
+                like_count                  integer NOT NULL,
+                has_viewer_saved            integer NOT NULL,
+                FOREIGN KEY (user_pk) REFERENCES users (pk)
+                    ON DELETE CASCADE ON UPDATE NO ACTION
+            );
+        """, batch_size)
+        add_indexes(db, batch_size)
+
+
+@migration(3, "add post_urls.blob_hash for the content-addressed media store")
+def add_blob_hash(db, batch_size):
+    add_column(db.cursor, 'post_urls', 'blob_hash', 'text')
+    db.cursor.executescript("""
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            hash                        text    PRIMARY KEY,
+            size                        integer NOT NULL,
+            etag                        text,
+            refcount                    integer NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS post_urls_blob
+            ON post_urls (blob_hash) WHERE blob_hash IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS media_blobs_etag
+            ON media_blobs (etag) WHERE etag IS NOT NULL;
+    """)
+
+
+@migration(4, "add post_urls columns tracking failed download attempts")
+def add_failure_tracking(db, batch_size):
+    add_column(db.cursor, 'post_urls', 'attempts',
+               'integer NOT NULL DEFAULT 0')
+    add_column(db.cursor, 'post_urls', 'last_error', 'text')
+    add_column(db.cursor, 'post_urls', 'next_attempt_at', 'integer')
+
+
+@migration(5, "index posts and collections by (taken_at, pk) for paging")
+def add_keyset_indexes(db, batch_size):
+    cursor = db.cursor
+    add_column(cursor, 'collection_relations', 'taken_at', 'integer')
+    db.connection.commit()
+    # backfill batch_size rows per transaction; rows already filled in are
+    # skipped, so an interrupted backfill picks up where it left off
+    last = 0
+    while True:
+        end = cursor.execute(
+            "SELECT max(rowid) FROM (SELECT rowid FROM collection_relations "
+            "WHERE rowid > ? ORDER BY rowid LIMIT ?)", (last, batch_size)
+        ).fetchone()[0]
+        if end is None:
+            break
+        cursor.execute(
+            "UPDATE collection_relations SET taken_at = (SELECT taken_at "
+            "FROM posts WHERE posts.pk = collection_relations.post_pk) "
+            "WHERE taken_at IS NULL AND rowid > ? AND rowid <= ?",
+            (last, end)
+        )
+        db.connection.commit()
+        logging.info("Migrating collection_relations: filled in taken_at "
+                     "up to rowid %d", end)
+        last = end
+    # widen the (user_pk) and (taken_at) indexes into keysets
+    cursor.executescript("""
+        DROP INDEX IF EXISTS posts_user;
+        DROP INDEX IF EXISTS posts_taken_at;
+        CREATE INDEX IF NOT EXISTS posts_user
+            ON posts (user_pk, taken_at, pk);
+        CREATE INDEX IF NOT EXISTS posts_taken_at ON posts (taken_at, pk);
+        CREATE INDEX IF NOT EXISTS collection_relations_keyset
+            ON collection_relations (collection_pk, taken_at, post_pk);
+    """)
@@ -0,0 +1,429 @@
+# (c) Stefan Countryman 2018
+
+"""
+Sync collections as a pipeline of concurrent stages connected by bounded
+queues, so that crawling, saving and downloading overlap instead of running
+one after another:
+
+- ``crawl``: threads page through collection feeds with the API client and
+  queue each page of posts;
+- ``ingest``: a single writer (the thread calling `Pipeline.run`, the only
+  one that touches the database) saves queued pages in batches with
+  `InstagramDb.save_posts`, queues their undownloaded media, and records
+  finished downloads;
+- ``download``: threads fetch queued media with a `Downloader`;
+- ``link``: a thread links downloaded media into collection directories.
+
+Because the queues are bounded, a slow stage applies backpressure to the
+stages feeding it (e.g. when downloads fall behind, crawling pauses) instead
+of letting work pile up in memory. `Pipeline.stats` reports each stage's
+queue depth and throughput.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple, Counter
+from . import crawler
+from .download import Downloader
+from .store import link_media
+
+STAGES = ('crawl', 'ingest', 'download', 'link')
+POLL_INTERVAL = 0.05
+DONE = object()  # end-of-stream marker
+StageStats = namedtuple('StageStats', ('workers', 'queue_depth', 'processed',
+                                       'failed', 'per_second'))
+
+
+class Stopped(Exception):
+    """Raised in a stage's thread when the pipeline is shutting down."""
+
+
+class Stage(object):
+    """The input queue and counters of one stage of a `Pipeline`. A
+    ``maxsize`` of 0 makes the queue unbounded."""
+
+    def __init__(self, name, workers, maxsize):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.processed = 0
+        self.failed = 0
+        self.started = None
+        self._lock = threading.Lock()
+
+    def count(self, processed=1, failed=0):
+        """Count items that this stage has finished with."""
+        with self._lock:
+            self.processed += processed
+            self.failed += failed
+
+    def stats(self):
+        """Get a ``StageStats`` snapshot of this stage."""
+        with self._lock:
+            processed, failed = self.processed, self.failed
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return StageStats(self.workers, self.queue.qsize(), processed, failed,
+                          processed/elapsed if elapsed else 0.0)
+
+
+class Pipeline(object):
+    """Sync collections into an `InstagramDb` and download their media
+    concurrently. Stages are described in the module docstring. Use as a
+    context manager or call ``close`` when done, to close the downloader's
+    connections."""
+
+    def __init__(self, db, media_root, crawl_workers=1, download_workers=8,
+                 queue_size=64, batch_size=500, full=False,
+                 page_delay=crawler.DEFAULT_PAGE_DELAY, collection_dirs=None,
+                 link='hard', report_interval=None, **downloader_kwargs):
+        """
+        Arguments
+        =========
+        db : `InstagramDb`
+            the database to sync into. Only accessed from the thread calling
+            ``run``; its ``client`` is shared by the crawl threads.
+        media_root : `string`
+            the directory under which media files will be saved.
+        crawl_workers : `int`, optional
+            the number of collections to crawl concurrently.
+        download_workers : `int`, optional
+            the number of files to fetch concurrently. If 0, media isn't
+            downloaded, leaving it pending in the database, and only the
+            ``crawl`` and ``ingest`` stages run.
+        queue_size : `int`, optional
+            the capacity of each stage's input queue (pages for ``ingest``,
+            files for ``download`` and ``link``).
+        batch_size : `int`, optional
+            the maximum number of posts to save, or of finished downloads to
+            record, per transaction.
+        full : `bool`, optional
+            if ``True``, page through every post in each collection instead
+            of stopping at the newest post saved by the last sync.
+        page_delay : `tuple`, optional
+            the range of seconds to wait between feed pages, on top of the
+            pacing by the database's ``throttle``.
+        collection_dirs : `dict`, optional
+            maps collection primary keys to directories that downloaded media
+            in those collections are linked into. If not given, the ``link``
+            stage doesn't run.
+        link : `string`, optional
+            ``"hard"`` (default) or ``"symlink"``; see `link_media`.
+        report_interval : `float`, optional
+            if given, log ``stats`` every this many seconds.
+        **downloader_kwargs
+            passed on to `Downloader` (e.g. ``rate`` or
+            ``content_addressed``).
+        """
+        self.db = db
+        self.media_root = media_root
+        self.batch_size = batch_size
+        self.full = full
+        self.page_delay = page_delay
+        self.collection_dirs = collection_dirs or dict()
+        self.link = link
+        self.report_interval = report_interval
+        self.downloader = Downloader(db, media_root,
+                                     workers=download_workers,
+                                     batch_size=batch_size,
+                                     **downloader_kwargs)
+        self.stages = dict(
+            crawl=Stage('crawl', crawl_workers, 0),
+            ingest=Stage('ingest', 1, queue_size),
+            download=Stage('download', download_workers, queue_size),
+            link=Stage('link', 1 if collection_dirs else 0, queue_size),
+        )
+        self._results = queue.Queue()  # bounded by the download queue
+        self._stopping = threading.Event()
+        self._in_flight = set()
+        self._finished = []
+        self._failed = []
+        self.saved = Counter()  # posts saved per collection
+        self._states = dict()  # SyncState of each collection being synced
+
+    def close(self):
+        """Close the `Downloader`'s connections."""
+        self.downloader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        """Return a dict mapping each stage's name to a ``StageStats`` tuple
+        of its number of worker threads, current queue depth, number of items
+        processed and failed, and items processed per second."""
+        return {name: self.stages[name].stats() for name in STAGES}
+
+    def report(self):
+        """Log the current ``stats``."""
+        for name, stats in self.stats().items():
+            logging.info("%s: %d workers, %d queued, %d done (%.1f/s), "
+                         "%d failed", name, stats.workers, stats.queue_depth,
+                         stats.processed, stats.per_second, stats.failed)
+
+    def put(self, stage, item):
+        """Put ``item`` on the queue of ``stage``, blocking while it's full
+        unless the pipeline is stopping, in which case raise ``Stopped``."""
+        while True:
+            try:
+                return self.stages[stage].queue.put(item,
+                                                    timeout=POLL_INTERVAL)
+            except queue.Full:
+                if self._stopping.is_set():
+                    raise Stopped()
+
+    def get(self, stage):
+        """Get the next item from the queue of ``stage``. Returns ``DONE``
+        once the pipeline is stopping."""
+        while not self._stopping.is_set():
+            try:
+                return self.stages[stage].queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def run(self, collection_pks=None):
+        """Sync the collections with primary keys in ``collection_pks``
+        (default: all of the user's collections, whose names are saved too)
+        and download their media, returning once every stage has finished.
+        Media already pending download in the database before the run is not
+        included; use `Downloader.download` for that. Returns ``stats``; the
+        number of posts saved from each collection is left in ``saved``."""
+        if collection_pks is None:
+            collection_pks = list(self.db.sync_collection_list())
+        for collection_pk in collection_pks:
+            self._states[str(collection_pk)] = None if self.full else \
+                self.db.get_sync_state(collection_pk)
+            self.stages['crawl'].queue.put(str(collection_pk))
+        if self.downloader.store is not None:
+            self.downloader.etags = self.db.get_blob_etags()
+        client = self.db.client
+        threads = [threading.Thread(target=self._crawl, args=(client,))
+                   for _ in range(self.stages['crawl'].workers)]
+        threads += [threading.Thread(target=self._download)
+                    for _ in range(self.stages['download'].workers)]
+        threads += [threading.Thread(target=self._link)
+                    for _ in range(self.stages['link'].workers)]
+        for stage in self.stages.values():
+            stage.started = time.monotonic()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._ingest()
+        except BaseException:
+            self._stopping.set()
+            raise
+        finally:
+            if not self._stopping.is_set():
+                for name in ('download', 'link'):
+                    for _ in range(self.stages[name].workers):
+                        self.stages[name].queue.put(DONE)
+            for thread in threads:
+                thread.join()
+        return self.stats()
+
+    def _crawl(self, client):
+        """Crawl stage: page through each queued collection's feed, putting
+        ``(collection_pk, items, reply)`` pages on the ingest queue followed
+        by ``(collection_pk, newest)`` once a collection is done."""
+        stage = self.stages['crawl']
+        try:
+            while not self._stopping.is_set():
+                try:
+                    collection_pk = stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self._crawl_collection(client, collection_pk)
+                    stage.count()
+                except Stopped:
+                    raise
+                except Exception as err:
+                    logging.warning("Failed to crawl collection %s: %s",
+                                    collection_pk, err)
+                    stage.count(0, 1)
+            self.put('ingest', DONE)
+        except Stopped:
+            pass
+
+    def _crawl_collection(self, client, collection_pk):
+        """Queue the pages of one collection that haven't been synced yet.
+        In an incremental sync, each page is checked by the writer (with
+        `InstagramDb.unsynced_items`), which sends back the number of new
+        items on ``reply``, before the next page is fetched."""
+        state = self._states.get(collection_pk)
+
+        def unsynced(items):
+            if not items:
+                return items
+            if state is None:
+                self.put('ingest', (collection_pk, items, None))
+                return items
+            reply = queue.Queue(1)
+            self.put('ingest', (collection_pk, items, reply))
+            while True:
+                try:
+                    return items[:reply.get(timeout=POLL_INTERVAL)]
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        raise Stopped()
+
+        pages = crawler.UnsyncedPages(
+            crawler.iter_collection_pages(client, collection_pk,
+                                          self.page_delay),
+            unsynced
+        )
+        for _ in pages:
+            pass
+        self.put('ingest', (collection_pk, pages.newest))
+
+    def _ingest(self):
+        """Ingest stage, run by the single writer: save queued pages, queue
+        their media for download, and record finished downloads, until every
+        crawler is done and no downloads are left in flight."""
+        stage = self.stages['ingest']
+        crawlers = self.stages['crawl'].workers
+        last_report = time.monotonic()
+        while crawlers or self._in_flight:
+            self._collect_results()
+            if (self.report_interval and time.monotonic() - last_report >
+                    self.report_interval):
+                self.report()
+                last_report = time.monotonic()
+            try:
+                message = stage.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                self._record_downloads()
+                continue
+            # greedily batch consecutive pages into one transaction
+            pages = []
+            count = 0
+            while isinstance(message, tuple) and len(message) == 3:
+                pages.append(message)
+                count += len(message[1])
+                if count >= self.batch_size:
+                    message = None
+                    break
+                try:
+                    message = stage.queue.get_nowait()
+                except queue.Empty:
+                    message = None
+            if pages:
+                self._save_pages(pages)
+            if message is DONE:
+                crawlers -= 1
+            elif message is not None:
+                collection_pk, newest = message
+                if newest is not None:
+                    self.db.save_sync_state(collection_pk, newest)
+        self._record_downloads()
+
+    def _save_pages(self, pages):
+        """Save the new items of ``pages`` of posts in one transaction, tell
+        the crawlers waiting on a ``reply`` how many there were, and queue
+        their undownloaded media."""
+        rows = []
+        replies = []
+        for collection_pk, items, reply in pages:
+            if reply is not None:
+                items = self.db.unsynced_items(
+                    collection_pk, self._states[collection_pk], items)
+                replies.append((reply, len(items)))
+            rows += items
+            self.saved[collection_pk] += len(items)
+        self.db.save_posts(rows, batch_size=self.batch_size)
+        for reply, count in replies:
+            reply.put(count)
+        self.stages['ingest'].count(len(rows))
+        if not self.stages['download'].workers:
+            return
+        post_pks = {str(item['media']['pk']) for item in rows}
+        for urlinfo in self.db.get_undownloaded_urls(post_pks):
+            if urlinfo in self._in_flight:
+                continue
+            self._in_flight.add(urlinfo)
+            # keep draining results while waiting so downloads never block
+            while True:
+                try:
+                    self.stages['download'].queue.put(urlinfo,
+                                                      timeout=POLL_INTERVAL)
+                    break
+                except queue.Full:
+                    self._collect_results()
+
+    def _collect_results(self):
+        """Gather finished and failed downloads, recording them once there
+        are ``batch_size`` of them."""
+        while True:
+            try:
+                urlinfo, download, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self._in_flight.discard(urlinfo)
+            if download is None:
+                self._failed.append((urlinfo, error))
+            else:
+                self._finished.append((urlinfo, download))
+            if len(self._finished) + len(self._failed) >= self.batch_size:
+                self._record_downloads()
+
+    def _record_downloads(self):
+        """Record finished and failed downloads in the database and queue
+        the finished ones for linking into collection directories."""
+        if not self._finished and not self._failed:
+            return
+        finished, self._finished = self._finished, []
+        failed, self._failed = self._failed, []
+        self.db.record_downloads(finished, commit=False)
+        self.db.record_failures(failed)
+        if not self.collection_dirs:
+            return
+        for urlinfo, download in finished:
+            name = self.db.get_media_name(urlinfo)
+            for collection_pk in self.db.get_post_collections(
+                    urlinfo.post_pk):
+                dest = self.collection_dirs.get(collection_pk)
+                if dest is not None:
+                    self.stages['link'].queue.put((download.path, dest, name))
+
+    def _download(self):
+        """Download stage: fetch queued media."""
+        stage = self.stages['download']
+        while True:
+            urlinfo = self.get('download')
+            if urlinfo is DONE:
+                return
+            try:
+                download = self.downloader.fetch_retrying(urlinfo)
+                error = None
+                stage.count()
+            except Exception as err:
+                logging.warning("Failed to download %s: %s", urlinfo.url, err)
+                download = None
+                error = err
+                stage.count(0, 1)
+            self._results.put((urlinfo, download, error))
+
+    def _link(self):
+        """Link stage: link downloaded media into collection directories."""
+        stage = self.stages['link']
+        while True:
+            task = self.get('link')
+            if task is DONE:
+                return
+            download_path, dest, name = task
+            try:
+                os.makedirs(dest, exist_ok=True)
+                link_media(self.media_root, download_path,
+                           os.path.join(dest, name), self.link)
+                stage.count()
+            except OSError as err:
+                logging.warning("Failed to link %s into %s: %s", name, dest,
+                                err)
+                stage.count(0, 1)
@@ -0,0 +1,242 @@
+# (c) Stefan Countryman 2018
+
+"""
+Pooled, keep-alive HTTP(S) connections for media downloads. Opening a fresh
+TCP connection and TLS session per file dominates the time it takes to fetch
+small images, so connections to each CDN host are kept open and reused by
+whichever download worker needs one next.
+
+`ConnectionPool` uses the standard library's ``http.client`` (HTTP/1.1).
+`Http2Pool` multiplexes requests over HTTP/2 connections instead, and
+requires the ``httpx`` package with its ``http2`` extra. Both return
+responses that can be used like those of ``urllib.request.urlopen`` and raise
+``urllib.error.HTTPError`` for error statuses.
+"""
+
+import ssl
+import threading
+from http import client as httpclient
+from urllib.parse import urlparse, urljoin
+from urllib.error import HTTPError
+
+DEFAULT_SIZE = 4
+MAX_REDIRECTS = 5
+REDIRECTS = frozenset((301, 302, 303, 307, 308))
+
+
+def httpx():
+    """Import the optional ``httpx`` package."""
+    try:
+        import httpx as _httpx
+        import h2  # noqa: F401 pylint: disable=unused-import
+    except ImportError:
+        raise ValueError("HTTP/2 requires the httpx package with the http2 "
+                         "extra (pip install 'httpx[http2]').")
+    return _httpx
+
+
+class PooledResponse(object):
+    """A response from a `ConnectionPool`. Closing it (e.g. by leaving a
+    ``with`` block) returns its connection to the pool if the body was read
+    to the end without errors and the server allows the connection to be
+    reused; otherwise the connection is closed."""
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.failed = False
+
+    def read(self, amt=None):
+        try:
+            return self.response.read(amt)
+        except BaseException:
+            self.failed = True
+            raise
+
+    def close(self):
+        if self.connection is None:
+            return
+        response = self.response
+        if response.length == 0 and not response.isclosed():
+            response.read()  # e.g. HEAD responses; marks the body consumed
+        reusable = (response.isclosed() and not response.will_close and
+                    not self.failed)
+        response.close()
+        self.pool.release(self.key, self.connection if reusable else None)
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP and HTTPS connections, shared by any number of
+    threads. Up to ``size`` idle connections per host are kept for reuse (a
+    ``size`` of 0 disables reuse); ``timeout`` is the socket timeout in
+    seconds and ``context`` the ``ssl.SSLContext`` for HTTPS connections
+    (default: ``ssl.create_default_context()``)."""
+
+    def __init__(self, size=DEFAULT_SIZE, timeout=30, context=None):
+        self.size = size
+        self.timeout = timeout
+        self.context = context or ssl.create_default_context()
+        self._idle = dict()
+        self._lock = threading.Lock()
+
+    def connect(self, key):
+        """Open a new connection for ``key``, a ``(scheme, netloc)``
+        pair."""
+        scheme, netloc = key
+        if scheme == 'https':
+            return httpclient.HTTPSConnection(netloc, timeout=self.timeout,
+                                              context=self.context)
+        if scheme == 'http':
+            return httpclient.HTTPConnection(netloc, timeout=self.timeout)
+        raise ValueError("Unsupported URL scheme: " + scheme)
+
+    def acquire(self, key):
+        """Get an idle connection for ``key`` or open a new one. Returns the
+        connection and whether it was reused."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    def release(self, key, connection):
+        """Return ``connection`` to the pool, or, if it's ``None``, note that
+        a connection for ``key`` was discarded."""
+        if connection is None:
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, method, url, headers=None):
+        """Make an HTTP request, following redirects, and return a
+        `PooledResponse` for a success status. Raises ``HTTPError`` for error
+        statuses. A request that fails on a reused connection (which the
+        server may have closed in the meantime) is retried on another one,
+        and finally on a fresh connection."""
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self.send(method, url, headers or dict())
+            if response.status in REDIRECTS and \
+                    response.headers.get('Location'):
+                response.read()
+                response.close()
+                url = urljoin(url, response.headers['Location'])
+                continue
+            if response.status >= 400:
+                response.read()
+                response.close()
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+            return response
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.headers, None)
+
+    def send(self, method, url, headers):
+        """Send a single request and return a `PooledResponse`."""
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            connection, reused = self.acquire(key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except (ConnectionError, httpclient.BadStatusLine):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            return PooledResponse(self, key, connection, response)
+
+
+class StreamedResponse(object):
+    """Adapt a streamed ``httpx.Response`` to the file-like interface of
+    ``urllib`` responses."""
+
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = response.headers
+        self._chunks = response.iter_raw()
+        self._buffer = b''
+
+    def read(self, amt=None):
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if amt is None:
+            amt = len(self._buffer)
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Http2Pool(object):
+    """A drop-in replacement for `ConnectionPool` that multiplexes concurrent
+    requests to each host over HTTP/2 (falling back to HTTP/1.1 for servers
+    that don't support it) using ``httpx``."""
+
+    def __init__(self, size=DEFAULT_SIZE, timeout=30, context=None):
+        _httpx = httpx()
+        self.client = _httpx.Client(
+            http2=True, timeout=timeout, verify=context or True,
+            follow_redirects=True,
+            limits=_httpx.Limits(max_keepalive_connections=size)
+        )
+
+    def close(self):
+        """Close all connections."""
+        self.client.close()
+
+    def request(self, method, url, headers=None):
+        """Make an HTTP request and return a streamed response for a success
+        status. Raises ``HTTPError`` for error statuses."""
+        response = self.client.send(
+            self.client.build_request(method, url, headers=headers),
+            stream=True
+        )
+        if response.status_code >= 400:
+            response.read()
+            response.close()
+            raise HTTPError(url, response.status_code, response.reason_phrase,
+                            response.headers, None)
+        return StreamedResponse(response)
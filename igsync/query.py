@@ -0,0 +1,123 @@
+# (c) Stefan Countryman 2018
+
+"""
+Read-only queries over the posts in an `InstagramDb`, for services (like a
+gallery) that page through large collections. Rows are returned as compact
+``PostRow`` tuples from lazy iterators that fetch them ``fetch_size`` at a
+time, so a 100k-post collection never has to fit in memory.
+
+Posts are ordered newest first by the keyset ``(taken_at, pk)``. Instead of
+an ``OFFSET``, which makes SQLite step over every skipped row, a page starts
+after the ``Key`` of the last post of the previous one; with the
+``posts_taken_at``, ``posts_user`` and ``collection_relations_keyset``
+indexes every page is a short index range scan, however deep it is.
+"""
+
+from collections import namedtuple
+from .media import MEDIA_TYPES
+
+FETCH_SIZE = 500
+PostRow = namedtuple('PostRow', ('pk', 'code', 'taken_at', 'media_type',
+                                 'user_pk', 'caption_text', 'like_count'))
+Key = namedtuple('Key', ('taken_at', 'pk'))
+Page = namedtuple('Page', ('posts', 'next'))
+
+
+def key(post):
+    """Get the ``Key`` of the ``PostRow`` ``post``, to pass as ``after`` to
+    get the posts that follow it."""
+    return Key(post.taken_at, post.pk)
+
+
+def posts_query(collection_pk=None, user_pk=None, since=None, until=None,
+                media_type=None, after=None, limit=None):
+    """Build the SQL query and parameters for ``iter_posts``."""
+    if collection_pk is not None:
+        # page through the collection's own keyset index, only looking up
+        # the posts that are returned
+        taken_at, pk = 'r.taken_at', 'r.post_pk'
+        sql = ("SELECT p.pk, p.code, p.taken_at, p.media_type, p.user_pk, "
+               "p.caption_text, p.like_count FROM collection_relations AS r "
+               "JOIN posts AS p ON p.pk = r.post_pk")
+        where, params = ["r.collection_pk = ?"], [str(collection_pk)]
+    else:
+        taken_at, pk = 'p.taken_at', 'p.pk'
+        sql = ("SELECT p.pk, p.code, p.taken_at, p.media_type, p.user_pk, "
+               "p.caption_text, p.like_count FROM posts AS p")
+        where, params = [], []
+    if user_pk is not None:
+        where.append("p.user_pk = ?")
+        params.append(str(user_pk))
+    if media_type is not None:
+        where.append("p.media_type = ?")
+        params.append(MEDIA_TYPES.get(media_type, media_type))
+    if since is not None:
+        where.append(taken_at + " >= ?")
+        params.append(int(since))
+    if until is not None:
+        where.append(taken_at + " < ?")
+        params.append(int(until))
+    if after is not None:
+        where.append("({}, {}) < (?, ?)".format(taken_at, pk))
+        params.extend((int(after[0]), str(after[1])))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY {0} DESC, {1} DESC".format(taken_at, pk)
+    if limit is not None:
+        sql += " LIMIT {:d}".format(limit)
+    return sql, params
+
+
+def iter_posts(connection, collection_pk=None, user_pk=None, since=None,
+               until=None, media_type=None, after=None, limit=None,
+               fetch_size=FETCH_SIZE):
+    """Lazily iterate over ``PostRow`` tuples for the posts in the database
+    open on ``connection``, newest first, fetching ``fetch_size`` rows at a
+    time.
+
+    Arguments
+    =========
+    collection_pk : `string`, optional
+        only include posts in this collection.
+    user_pk : `string`, optional
+        only include posts by this user.
+    since : `int`, optional
+        only include posts taken at or after this Unix time.
+    until : `int`, optional
+        only include posts taken before this Unix time.
+    media_type : `int` or `string`, optional
+        only include posts of this media type, either as the API's code or
+        as a key of ``MEDIA_TYPES`` (``"image"``, ``"video"`` or
+        ``"carousel"``).
+    after : `Key`, optional
+        start after the post with this ``Key`` (see ``key``).
+    limit : `int`, optional
+        return at most this many posts.
+    fetch_size : `int`, optional
+        how many rows to fetch from SQLite at a time.
+    """
+    sql, params = posts_query(collection_pk, user_pk, since, until,
+                              media_type, after, limit)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield PostRow(*row)
+    finally:
+        cursor.close()
+
+
+def page_posts(connection, limit, after=None, **filters):
+    """Get a ``Page`` of up to ``limit`` posts following the post with
+    ``Key`` ``after`` (default: from the newest), filtered as for
+    ``iter_posts``. ``Page.next`` is the ``after`` to pass to get the next
+    page, or ``None`` if this is the last one."""
+    posts = list(iter_posts(connection, after=after, limit=limit+1,
+                            fetch_size=limit+1, **filters))
+    if len(posts) > limit:
+        return Page(posts[:limit], key(posts[limit-1]))
+    return Page(posts, None)
@@ -0,0 +1,184 @@
+# (c) Stefan Countryman 2018
+
+"""
+Adaptive rate limiting for every request igsync makes. Each budget is a
+token bucket whose refill rate follows AIMD (additive increase,
+multiplicative decrease): every clean response nudges the rate up towards
+its maximum, and every throttling response (HTTP 429, a 5xx, or a dropped
+connection) halves it and empties the bucket, honoring ``Retry-After`` when
+the server sends one.
+
+A `Throttle` holds one budget for the private API and one per CDN host, so
+that we can stay well within Instagram's API limits while saturating the
+CDN, which tolerates far more traffic.
+"""
+
+import time
+import socket
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from urllib.error import URLError, HTTPError
+
+# start at one API call every 4 seconds, the old fixed delay between pages
+API_BUDGET = dict(rate=0.25, burst=1, min_rate=0.05, max_rate=1.0,
+                  increase=0.01)
+CDN_BUDGET = dict(rate=10.0, burst=10, min_rate=0.5, max_rate=100.0,
+                  increase=0.5)
+DECREASE_COOLDOWN = 1.0  # ignore further throttling for this many seconds
+
+
+def is_throttling(err):
+    """Check whether the exception ``err`` means that we should slow down:
+    an HTTP 429 or 5xx response (from the API client or ``urllib``), or a
+    failed or timed out connection."""
+    from instagram_private_api import errors
+    if isinstance(err, (errors.ClientThrottledError,
+                        errors.ClientConnectionError)):
+        return True
+    code = getattr(err, 'code', None)
+    if isinstance(err, (HTTPError, errors.ClientError)):
+        return isinstance(code, int) and (code == 429 or code >= 500)
+    return isinstance(err, (URLError, ConnectionError, socket.timeout))
+
+
+def retry_after(err):
+    """Get the number of seconds the server asked us to wait in the
+    ``Retry-After`` header of the HTTP error ``err``, if any."""
+    headers = getattr(err, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket allowing bursts of up to ``burst`` requests
+    and refilling at ``rate`` requests per second. A ``rate`` of ``None``
+    disables limiting.
+
+    ``success`` raises the rate by ``increase`` (up to ``max_rate``) and
+    ``throttled`` multiplies it by ``decrease`` (down to ``min_rate``). Both
+    bounds default to ``rate``, i.e. a fixed rate."""
+
+    def __init__(self, rate=None, burst=1, min_rate=None, max_rate=None,
+                 increase=0.0, decrease=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = rate if min_rate is None else min_rate
+        self.max_rate = rate if max_rate is None else max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()  # in the future while paused
+        self._last_decrease = None
+
+    def wait(self):
+        """Block until the caller is allowed to make its next request."""
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now > self._updated:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated)*self.rate)
+                self._updated = now
+            # reserve a token, going into debt if there are none left
+            self._tokens -= 1
+            delay = self._updated - now + max(0.0, -self._tokens)/self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def success(self):
+        """Record a clean response."""
+        if self.rate is None:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, delay=None):
+        """Record a throttling response, pausing for ``delay`` seconds if
+        given (e.g. from a ``Retry-After`` header). A burst of throttling
+        responses (e.g. from concurrent requests) only slows down once."""
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if (self._last_decrease is None or
+                    now - self._last_decrease > DECREASE_COOLDOWN):
+                self.rate = max(self.min_rate, self.rate*self.decrease)
+                self._last_decrease = now
+            self._tokens = min(self._tokens, 0.0)
+            if delay:
+                self._updated = max(self._updated, now + delay)
+
+    @contextmanager
+    def request(self):
+        """Wait for a token, then record the outcome of the request made in
+        the ``with`` block: ``throttled`` if it raises an exception for which
+        ``is_throttling`` is true, ``success`` if it doesn't raise."""
+        self.wait()
+        try:
+            yield self
+        except Exception as err:
+            if is_throttling(err):
+                self.throttled(retry_after(err))
+            raise
+        self.success()
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` with the given arguments as a rate-limited
+        ``request``."""
+        with self.request():
+            return func(*args, **kwargs)
+
+
+class Throttle(object):
+    """The rate limiters shared by all requests to Instagram: ``api`` for the
+    private API and one per CDN host (see ``host``). ``api`` and ``cdn`` are
+    dicts of `RateLimiter` arguments; pass ``None`` to disable limiting."""
+
+    def __init__(self, api=API_BUDGET, cdn=CDN_BUDGET):
+        self.api = RateLimiter(**(api or dict()))
+        self.cdn = cdn or dict()
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def with_api(self, api=API_BUDGET):
+        """Get a ``Throttle`` with its own API budget, ``api``, that shares
+        this one's CDN budgets, e.g. for another account."""
+        throttle = Throttle(api, self.cdn)
+        throttle._hosts = self._hosts
+        throttle._lock = self._lock
+        return throttle
+
+    def host(self, url):
+        """Get the rate limiter for requests to ``url``'s host."""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = RateLimiter(**self.cdn)
+            return self._hosts[host]
+
+
+class ThrottledClient(object):
+    """Wrap an Instagram API ``client`` so that each of its method calls is
+    made through the `RateLimiter` ``limiter``. Other attributes are passed
+    through unchanged."""
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def throttled(*args, **kwargs):
+            return self.limiter.call(attr, *args, **kwargs)
+        return throttled
@@ -0,0 +1,89 @@
+# (c) Stefan Countryman 2018
+
+"""
+Retry failed requests with jittered exponential backoff. Errors are
+classified as permanent (e.g. a 403 or 404 from the CDN, which is what an
+expired signed media URL gets, so retrying the same URL is pointless) or
+transient (timeouts, dropped connections, throttling, server errors).
+
+Transient errors are retried a few times in-process by `call`. Downloads
+that still fail are recorded in ``post_urls`` by
+`InstagramDb.record_failures` along with the time after which they may be
+tried again, computed with `backoff`, so that later runs skip them until
+then; permanently failed URLs and URLs that have failed too many times are
+not tried again at all until they are reset.
+"""
+
+import time
+import random
+import logging
+from urllib.error import HTTPError
+from .ratelimit import is_throttling
+
+PERMANENT_STATUS = frozenset((400, 401, 403, 404, 410))
+RETRIES = 2  # in-process retries of transient errors
+RETRY_DELAY = 1.0  # base delay in seconds between in-process retries
+BACKOFF_BASE = 15*60  # base delay in seconds before a failed URL is retried
+BACKOFF_CAP = 7*24*3600
+MAX_ATTEMPTS = 10
+NEVER = 2**63 - 1  # ``next_attempt_at`` of URLs not to be retried
+
+
+def is_permanent(err):
+    """Check whether the exception ``err`` means that repeating the request
+    can't succeed: an HTTP 400, 401, 403, 404 or 410 response (from
+    ``urllib`` or the API client)."""
+    from instagram_private_api import errors
+    if isinstance(err, (HTTPError, errors.ClientError)):
+        return getattr(err, 'code', None) in PERMANENT_STATUS
+    return False
+
+
+def is_transient(err):
+    """Check whether the exception ``err`` is worth retrying soon: a
+    throttling response, server error, timeout or other network error."""
+    from http.client import HTTPException
+    if is_permanent(err):
+        return False
+    return is_throttling(err) or isinstance(err, (OSError, HTTPException))
+
+
+def backoff(attempts, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Get the number of seconds to wait before trying again after
+    ``attempts`` consecutive failures: ``base*2**(attempts-1)`` capped at
+    ``cap``, of which the second half is random ("equal jitter") so that
+    items that failed together don't all come back at once."""
+    delay = min(cap, base*2**max(attempts-1, 0))
+    return delay/2 + random.uniform(0, delay/2)
+
+
+def next_attempt_at(err, attempts, now=None, max_attempts=MAX_ATTEMPTS):
+    """Get the Unix time after which a request that has now failed
+    ``attempts`` times, most recently with ``err``, may be tried again.
+    Returns ``NEVER`` if ``err`` is permanent or ``attempts`` has reached
+    ``max_attempts``."""
+    if is_permanent(err) or attempts >= max_attempts:
+        return NEVER
+    return int((time.time() if now is None else now) + backoff(attempts))
+
+
+def describe(err):
+    """Describe ``err`` for the ``post_urls.last_error`` column."""
+    return "{}: {}".format(type(err).__name__, err)
+
+
+def call(func, *args, retries=RETRIES, delay=RETRY_DELAY, **kwargs):
+    """Call ``func`` with the given arguments, retrying up to ``retries``
+    times after transient errors (see ``is_transient``) with jittered
+    exponential backoff starting at ``delay`` seconds. Other errors, and the
+    last transient one, are raised."""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            if attempt == retries or not is_transient(err):
+                raise
+            wait = backoff(attempt + 1, base=delay)
+            logging.info("Retrying in %.1fs after error: %s", wait,
+                         describe(err))
+            time.sleep(wait)
@@ -0,0 +1,195 @@
+# (c) Stefan Countryman 2018
+
+"""
+Cache logged in Instagram API sessions so that each run doesn't start with a
+full login. A full login is slow, uses up API budget and, done often enough,
+gets the account flagged for a security checkpoint.
+
+`SessionCache` keeps the settings of each account's client (device ids and
+session cookies) in a JSON file named after its username, along with when
+they were saved and when the session expires (the client's pickled cookie
+jar is stored base64-encoded). `Session` wraps an API client
+that is created from the cached settings without contacting Instagram; the
+session is only checked by the first real request, and the account only
+logs in again if that (or any later) request fails because the session is
+no longer valid.
+"""
+
+import os
+import json
+import base64
+import time
+import logging
+import threading
+from functools import wraps
+from urllib.parse import quote_plus
+
+SESSION_TTL = 30*24*60*60  # lifetime (s) of sessions without a cookie expiry
+AUTH_STATUS = frozenset((401,))
+
+
+def is_auth_error(err):
+    """Check whether the API client exception ``err`` means that the session
+    is no longer valid and we have to log in again."""
+    from instagram_private_api import errors
+    if isinstance(err, (errors.ClientLoginRequiredError,
+                        errors.ClientCookieExpiredError)):
+        return True
+    return isinstance(err, errors.ClientError) and err.code in AUTH_STATUS
+
+
+class SessionCache(object):
+    """Cache the settings of logged in API clients as JSON files in
+    ``directory``, one per username."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, username):
+        """Get the path of the file caching ``username``'s session."""
+        return os.path.join(self.directory, quote_plus(username) + '.json')
+
+    def load(self, username, now=None):
+        """Get the cached client settings of ``username``, or ``None`` if
+        there are none or the session has expired by ``now`` (default: the
+        current time)."""
+        try:
+            with open(self.path(username)) as infile:
+                cached = json.load(infile)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning("Could not read cached session of %s: %s",
+                            username, err)
+            return None
+        if cached.get('username') != username:
+            return None
+        if cached['expires'] <= (time.time() if now is None else now):
+            logging.info("Cached session of %s has expired.", username)
+            return None
+        settings = cached['settings']
+        if cached.get('cookie_encoding') == 'base64':
+            settings['cookie'] = base64.b64decode(settings['cookie'])
+        return settings
+
+    def save(self, username, client, now=None):
+        """Cache the settings of ``username``'s logged in API ``client``,
+        saved at ``now`` (default: the current time). Returns ``self`` to
+        allow for chained commands."""
+        now = int(time.time() if now is None else now)
+        expires = client.cookie_jar.auth_expires or now + SESSION_TTL
+        settings = dict(client.settings)
+        cached = dict(username=username, settings=settings, saved_at=now,
+                      expires=expires)
+        if isinstance(settings.get('cookie'), bytes):
+            settings['cookie'] = base64.b64encode(
+                settings['cookie']).decode('ascii')
+            cached['cookie_encoding'] = 'base64'
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(username)
+        # the settings include the session cookie, so keep them private, and
+        # replace the file atomically in case another process is reading it
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(cached, outfile)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return self
+
+    def discard(self, username):
+        """Remove ``username``'s cached session, if any. Returns ``self`` to
+        allow for chained commands."""
+        try:
+            os.remove(self.path(username))
+        except FileNotFoundError:
+            pass
+        return self
+
+
+class Session(object):
+    """An Instagram API client for ``username`` that reuses the session
+    cached in the `SessionCache` ``cache``. Attribute access is passed
+    through to the client, which is created on first use. A method call that
+    fails with an ``is_auth_error`` logs in again and is retried once.
+    ``client_class`` defaults to ``instagram_private_api.Client``.
+
+    A session can be shared by several threads: only one of them connects
+    or logs in, and when their requests fail together, the first to get to
+    it logs in again while the rest reuse its new client."""
+
+    def __init__(self, username, password, cache, client_class=None):
+        self.username = username
+        self.password = password
+        self.cache = cache
+        self.client_class = client_class
+        self.client = None
+        self.logins = 0  # number of full logins made
+        self._lock = threading.Lock()
+
+    def _client_class(self):
+        if self.client_class is None:
+            from instagram_private_api import Client
+            self.client_class = Client
+        return self.client_class
+
+    def connect(self):
+        """Create the client from the cached session if there is one, without
+        making any requests, and log in otherwise. Returns the client."""
+        with self._lock:
+            if self.client is None:
+                self._connect()
+            return self.client
+
+    def _connect(self):
+        settings = self.cache.load(self.username)
+        if settings is not None:
+            try:
+                self.client = self._client_class()(
+                    self.username, self.password, settings=settings)
+                return self.client
+            except Exception as err:
+                if not is_auth_error(err):
+                    raise
+        return self._login()
+
+    def login(self, failed=None):
+        """Log in from scratch and cache the new session. If the client
+        ``failed`` is given, only log in if it is still the current client,
+        i.e. no other thread has logged in again since it failed. Returns the
+        client."""
+        with self._lock:
+            if failed is None or self.client is failed:
+                self._login()
+            return self.client
+
+    def _login(self):
+        logging.info("Logging in to Instagram as %s.", self.username)
+        self.cache.discard(self.username)
+        self.client = self._client_class()(self.username, self.password)
+        self.logins += 1
+        self.cache.save(self.username, self.client)
+        return self.client
+
+    def __getattr__(self, name):
+        client = self.client
+        attr = getattr(self.connect() if client is None else client, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            client = self.client
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            except Exception as err:
+                if not is_auth_error(err):
+                    raise
+                logging.info("Session of %s is no longer valid: %s",
+                             self.username, err)
+            return getattr(self.login(client), name)(*args, **kwargs)
+        return call
@@ -0,0 +1,109 @@
+# (c) Stefan Countryman 2018
+
+"""
+A content-addressed media store. Each distinct file is stored once, named by
+the SHA-256 hash of its bytes, no matter how many posts (or collections, or
+CDN URLs) it appears under. The ``media_blobs`` table of an `InstagramDb`
+tracks each blob's size, HTTP ETag and the number of ``post_urls`` rows that
+reference it, and collection directories are materialized as links to the
+blobs.
+"""
+
+import os
+import hashlib
+from collections import namedtuple
+
+Blob = namedtuple('Blob', ('hash', 'size', 'etag'))
+BLOB_DIR = "blobs"
+INCOMING_DIR = "incoming"
+LINKS = ('hard', 'symlink')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Get the SHA-256 hex digest and size of the file at ``path``."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class BlobStore(object):
+    """Content-addressed blobs stored under ``media_root``. Paths returned
+    by this class are relative to ``media_root``."""
+
+    def __init__(self, media_root):
+        self.media_root = media_root
+
+    @staticmethod
+    def blob_path(blob_hash):
+        """Get the path of the blob with hash ``blob_hash``."""
+        return os.path.join(BLOB_DIR, blob_hash[:2], blob_hash[2:4],
+                            blob_hash)
+
+    def incoming_path(self, relpath):
+        """Get the absolute path that a download which would otherwise be
+        saved at ``relpath`` is staged at while it is in progress."""
+        return os.path.join(self.media_root, BLOB_DIR, INCOMING_DIR, relpath)
+
+    def add(self, path, etag=None):
+        """Move the completed download at ``path`` into the store (or just
+        delete it if the store already has a blob with the same contents).
+        Returns the ``Blob``."""
+        blob_hash, size = file_hash(path)
+        dest = os.path.join(self.media_root, self.blob_path(blob_hash))
+        if os.path.isfile(dest):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(path, dest)
+        return Blob(blob_hash, size, etag)
+
+    def collect_garbage(self, db, commit=True):
+        """Delete the blobs that no ``post_urls`` rows in ``db`` reference
+        from disk and from the ``media_blobs`` table. Returns the list of
+        hashes deleted."""
+        hashes = db.get_unreferenced_blobs()
+        for blob_hash in hashes:
+            try:
+                os.remove(os.path.join(self.media_root,
+                                       self.blob_path(blob_hash)))
+            except FileNotFoundError:
+                pass
+        db.delete_blobs(hashes, commit=commit)
+        return hashes
+
+
+def link_media(media_root, download_path, linkpath, link='hard'):
+    """Link ``linkpath`` to the media downloaded to ``download_path`` under
+    ``media_root`` with a hard link (default) or, if ``link`` is
+    ``"symlink"``, a symbolic link. Returns ``False`` without doing anything
+    if ``linkpath`` already exists, ``True`` otherwise."""
+    if link not in LINKS:
+        raise ValueError("link must be one of: " + ", ".join(LINKS))
+    if os.path.lexists(linkpath):
+        return False
+    target = os.path.join(media_root, download_path)
+    if link == 'hard':
+        os.link(target, linkpath)
+    else:
+        os.symlink(os.path.abspath(target), linkpath)
+    return True
+
+
+def materialize_collection(db, media_root, collection_pk, dest, link='hard'):
+    """Populate the directory ``dest`` with links to the downloaded media in
+    the collection with primary key ``collection_pk``, named by
+    `InstagramDb.get_media_name` (like saveImages.php names them). Works
+    with every layout under ``media_root``. ``link`` is ``"hard"`` (default) or
+    ``"symlink"``. Existing links are left alone. Returns the number of links
+    created."""
+    os.makedirs(dest, exist_ok=True)
+    created = 0
+    for urlinfo, download_path in db.get_collection_media(collection_pk):
+        name = db.get_media_name(urlinfo)
+        created += link_media(media_root, download_path,
+                              os.path.join(dest, name), link)
+    return created
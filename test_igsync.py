@@ -7,7 +7,19 @@ Tests for igsync
 
 import sys
 import os
-from tempfile import NamedTemporaryFile
+import asyncio
+import re
+import json
+import sqlite3
+import time
+import hashlib
+import threading
+import functools
+import subprocess
+import importlib.util
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 import igsync
 
 # example JSON
@@ -953,6 +965,175 @@ IMAGE_JSON = r"""{
         "organic_tracking_token": "eyJ2ZXJzaW9uIjo1LCJwYXlsb2FkIjp7ImlzX2FuYWx5dGljc190cmFja2VkIjp0cnVlLCJ1dWlkIjoiODExMDIxNGQ2NWMzNGFlYWFjY2JiNGY4NTQyMTE1ODUxMTE0ODM0NjExMTM2MDg1ODg1Iiwic2VydmVyX3Rva2VuIjoiMTUzNDk4NDUyMTE0OXwxMTE0ODM0NjExMTM2MDg1ODg1fDIwNjcyNzU3MnwyOTgwYTlmODQ3NzA2Y2FkNDkwZWIxMjk3MTYxYzM0Mzc5MjAzZmI2M2RjMWVjMWRkZjVhNDBlYWMyNGY2ZTVkIn0sInNpZ25hdHVyZSI6IiJ9"
     }
 }"""
+CDN_HOST = "https://scontent-iad3-1.cdninstagram.com"
+
+
+FRESH_EXPIRY = '7FFFFFFF'
+
+
+def cdn_bytes(path):
+    """The fake media served by the local CDN stand-in for ``path``."""
+    return hashlib.sha256(path.encode()).digest() * 1024
+
+
+class CdnHandler(BaseHTTPRequestHandler):
+    """Serve deterministic fake media for any path, like a tiny CDN. Honors
+    HEAD, Range and If-Range requests. If ``truncate`` is set, hangs up after
+    sending that many bytes of the body."""
+
+    requests = []
+    truncate = None
+
+    def body(self):
+        """The media served at this request's path."""
+        return cdn_bytes(self.path.split('?')[0])
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', self.path, None))
+        body = self.body()
+        self.send_response(200)
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(body).hexdigest()))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, self.headers.get('Range')))
+        body = self.body()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        start = 0
+        if self.headers.get('Range') and \
+                self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        end = None if self.truncate is None else start + self.truncate
+        self.wfile.write(body[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class RepostCdnHandler(CdnHandler):
+    """A CDN stand-in serving the same image at every URL."""
+
+    def body(self):
+        return cdn_bytes('/repost.jpg')
+
+
+class FlakyCdnHandler(CdnHandler):
+    """A CDN stand-in that drops every connection partway through."""
+
+    truncate = 10000
+
+
+class BrokenCdnHandler(CdnHandler):
+    """A CDN stand-in that has lost every video (404) and is overloaded
+    (503) for everything else."""
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, self.headers.get('Range')))
+        self.send_error(404 if '.mp4' in self.path else 503)
+
+
+class SignedCdnHandler(CdnHandler):
+    """A CDN stand-in that rejects (403) every URL not signed with an
+    expiry of ``FRESH_EXPIRY``."""
+
+    def do_GET(self):
+        if '/{}/'.format(FRESH_EXPIRY) not in self.path:
+            self.requests.append(('GET', self.path, None))
+            return self.send_error(403)
+        CdnHandler.do_GET(self)
+
+
+class KeepAliveCdnHandler(CdnHandler):
+    """A CDN stand-in that keeps connections open between requests and
+    counts the connections it accepts."""
+
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def setup(self):
+        self.connections.append(self.client_address)
+        CdnHandler.setup(self)
+
+
+@contextmanager
+def local_cdn(handler=CdnHandler):
+    """Run a local HTTP stand-in for the Instagram CDN in a background thread
+    and yield its base URL."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def feed_item(i, collection_pk='1000'):
+    """Make a distinct example feed item (post) from the example image post,
+    saved in the collection with primary key ``collection_pk``."""
+    post = json.loads(IMAGE_JSON)
+    post['media']['pk'] = str(10**18 + i)
+    post['media']['code'] = "item{}".format(i)
+    post['media']['saved_collection_ids'] = [collection_pk]
+    return post
+
+
+class FakeClient(object):
+    """Stand-in for the Instagram API client serving collection feeds from
+    ``feeds``, a dict mapping collection primary keys to lists of feed items
+    (newest first), ``page_size`` items per page, and media info from
+    ``media``, a dict mapping post primary keys to ``media`` dicts."""
+
+    def __init__(self, feeds, page_size=3, media=None):
+        self.feeds = feeds
+        self.page_size = page_size
+        self.media = media or dict()
+        self.calls = []
+
+    def list_collections(self):
+        self.calls.append(('list_collections',))
+        return dict(items=[dict(collection_id=pk, collection_name="c" + pk)
+                           for pk in self.feeds], more_available=False)
+
+    def collection_feed(self, collection_id, max_id=None):
+        self.calls.append(('collection_feed', collection_id, max_id))
+        start = int(max_id or 0)
+        end = start + self.page_size
+        items = self.feeds[collection_id]
+        return dict(items=items[start:end], more_available=end < len(items),
+                    next_max_id=str(end))
+
+    def medias_info(self, media_ids):
+        self.calls.append(('medias_info', list(media_ids)))
+        return dict(items=[self.media[pk] for pk in media_ids
+                           if pk in self.media])
+
+
+def new_db(cdn=None):
+    """Make a fresh database in a tempfile holding the example posts. If
+    ``cdn`` is given, point the saved media URLs at that base URL instead of
+    Instagram's CDN."""
+    tmp = NamedTemporaryFile(delete=False, suffix='.sqlite')
+    tmp.file.close()
+    db = igsync.InstagramDb(path=tmp.name, throttle=igsync.Throttle(
+        api=None, cdn=None)).inittables()
+    for post in (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON):
+        db.save_post(post)
+    if cdn is not None:
+        db.cursor.execute("UPDATE post_urls SET url = replace(url, ?, ?)",
+                          (CDN_HOST, cdn))
+        db.connection.commit()
+    return db
 
 
 def test_init_tables():
@@ -967,15 +1148,1055 @@ def test_save_post():
         DB.save_post(post)
 
 
+def test_content_addressed_download():
+    """Test that identical media is stored and fetched once in the
+    content-addressed layout, that collections are materialized as hard
+    links to the blobs, and that only unreferenced blobs are collected."""
+    with local_cdn(RepostCdnHandler) as cdn, \
+            TemporaryDirectory() as media_root:
+        db = new_db(cdn)
+        del CdnHandler.requests[:]
+        results = igsync.Downloader(db, media_root, workers=1,
+                                    content_addressed=True).download()
+        assert not results.failed
+        assert [r[0] for r in CdnHandler.requests].count('GET') == 1
+        assert len({d.path for _, d in results.downloaded}) == 1
+        assert db.cursor.execute("SELECT hash, refcount FROM media_blobs"
+                                 ).fetchall() == \
+            [(results.downloaded[0][1].blob.hash, 8)]
+        blob_path = os.path.join(media_root, results.downloaded[0][1].path)
+        collection = os.path.join(media_root, 'collection')
+        assert igsync.materialize_collection(
+            db, media_root, '17887886089047035', collection) == 6
+        for name in os.listdir(collection):
+            assert name.startswith('BWYRFq6gOv-.')
+            assert os.path.samefile(os.path.join(collection, name),
+                                    blob_path)
+        store = igsync.BlobStore(media_root)
+        assert store.collect_garbage(db) == []
+        db.cursor.execute("UPDATE post_urls SET blob_hash = NULL")
+        assert len(store.collect_garbage(db)) == 1
+        assert not os.path.exists(blob_path)
+
+
+def test_save_posts():
+    """Test that bulk-saving posts produces the same rows as saving them one
+    at a time, and that a failed bulk save only undoes its own rows, leaving
+    the rest of the caller's transaction alone unless it commits."""
+    db = new_db()
+    bulk = new_db()
+    bulk.cursor.execute("DELETE FROM posts")
+    bulk.cursor.execute("DELETE FROM post_urls")
+    bulk.cursor.execute("DELETE FROM collection_relations")
+    bulk.save_posts((p for p in (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON,
+                                 IMAGE_JSON)), batch_size=2)
+    for table in ('users', 'collections', 'posts', 'post_urls',
+                  'collection_relations'):
+        query = "SELECT * FROM {} ORDER BY 1, 2".format(table)
+        assert (db.cursor.execute(query).fetchall() ==
+                bulk.cursor.execute(query).fetchall())
+    post = json.loads(IMAGE_JSON)
+    post['media']['pk'] = '1'
+    rows = [igsync.post_rows(post, bulk.encode_post(post)), object()]
+    for collection_pk, commit in (('998', False), ('999', True)):
+        bulk.save_collection(collection_pk, overwrite=False, commit=False)
+        try:
+            bulk.save_post_rows(rows, batch_size=1, commit=commit)
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError("Saving a broken row didn't fail.")
+        assert bulk.get_post('1') is None
+        assert bulk.cursor.execute(
+            "SELECT count(*) FROM collections WHERE pk = ?",
+            (collection_pk,)).fetchone() == (0 if commit else 1,)
+        bulk.connection.commit()
+    bulk.save_post_rows(rows[:1], commit=False)
+    assert bulk.connection.in_transaction
+    bulk.connection.rollback()
+    assert bulk.get_post('1') is None
+
+
+def test_profiles():
+    """Test that performance profiles set their pragmas and that a readonly
+    connection can query the database while a WAL writer is mid-transaction
+    but can't write to it."""
+    path = new_db().path
+    writer = igsync.InstagramDb(path, profile='bulk',
+                                pragmas={'cache_size': -1024})
+    assert writer.cursor.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+    assert writer.cursor.execute("PRAGMA synchronous").fetchone() == (1,)
+    assert writer.cursor.execute("PRAGMA cache_size").fetchone() == (-1024,)
+    writer.cursor.execute("DELETE FROM posts")
+    reader = igsync.InstagramDb(path, profile='readonly')
+    assert reader.cursor.execute("SELECT count(*) FROM posts").fetchone() \
+        == (3,)
+    try:
+        reader.cursor.execute("DELETE FROM posts")
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError("readonly profile allowed a write")
+    writer.connection.rollback()
+
+
+def test_query_plans():
+    """Test that none of the queries used to poll for downloads or to list a
+    collection's posts do a full table scan."""
+    db = new_db()
+    queries = []
+    db.connection.set_trace_callback(queries.append)
+    db.get_undownloaded_posts()
+    db.get_undownloaded_urls()
+    db.get_collection_posts('17887886089047035')
+    db.connection.set_trace_callback(None)
+    assert len(queries) == 3
+    for query in queries:
+        for row in db.cursor.execute("EXPLAIN QUERY PLAN " + query):
+            detail = row[-1]
+            assert not detail.startswith('SCAN') or 'INDEX' in detail, \
+                "Full scan in {}: {}".format(query, detail)
+
+
+def test_migrate():
+    """Test that a database from before schema versioning is migrated in
+    place to the latest schema without losing any rows, and that the keyset
+    migration fills in collection_relations.taken_at in batches."""
+    db = new_db()
+    old_posts = db.TABLE_DEFINITIONS.POSTS.replace(
+        'user_pk                     text   ',
+        'user_pk                     integer'
+    )
+    assert old_posts != db.TABLE_DEFINITIONS.POSTS
+    igsync.migrations.copy_table(db, 'posts', old_posts)
+    igsync.migrations.set_version(db.cursor, 0)
+    query = "SELECT pk, user_pk, typeof(user_pk) FROM posts ORDER BY pk"
+    before = db.cursor.execute(query).fetchall()
+    assert {row[2] for row in before} == {'integer'}
+    igsync.InstagramDb(db.path).migrate(batch_size=2).inittables()
+    after = db.cursor.execute(query).fetchall()
+    assert [(pk, str(user)) for pk, user, _ in before] == \
+        [(pk, user) for pk, user, _ in after]
+    assert {row[2] for row in after} == {'text'}
+    assert db.schema_version == igsync.migrations.latest_version()
+    assert db.cursor.execute("SELECT count(*) FROM sqlite_master WHERE "
+                             "name LIKE '%migrating%'").fetchone() == (0,)
+    assert db.cursor.execute("SELECT count(*) FROM sqlite_master WHERE "
+                             "name = 'posts_user'").fetchone() == (1,)
+    relations = "SELECT post_pk, collection_pk, taken_at " \
+        "FROM collection_relations ORDER BY 1, 2"
+    expected = db.cursor.execute(relations).fetchall()
+    assert len(expected) > 2 and all(row[2] for row in expected)
+    db.cursor.executescript("""
+        UPDATE collection_relations SET taken_at = NULL;
+        DROP INDEX posts_user;
+        CREATE INDEX posts_user ON posts (user_pk);
+    """)
+    igsync.migrations.set_version(db.cursor, 4)
+    igsync.InstagramDb(db.path).migrate(batch_size=2)
+    assert db.cursor.execute(relations).fetchall() == expected
+    assert 'taken_at' in db.cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'posts_user'"
+    ).fetchone()[0]
+
+
+def test_post_codecs():
+    """Test that posts stored as JSON or compressed with a trained dictionary
+    decode to the original payload, and that legacy ``repr`` rows can be
+    converted."""
+    originals = {}
+    for post in (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON):
+        post = json.loads(post)
+        originals[post['media']['pk']] = post
+    db = new_db()
+    size = "SELECT sum(length(post_json)) FROM posts"
+    json_size = db.cursor.execute(size).fetchone()[0]
+    db.cursor.execute("SELECT pk, post_json, typeof(post_json) FROM posts")
+    for pk, post_json, kind in db.cursor.fetchall():
+        assert kind == 'text' and json.loads(post_json) == originals[pk]
+    db.cursor.executemany("UPDATE posts SET post_json = ? WHERE pk = ?",
+                          [(str(p), k) for k, p in originals.items()])
+    assert db.convert_posts(batch_size=2) == 3
+    assert db.convert_posts() == 0
+    assert db.cursor.execute(size).fetchone()[0] == json_size
+    compressed = igsync.InstagramDb(db.path, post_codec='zlib')
+    compressed.train_post_dictionary()
+    assert compressed.convert_posts() == 3
+    assert db.cursor.execute("SELECT DISTINCT typeof(post_json) FROM posts"
+                             ).fetchall() == [('blob',)]
+    assert db.cursor.execute(size).fetchone()[0] < json_size / 2
+    for pk, post in originals.items():
+        assert compressed.get_post(pk) == post
+        assert db.get_post(pk) == post
+
+
+def test_incremental_sync():
+    """Test that syncing a collection only pages back as far as the posts
+    seen by the previous sync unless a full sync is requested."""
+    db = new_db()
+    feed = [feed_item(i) for i in range(8)]
+    db._client = FakeClient({'1000': feed})
+    assert db.sync_collection('1000', page_delay=(0, 0)) == 8
+    assert len(db._client.calls) == 3
+    assert db.get_sync_state('1000').newest_post_pk == str(10**18)
+    feed.insert(0, feed_item(8))
+    feed.insert(0, feed_item(9))
+    del db._client.calls[:]
+    assert db.sync_collection('1000', page_delay=(0, 0)) == 2
+    assert len(db._client.calls) == 1
+    assert len(db.get_collection_posts('1000')) == 10
+    del db._client.calls[:]
+    assert db.sync_collection('1000', page_delay=(0, 0), full=True) == 10
+    assert len(db._client.calls) == 4
+    # the cursor post was removed from the collection: every way of syncing
+    # stops at the first page whose posts are all saved already
+    db.cursor.execute("UPDATE collection_sync_state SET newest_post_pk = "
+                      "'1' WHERE collection_pk = '1000'")
+    db.connection.commit()
+    del db._client.calls[:]
+    assert db.sync_collection('1000', page_delay=(0, 0)) == 0
+    assert len(db._client.calls) == 1
+    db.cursor.execute("UPDATE collection_sync_state SET newest_post_pk = "
+                      "'1' WHERE collection_pk = '1000'")
+    db.connection.commit()
+    del db._client.calls[:]
+    pipeline = igsync.Pipeline(db, None, download_workers=0,
+                               page_delay=(0, 0))
+    pipeline.run(['1000'])
+    assert pipeline.saved['1000'] == 0 and len(db._client.calls) == 1
+
+    async def sync():
+        async with igsync.AsyncInstagramDb(db.path, throttle=igsync.Throttle(
+                api=None, cdn=None)) as adb:
+            adb.db._client = FakeClient({'1000': feed})
+            await adb.write(lambda db: db.cursor.execute(
+                "UPDATE collection_sync_state SET newest_post_pk = '1'"))
+            assert await adb.sync_collection('1000') == 0
+            return adb.db._client.calls
+    assert len(asyncio.run(sync())) == 1
+
+
+def test_crawler():
+    """Test that the crawler pages through whole collection feeds and that
+    syncing with no collections specified syncs (and names) all of them."""
+    feeds = {'1000': [feed_item(i) for i in range(7)],
+             '2000': [feed_item(i, '2000') for i in range(10, 12)]}
+    client = FakeClient(feeds)
+    items = list(igsync.crawler.iter_collection_feed(client, '1000', (0, 0)))
+    assert items == feeds['1000']
+    assert len(client.calls) == 3
+    db = new_db()
+    db._client = client
+    assert db.sync_collections(page_delay=(0, 0)) == {'1000': 7, '2000': 2}
+    assert db.cursor.execute("SELECT name FROM collections WHERE pk = '2000'"
+                             ).fetchone() == ('c2000',)
+
+
 def test_collection_sync():
     """Test igsync's ability to sync collection names."""
     DB.sync_collection_names(DB.get_anonymous_collections())
 
 
+def test_download():
+    """Test that the downloader fetches every pending URL from a local CDN,
+    writes the expected bytes, and marks the rows as downloaded."""
+    with local_cdn() as cdn, TemporaryDirectory() as media_root:
+        db = new_db(cdn)
+        pending = db.get_undownloaded_urls()
+        assert len(pending) == 8
+        results = igsync.Downloader(db, media_root, workers=4, rate=100,
+                                    batch_size=3).download()
+        assert not results.failed
+        assert len(results.downloaded) == len(pending)
+        assert db.get_undownloaded_urls() == []
+        for info, download in results.downloaded:
+            path = download.path
+            assert path == db.get_media_path(info)
+            with open(os.path.join(media_root, path), 'rb') as media:
+                assert media.read() == cdn_bytes(info.url[len(cdn):]
+                                                 .split('?')[0])
+
+
+def test_download_resume():
+    """Test that an interrupted download leaves no file at the final path and
+    that the next attempt resumes it with a Range request."""
+    with TemporaryDirectory() as media_root:
+        with local_cdn(FlakyCdnHandler) as cdn:
+            db = new_db(cdn)
+            video = [u for u in db.get_undownloaded_urls()
+                     if u.url.endswith('.mp4')]
+            downloader = igsync.Downloader(db, media_root, retries=0)
+            results = downloader.download(video)
+        assert len(results.failed) == 1
+        path = os.path.join(media_root, db.get_media_path(video[0]))
+        assert not os.path.exists(path)
+        assert os.path.getsize(path + '.part') == FlakyCdnHandler.truncate
+        with local_cdn() as cdn2:
+            db.cursor.execute("UPDATE post_urls SET url = replace(url, ?, ?)",
+                              (cdn, cdn2))
+            video = [u for u in db.reset_failures().get_undownloaded_urls()
+                     if u.url.endswith('.mp4')]
+            del CdnHandler.requests[:]
+            results = downloader.download(video)
+        assert not results.failed
+        assert CdnHandler.requests[0][2] == 'bytes={}-'.format(
+            FlakyCdnHandler.truncate)
+        assert not os.path.exists(path + '.part.offset')
+        with open(path, 'rb') as media:
+            assert media.read() == cdn_bytes(video[0].url[len(cdn2):])
+
+
+def test_pipeline():
+    """Test that the pipeline saves crawled posts, downloads their media and
+    links it into collection directories in one pass, and that a second run
+    only crawls new posts."""
+    with local_cdn() as cdn, TemporaryDirectory() as media_root:
+        feeds = {pk: [json.loads(json.dumps(feed_item(i, pk)).replace(
+            CDN_HOST, cdn)) for i in range(start, start+5)]
+                 for pk, start in (('1000', 0), ('2000', 10))}
+        db = new_db()
+        db._client = FakeClient(feeds, page_size=2)
+        collections = os.path.join(media_root, 'collections')
+        dirs = {pk: os.path.join(collections, pk) for pk in feeds}
+        pipeline = igsync.Pipeline(db, media_root, crawl_workers=2,
+                                   download_workers=3, queue_size=2,
+                                   batch_size=3, page_delay=(0, 0),
+                                   collection_dirs=dirs)
+        stats = pipeline.run()
+        assert stats['ingest'].processed == 10
+        assert stats['download'].processed == 10
+        assert stats['link'].processed == 10
+        assert not any(s.failed for s in stats.values())
+        assert all(s.queue_depth == 0 for s in stats.values())
+        assert not [u for u in db.get_undownloaded_urls()
+                    if u.code.startswith('item')]
+        for pk in feeds:
+            assert len(os.listdir(dirs[pk])) == 5
+            assert db.get_sync_state(pk).newest_post_pk == \
+                feeds[pk][0]['media']['pk']
+        feeds['1000'].insert(0, json.loads(json.dumps(feed_item(
+            20)).replace(CDN_HOST, cdn)))
+        del db._client.calls[:]
+        stats = igsync.Pipeline(db, media_root, page_delay=(0, 0),
+                                collection_dirs=dirs).run(['1000'])
+        assert stats['ingest'].processed == 1
+        assert len(db._client.calls) == 1
+        assert len(os.listdir(dirs['1000'])) == 6
+
+
+def test_rate_limiter():
+    """Test that the rate limiter spaces out requests, backs off on
+    throttling errors (and only on those) and ramps up on clean responses,
+    and that throttled clients and per-host budgets go through it."""
+    from urllib.error import HTTPError
+    limiter = igsync.RateLimiter(rate=200, burst=5, min_rate=50,
+                                 max_rate=400, increase=100)
+    start = time.monotonic()
+    for _ in range(25):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.09
+    limiter.success()
+    assert limiter.rate == 300
+    limiter.success()
+    limiter.success()
+    assert limiter.rate == 400
+    try:
+        limiter.call(int, 'not a number')
+    except ValueError:
+        pass
+    assert limiter.rate == 400
+    throttling = HTTPError('http://example.com', 429, 'Too Many Requests',
+                           {'Retry-After': '0.1'}, None)
+
+    def throttled():
+        raise throttling
+    for _ in range(2):
+        try:
+            limiter.call(throttled)
+        except HTTPError:
+            pass
+        else:
+            raise AssertionError("throttling error was swallowed")
+    assert limiter.rate == 200
+    start = time.monotonic()
+    limiter.wait()
+    assert time.monotonic() - start >= 0.09
+    throttle = igsync.Throttle(api=dict(rate=1000))
+    assert throttle.host('https://a.cdn/x') is throttle.host('https://a.cdn/y')
+    assert throttle.host('https://a.cdn/x') is not throttle.host('https://b/')
+    client = igsync.ratelimit.ThrottledClient(FakeClient({'1': []}),
+                                              throttle.api)
+    assert client.page_size == 3
+    client.collection_feed('1')
+    assert client.calls == [('collection_feed', '1', None)]
+    assert throttle.api.rate == 1000
+
+
+def test_download_failures():
+    """Test that transient errors are retried in-process, that failed
+    downloads are recorded with a backoff that hides them from
+    ``get_undownloaded_urls`` until it passes, and that permanently failed
+    URLs aren't retried until reset."""
+    attempts = []
+
+    def flaky():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise ConnectionResetError("dropped")
+        return "ok"
+    assert igsync.retry.call(flaky, retries=2, delay=0.01) == "ok"
+    del attempts[:]
+    try:
+        igsync.retry.call(flaky, retries=1, delay=0.01)
+    except ConnectionResetError:
+        pass
+    else:
+        raise AssertionError("last transient error was swallowed")
+    assert len(attempts) == 2
+    with local_cdn(BrokenCdnHandler) as cdn, \
+            TemporaryDirectory() as media_root:
+        db = new_db(cdn)
+        pending = db.get_undownloaded_urls()
+        del CdnHandler.requests[:]
+        results = igsync.Downloader(db, media_root, retries=0).download()
+        assert len(results.failed) == len(pending)
+        assert len(CdnHandler.requests) == len(pending)
+        assert db.get_undownloaded_urls() == []
+        rows = db.cursor.execute(
+            "SELECT url, attempts, last_error, next_attempt_at "
+            "FROM post_urls").fetchall()
+        for url, count, error, next_attempt in rows:
+            assert count == 1
+            if '.mp4' in url:
+                assert '404' in error
+                assert next_attempt == igsync.retry.NEVER
+            else:
+                assert '503' in error
+                assert time.time() < next_attempt < igsync.retry.NEVER
+        retried = db.get_undownloaded_urls(now=igsync.retry.NEVER - 1)
+        assert len(retried) == len(pending) - 1
+        assert not [u for u in retried if '.mp4' in u.url]
+        db.record_failures([(retried[0], ConnectionResetError())], now=0)
+        attempts, next_attempt = db.cursor.execute(
+            "SELECT attempts, next_attempt_at FROM post_urls WHERE url = ?",
+            (retried[0].url,)).fetchone()
+        base = igsync.retry.BACKOFF_BASE
+        assert attempts == 2 and base <= next_attempt <= 2*base
+        db.cursor.execute("UPDATE post_urls SET attempts = ? WHERE url = ?",
+                          (igsync.retry.MAX_ATTEMPTS - 1, retried[1].url))
+        db.record_failures([(retried[1], ConnectionResetError()),
+                            (retried[2], ConnectionResetError())], now=0)
+        next_attempts = dict(db.cursor.execute(
+            "SELECT url, next_attempt_at FROM post_urls WHERE url IN (?, ?)",
+            (retried[1].url, retried[2].url)).fetchall())
+        assert next_attempts[retried[1].url] == igsync.retry.NEVER
+        assert base <= next_attempts[retried[2].url] <= 2*base
+        assert len(db.reset_failures().get_undownloaded_urls()) == \
+            len(pending)
+
+
+def test_refresh_urls():
+    """Test that expired media URLs are detected from their signed expiry
+    time or from a failed download, refreshed in one batch, and then
+    downloaded."""
+    assert igsync.expiry.url_expiry(
+        'https://a.cdn/vp/4012ba/5BF88474/t51/x.jpg?se=7') == 0x5BF88474
+    assert igsync.expiry.url_expiry(
+        'https://a.cdn/v/t51/x.jpg?_nc_ht=a&oe=5C3ACE7C') == 0x5C3ACE7C
+    assert igsync.expiry.url_expiry('https://a.cdn/x.jpg') is None
+    assert not igsync.expiry.is_expired('https://a.cdn/x.jpg?oe=7FFFFFFF')
+    with local_cdn(SignedCdnHandler) as cdn, \
+            TemporaryDirectory() as media_root:
+        db = new_db(cdn)
+        fresh = dict()
+        for post in (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON):
+            post = json.loads(re.sub(
+                r'(/vp/[0-9a-f]+/)[0-9A-F]{8}/', r'\g<1>{}/'.format(
+                    FRESH_EXPIRY), post.replace(CDN_HOST, cdn)))['media']
+            fresh[str(post['pk'])] = post
+        # looks fresh, but the CDN rejects it anyway
+        rejected = str(json.loads(IMAGE_JSON)['media']['pk'])
+        db.cursor.execute("UPDATE post_urls SET url = ? WHERE post_pk = ?",
+                          (cdn + '/x.jpg?oe=7FFFFFFE', rejected))
+        db.connection.commit()
+        assert db.get_stale_post_pks() == sorted(set(fresh) - {rejected})
+        db._client = FakeClient(dict(), media=fresh)
+        results = igsync.Downloader(db, media_root, refresh=True).download()
+        assert not results.failed
+        assert len(results.downloaded) == 8
+        assert [c[0] for c in db._client.calls] == ['medias_info'] * 2
+        assert db._client.calls[1][1] == [rejected]
+        assert db.get_stale_post_pks() == []
+        assert db.cursor.execute(
+            "SELECT count(*) FROM post_urls WHERE url LIKE ? AND "
+            "download_path IS NOT NULL", ('%/{}/%'.format(FRESH_EXPIRY),)
+        ).fetchone() == (8,)
+        # two pending rows for one media item, with the old and the newly
+        # signed URL, plus a third stale one
+        image = fresh[rejected]
+        db.cursor.execute("UPDATE post_urls SET download_path = NULL")
+        db.cursor.executemany(
+            "INSERT INTO post_urls (post_pk, url, ind, media_type, height, "
+            "width) VALUES (?, ?, 0, 1, 1, 1)",
+            [(rejected, cdn + '/old.jpg?oe=1'), (rejected, cdn + '/2.jpg')]
+        )
+        assert db.refresh_urls([rejected]) == 1
+        assert db.cursor.execute(
+            "SELECT url, attempts FROM post_urls WHERE post_pk = ?",
+            (rejected,)
+        ).fetchall() == [(igsync.media.media_links(image)[0].url, 0)]
+
+
+def test_connection_pool():
+    """Test that downloads reuse keep-alive connections from the pool, that
+    each download opens its own connection without one, and that closing a
+    downloader only closes the pool it opened itself."""
+    with local_cdn(KeepAliveCdnHandler) as cdn:
+        for size, connections in ((1, 1), (0, 8)):
+            with TemporaryDirectory() as media_root:
+                db = new_db(cdn)
+                del KeepAliveCdnHandler.connections[:]
+                with igsync.Downloader(db, media_root, workers=1,
+                                       pool_size=size) as downloader:
+                    results = downloader.download()
+                assert not downloader.pool._idle
+                assert len(results.downloaded) == 8
+                assert len(KeepAliveCdnHandler.connections) == connections
+                for info, download in results.downloaded:
+                    with open(os.path.join(media_root, download.path),
+                              'rb') as media:
+                        assert media.read() == cdn_bytes(
+                            info.url[len(cdn):].split('?')[0])
+        pool = igsync.pool.ConnectionPool()
+        with TemporaryDirectory() as media_root:
+            with igsync.Downloader(new_db(cdn), media_root, workers=1,
+                                   pool=pool) as downloader:
+                downloader.download()
+        assert pool._idle
+        pool.close()
+        try:
+            pool.request('GET', cdn.replace('http', 'ftp'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("unsupported scheme was accepted")
+
+
+def test_async_db():
+    """Test that the asyncio facade syncs collections concurrently, iterates
+    over feeds and pending downloads, downloads media, and runs every
+    database call on its writer thread."""
+    feeds = {'1000': [feed_item(i) for i in range(7)],
+             '2000': [feed_item(i, '2000') for i in range(10, 12)]}
+
+    async def run(cdn, media_root):
+        path = new_db(cdn).path
+        async with igsync.AsyncInstagramDb(path, throttle=igsync.Throttle(
+                api=None, cdn=None)) as adb:
+            adb.db._client = FakeClient(feeds)
+            items = [item async for item in adb.iter_collection_feed('1000')]
+            assert items == feeds['1000']
+            assert await adb.sync_collections() == {'1000': 7, '2000': 2}
+            assert await adb.sync_collection('1000') == 0
+            assert len(await adb.get_collection_posts('2000')) == 2
+            pending = [u async for u in adb.iter_undownloaded_urls()]
+            assert len(pending) == 8 + 9
+            assert [u async for u in adb.iter_undownloaded_urls(
+                fetch_size=5)] == pending
+            example = [u for u in pending if u.url.startswith(cdn)]
+            # more URLs than download workers, given lazily
+            adb.api_workers = 3
+            results = await adb.download(media_root, iter(example))
+            assert len(results.downloaded) == 8
+            assert not results.failed
+            assert len(await adb.get_undownloaded_urls()) == 9
+            writer = await adb.write(lambda db: threading.get_ident())
+            assert writer != threading.get_ident()
+            assert await adb.write(lambda db: db.connection.execute(
+                "SELECT count(*) FROM posts").fetchone()) == (3 + 9,)
+
+    with local_cdn() as cdn, TemporaryDirectory() as media_root:
+        asyncio.run(run(cdn, media_root))
+
+
+def test_orchestrator():
+    """Test that the orchestrator syncs each account with its own session and
+    API budget into one database and media store, storing posts saved by
+    both accounts once, and that one account failing doesn't stop the
+    others."""
+    with local_cdn() as cdn, TemporaryDirectory() as storage:
+        feeds = {
+            user: {pk: [json.loads(json.dumps(feed_item(i, pk)).replace(
+                CDN_HOST, cdn)) for i in range(start, start+4)]}
+            for user, pk, start in (('alice', '1000', 0), ('bob', '2000', 2))
+        }
+        sessions = dict()
+
+        class Orchestrator(igsync.Orchestrator):
+            def connect(self, account):
+                db = igsync.InstagramDb(
+                    self.db_path, throttle=self.throttle.with_api(None),
+                    sessions=self.sessions, shared=True
+                )
+                sessions[account.username] = db
+                db._client = FakeClient(feeds[account.username], page_size=2)
+                return db
+
+        path = os.path.join(storage, 'insta.sqlite')
+        media_root = os.path.join(storage, 'media')
+        collections = os.path.join(storage, 'collections')
+        accounts = [igsync.Account('alice', 'pw'),
+                    igsync.Account('bob', 'pw', ['2000']),
+                    igsync.Account('carol', 'pw')]
+        orchestrator = Orchestrator(path, media_root, accounts,
+                                    collections_dir=collections,
+                                    page_delay=(0, 0))
+        assert orchestrator.run() == {'alice': {'1000': 4},
+                                      'bob': {'2000': 4}, 'carol': None}
+        alice, bob = sessions['alice'], sessions['bob']
+        assert alice.throttle.api is not bob.throttle.api
+        assert alice.throttle.host(cdn) is bob.throttle.host(cdn)
+        for user, pk in (('alice', '1000'), ('bob', '2000')):
+            assert len(os.listdir(os.path.join(collections, user, pk))) == 4
+        db = igsync.InstagramDb(path)
+        assert db.cursor.execute("SELECT count(*) FROM posts"
+                                 ).fetchone() == (6,)
+        both = feeds['bob']['2000'][0]['media']['pk']
+        assert sorted(db.get_post_collections(both)) == ['1000', '2000']
+        assert not db.get_undownloaded_urls()
+        assert db.cursor.execute("SELECT count(*) FROM post_urls WHERE "
+                                 "blob_hash IS NULL").fetchone() == (0,)
+
+
+def session_cookie(settings):
+    """Get the value of the ``sessionid`` cookie in the pickled cookie jar
+    of the client ``settings``."""
+    from instagram_private_api.http import ClientCookieJar
+    jar = ClientCookieJar(settings['cookie'])
+    return next(c.value for c in jar if c.name == 'sessionid')
+
+
+class LoginClient(object):
+    """Stand-in for the Instagram API client that records full logins in
+    ``logins`` and only serves requests with the session cookie of the
+    latest login. Like the real client, its ``settings`` hold its cookie
+    jar pickled as ``bytes``."""
+    logins = []
+
+    def __init__(self, username, password, settings=None):
+        from http.cookiejar import Cookie
+        from instagram_private_api.http import ClientCookieJar
+        if settings is None:
+            time.sleep(0.01)  # give other threads a chance to log in too
+            self.logins.append(username)
+            self.cookie_jar = ClientCookieJar()
+            self.cookie_jar.set_cookie(Cookie(
+                0, 'sessionid', "session{}".format(len(self.logins)), None,
+                False, '.instagram.com', True, True, '/', True, True, None,
+                False, None, None, {}
+            ))
+        else:
+            self.cookie_jar = ClientCookieJar(settings['cookie'])
+
+    @property
+    def settings(self):
+        return dict(uuid='uuid', cookie=self.cookie_jar.dump())
+
+    def list_collections(self):
+        from instagram_private_api.errors import ClientLoginRequiredError
+        if session_cookie(self.settings) != "session{}".format(
+                len(self.logins)):
+            raise ClientLoginRequiredError('login_required', code=400)
+        return dict(items=[], more_available=False)
+
+
+def test_session_cache():
+    """Test that cached sessions are reused without logging in, that the
+    client only logs in again when a request fails because the session is no
+    longer valid, and that expired or mismatched sessions are ignored."""
+    from igsync.session import Session, SessionCache, SESSION_TTL
+    del LoginClient.logins[:]
+    with TemporaryDirectory() as sessions:
+        cache = SessionCache(sessions)
+        db = igsync.InstagramDb(new_db().path, 'alice', 'pw',
+                                sessions=sessions)
+        assert db._client.client is None
+        assert LoginClient.logins == []
+        session = Session('alice', 'pw', cache, LoginClient)
+        assert session.list_collections()['items'] == []
+        assert LoginClient.logins == ['alice']
+        assert os.stat(cache.path('alice')).st_mode & 0o077 == 0
+        session = Session('alice', 'pw', cache, LoginClient)
+        for _ in range(2):
+            session.list_collections()
+        assert session.logins == 0
+        assert LoginClient.logins == ['alice']
+        # another process logs in, invalidating our cached session
+        Session('alice', 'pw', SessionCache(sessions + '2'),
+                LoginClient).connect()
+        session = Session('alice', 'pw', cache, LoginClient)
+        assert session.list_collections()['items'] == []
+        assert session.logins == 1
+        assert session_cookie(cache.load('alice')) == "session3"
+        assert os.listdir(sessions) == ['alice.json']
+        # threads sharing a session log in once, however many fail at once
+        for cache_dir in (sessions + '3', sessions):
+            del LoginClient.logins[:]
+            session = Session('alice', 'pw', SessionCache(cache_dir),
+                              LoginClient)
+            threads = [threading.Thread(target=session.list_collections)
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert session.logins == 1 and LoginClient.logins == ['alice']
+        broken = type('Client', (), dict(settings=dict(uuid={'uuid'}),
+                                         cookie_jar=session.cookie_jar))
+        try:
+            cache.save('carol', broken)
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("Unserializable settings were cached.")
+        assert os.listdir(sessions) == ['alice.json']
+        assert cache.load('alice', now=time.time() + SESSION_TTL) is None
+        assert cache.load('bob') is None
+        os.rename(cache.path('alice'), cache.path('bob'))
+        assert cache.load('bob') is None
+
+
+def import_times(statement, **env):
+    """Run ``statement`` in a fresh interpreter with ``-X importtime`` (and
+    the extra environment variables ``env``) and return a dict mapping the
+    names of the modules it imported to their cumulative import times in
+    microseconds."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        env=dict(os.environ, **env), stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+    times = dict()
+    for line in proc.stderr.splitlines():
+        fields = line.partition('import time:')[2].split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def test_import_time():
+    """Test that importing igsync has no side effects and leaves the API
+    client, downloader and ``asyncio`` to be imported on first use."""
+    with TemporaryDirectory() as home:
+        times = import_times("import igsync", HOME=home)
+        assert os.listdir(home) == []
+    assert 'igsync' in times
+    for module in ('instagram_private_api', 'asyncio', 'ssl', 'http.client',
+                   'igsync.download', 'igsync.aio'):
+        assert module not in times, module
+    loaded = subprocess.check_output([sys.executable, '-c', (
+        "import sys, igsync; igsync.Downloader, igsync.pool; "
+        "print(*(m in sys.modules for m in ('igsync.download', 'asyncio')))"
+    )], universal_newlines=True)
+    assert loaded.split() == ['True', 'False']
+
+
+def test_query_posts():
+    """Test that posts can be filtered by collection, user, date range and
+    media type, that keyset pages cover every post exactly once in order,
+    and that no page needs a sort or a full table scan."""
+    db = new_db()
+    posts = [feed_item(i, '1000' if i % 3 else '2000') for i in range(20)]
+    for i, post in enumerate(posts):
+        post['media']['taken_at'] = 1500000000 + i//2  # with ties
+        post['media']['user']['pk'] = str(i % 2)
+    db.save_posts(posts)
+    expected = sorted(((p['media']['taken_at'], p['media']['pk'])
+                       for i, p in enumerate(posts) if i % 3), reverse=True)
+    pages, after = [], None
+    while True:
+        page = db.page_posts(4, after, collection_pk='1000')
+        pages.append(page.posts)
+        if page.next is None:
+            break
+        after = page.next
+    assert [len(p) for p in pages] == [4, 4, 4, 1]
+    assert [igsync.query.key(p) for page in pages for p in page] == expected
+    assert [p.pk for p in db.iter_posts(collection_pk='1000',
+                                        fetch_size=3)] == \
+        [pk for _, pk in expected]
+    assert all(p.user_pk == '1' for p in db.iter_posts(user_pk='1'))
+    assert len(list(db.iter_posts(user_pk='1', collection_pk='2000'))) == 3
+    assert len(list(db.iter_posts(since=1500000002,
+                                  until=1500000004))) == 4
+    assert {p.media_type for p in db.iter_posts(media_type='carousel')} == \
+        {8}
+    assert len(list(db.iter_posts(limit=5))) == 5
+    queries = []
+    db.connection.set_trace_callback(queries.append)
+    for filters in (dict(), dict(collection_pk='1000'), dict(user_pk='1'),
+                    dict(since=1500000002)):
+        db.page_posts(2, after=(1500000005, posts[0]['media']['pk']),
+                      **filters)
+    db.connection.set_trace_callback(None)
+    for query in queries:
+        for row in db.cursor.execute("EXPLAIN QUERY PLAN " + query):
+            detail = row[-1]
+            assert 'TEMP B-TREE' not in detail, detail
+            assert not detail.startswith('SCAN') or 'INDEX' in detail, detail
+    # older databases get taken_at copied into collection_relations
+    db.cursor.execute("UPDATE collection_relations SET taken_at = NULL")
+    igsync.migrations.set_version(db.cursor, 4)
+    db.migrate()
+    assert db.cursor.execute("SELECT count(*) FROM collection_relations "
+                             "WHERE taken_at IS NULL").fetchone() == (0,)
+
+
+def test_parallel_sync():
+    """Test that syncing collections with several workers crawls them
+    concurrently while saving every post from the calling thread."""
+    feeds = {str(pk): [feed_item(pk + i, str(pk)) for i in range(5)]
+             for pk in range(1000, 7000, 1000)}
+
+    class SlowClient(FakeClient):
+        active = 0
+        most_active = 0
+        lock = threading.Lock()
+
+        def collection_feed(self, collection_id, max_id=None):
+            with self.lock:
+                self.active += 1
+                self.most_active = max(self.most_active, self.active)
+            time.sleep(0.02)
+            with self.lock:
+                self.active -= 1
+            return super().collection_feed(collection_id, max_id)
+
+    db = new_db()
+    db._client = SlowClient(feeds)
+    assert db.sync_collections(page_delay=None, workers=3) == \
+        {pk: 5 for pk in feeds}
+    assert db._client.most_active == 3
+    for pk, feed in feeds.items():
+        assert db.get_sync_state(pk).newest_post_pk == feed[0]['media']['pk']
+        assert len(db.get_collection_posts(pk)) == 5
+    feeds['1000'].insert(0, feed_item(999, '1000'))
+    assert db.sync_collections(list(feeds), workers=3)['1000'] == 1
+    assert len(db.get_undownloaded_urls()) == 8 + 31
+
+
+def test_collection_names():
+    """Test that anonymous collections are named from one request for the
+    collection list, which is cached, instead of one feed per collection,
+    and that names can be saved as part of a larger transaction."""
+    feeds = {pk: [feed_item(int(pk), pk)] for pk in ('1000', '2000', '3000')}
+    db = new_db()
+    db.save_posts(feed[0] for feed in feeds.values())
+    db._client = FakeClient(feeds)
+    anonymous = set(db.get_anonymous_collections())
+    assert anonymous.issuperset(feeds)
+    assert db.sync_collection_names() == {pk: 'c' + pk for pk in feeds}
+    assert db._client.calls == [('list_collections',)]
+    assert set(db.get_anonymous_collections()) == anonymous.difference(feeds)
+    feeds['4000'] = []
+    db.save_collection('4000')
+    assert db.sync_collection_names(['4000']) == dict()
+    assert len(db._client.calls) == 1
+    assert db.sync_collection_names(['4000'], max_age=0) == {'4000': 'c4000'}
+    assert len(db._client.calls) == 2
+    assert db.sync_collection_names([]) == dict()
+    assert not [c for c in db._client.calls if c[0] == 'collection_feed']
+    db.save_collection_names({'5000': 'c5000'}, commit=False)
+    assert db.connection.in_transaction
+    db.connection.rollback()
+    assert db.cursor.execute("SELECT count(*) FROM collections WHERE "
+                             "pk = '5000'").fetchone() == (0,)
+
+
+def test_media_links():
+    """Test that renditions are picked by policy whatever order the API
+    lists them in, and that previews can be downloaded without touching the
+    archived media's download state."""
+    video = json.loads(VIDEO_JSON)['media']
+    video['video_versions'].reverse()
+    video['image_versions2']['candidates'].reverse()
+    links = igsync.media.media_links(video)
+    assert [(l.media_type, l.width) for l in links] == [(2, 640)]
+    links = igsync.media.media_links(video, igsync.PREVIEW)
+    assert [(l.media_type, l.width) for l in links] == [(1, 240)]
+    tiny = igsync.LinkPolicy(max_side=100, video=True)
+    assert igsync.media.media_links(video, tiny)[0].width == 480
+    carousel = json.loads(CAROUSEL_JSON)['media']
+    rows = list(igsync.media.iter_links([carousel, video], igsync.PREVIEW))
+    assert [(pk, i) for pk, i, _ in rows] == \
+        [(carousel['pk'], i) for i in range(6)] + [(video['pk'], 0)]
+    assert igsync.get_media_links(json.dumps(video)) == \
+        [igsync.media.media_links(video)[0]._asdict()]
+    with local_cdn() as cdn, TemporaryDirectory() as previews:
+        db = new_db(cdn)
+        pending = db.get_undownloaded_urls()
+        urls = db.get_media_urls()
+        assert sorted((u.post_pk, u.index) for u in urls) == \
+            sorted((u.post_pk, u.index) for u in pending)
+        assert not set(u.url for u in urls).intersection(
+            u.url.replace(cdn, CDN_HOST) for u in pending)
+        urls = [u._replace(url=u.url.replace(CDN_HOST, cdn)) for u in urls]
+        results = igsync.Downloader(db, previews, record=False).download(urls)
+        assert len(results.downloaded) == 8 and not results.failed
+        assert db.get_undownloaded_urls() == pending
+
+
+def test_json_decoders():
+    """Test that every installed JSON decoder saves the same rows as the
+    stdlib's, that posts can be given as bytes, that documents with lone
+    surrogates (which ``orjson`` rejects) still parse, and that asking for a
+    decoder that isn't installed fails early."""
+    tables = ('users', 'collections', 'posts', 'post_urls',
+              'collection_relations')
+    expected = None
+    for name in igsync.codec.DECODERS:
+        try:
+            decoder = igsync.codec.get_decoder(name)
+        except ValueError:
+            if importlib.util.find_spec(name) is not None:
+                raise
+            continue
+        assert decoder.loads(CAROUSEL_JSON.encode()) == \
+            json.loads(CAROUSEL_JSON)
+        surrogate = json.loads(IMAGE_JSON)
+        surrogate['media']['caption']['text'] = 'cut off \ud83d'
+        surrogate = json.dumps(surrogate)
+        assert decoder.loads(surrogate.encode()) == json.loads(surrogate)
+        try:
+            decoder.loads(b'{"media": {')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Malformed JSON was accepted.")
+        tmp = NamedTemporaryFile(delete=False, suffix='.sqlite')
+        tmp.file.close()
+        db = igsync.InstagramDb(path=tmp.name, decoder=name).inittables()
+        db.save_post(CAROUSEL_JSON)
+        db.save_posts([VIDEO_JSON.encode(), surrogate])
+        rows = [db.cursor.execute("SELECT * FROM {} ORDER BY 1, 2".format(
+            table)).fetchall() for table in tables]
+        assert expected is None or rows == expected
+        expected = rows
+        for pk, post_json in db.cursor.execute(
+                "SELECT pk, post_json FROM posts").fetchall():
+            assert db.get_post(pk) == json.loads(post_json)
+        assert db.cursor.execute(
+            "SELECT caption_text FROM posts WHERE pk = ?",
+            (json.loads(surrogate)['media']['pk'],)
+        ).fetchone()[0] == 'cut off \ufffd'
+    try:
+        igsync.InstagramDb(path=tmp.name, decoder='yaml')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Unrecognized decoder was accepted.")
+
+
+def test_import_json():
+    """Test that a JSON dump directory imports the same rows as saving its
+    posts directly, skipping broken files, and that a second run only loads
+    the files that weren't imported, whatever their names."""
+    tables = ('users', 'collections', 'posts', 'post_urls',
+              'collection_relations')
+    expected = new_db()
+    with TemporaryDirectory() as dump:
+        for post in (CAROUSEL_JSON, VIDEO_JSON, IMAGE_JSON):
+            code = json.loads(post)['media']['code']
+            with open(os.path.join(dump, code + '.json'), 'w') as outfile:
+                outfile.write(post)
+        with open(os.path.join(dump, 'AAA.json'), 'w') as outfile:
+            outfile.write('{"media": {')
+        with open(os.path.join(dump, 'notes.txt'), 'w') as outfile:
+            outfile.write(IMAGE_JSON)
+        tmp = NamedTemporaryFile(delete=False, suffix='.sqlite')
+        tmp.file.close()
+        db = igsync.InstagramDb(path=tmp.name).inittables()
+        importer = igsync.JsonImporter(db, dump, workers=2, batch_size=2)
+        assert importer.run() == 3 and importer.failed == 1
+        for table in tables:
+            query = "SELECT * FROM {} ORDER BY 1, 2".format(table)
+            assert (db.cursor.execute(query).fetchall() ==
+                    expected.cursor.execute(query).fetchall())
+        assert len(db.get_imported_files(dump, os.listdir(dump))) == 3
+        imported = functools.partial(db.get_imported_files, dump)
+        assert list(igsync.importer.iter_json_files(
+            dump, imported, chunk_size=2)) == ['AAA.json']
+        # a new file sorting before every imported one, and a copy of a
+        # post that's saved already
+        post = json.loads(IMAGE_JSON)
+        post['media'].update(pk='1', code='0000')
+        with open(os.path.join(dump, '0000.json'), 'w') as outfile:
+            json.dump(post, outfile)
+        with open(os.path.join(dump, 'zzz.json'), 'w') as outfile:
+            outfile.write(IMAGE_JSON)
+        importer = igsync.JsonImporter(db, dump, workers=0)
+        assert importer.run() == 1
+        assert (importer.skipped, importer.failed) == (1, 1)
+        assert db.get_post('1')['media']['code'] == '0000'
+        assert len(db.get_imported_files(dump, os.listdir(dump))) == 5
+
+
+def test_flat_layout():
+    """Test that media is stored and linked under the names saveImages.php
+    uses, and that files it already downloaded aren't fetched again."""
+    with local_cdn() as cdn, TemporaryDirectory() as media_root:
+        db = new_db(cdn)
+        image = json.loads(IMAGE_JSON)['media']
+        pending = db.get_undownloaded_urls()
+        names = {db.get_media_name(u) for u in pending}
+        carousel = json.loads(CAROUSEL_JSON)['media']['code']
+        assert image['code'] + '.jpg' in names
+        assert carousel + '.5.jpg' in names and len(names) == 8
+        with open(os.path.join(media_root, image['code'] + '.jpg'),
+                  'wb') as outfile:
+            outfile.write(b'from saveImages.php')
+        del CdnHandler.requests[:]
+        results = igsync.Downloader(db, media_root, flat=True).download()
+        assert len(results.downloaded) == 8 and not results.failed
+        assert len(CdnHandler.requests) == 7
+        assert sorted(os.listdir(media_root)) == sorted(names)
+        collection = os.path.join(media_root, 'collection')
+        pk = json.loads(IMAGE_JSON)['media']['saved_collection_ids'][0]
+        assert igsync.materialize_collection(db, media_root, str(pk),
+                                             collection) > 0
+        assert image['code'] + '.jpg' in os.listdir(collection)
+
+
 def main():
     test_init_tables()
     test_save_post()
+    test_save_posts()
+    test_profiles()
+    test_query_plans()
+    test_migrate()
+    test_post_codecs()
+    test_incremental_sync()
+    test_crawler()
     test_collection_sync()
+    test_download()
+    test_download_resume()
+    test_content_addressed_download()
+    test_pipeline()
+    test_rate_limiter()
+    test_download_failures()
+    test_refresh_urls()
+    test_connection_pool()
+    test_async_db()
+    test_orchestrator()
+    test_session_cache()
+    test_import_time()
+    test_query_posts()
+    test_parallel_sync()
+    test_collection_names()
+    test_media_links()
+    test_json_decoders()
+    test_import_json()
+    test_flat_layout()
 
 if __name__ == "__main__":
     main()